@@ -3,13 +3,47 @@ from PyQt6.QtGui import *
 from PyQt6.QtCore import *
 from PyQt6.QtWidgets import *
 
+from geometry import segment_rect
+from undo import RasterHistory
+from tiled_canvas import TiledCanvas
+from input_batch import InputBatch
+
+
+class CanvasView(QWidget):
+    # Shows the visible part of a tiled canvas, plus the line being dragged out with the right button.
+    # Mouse input is left to the main window.
+    def __init__(self, canvas):
+        super().__init__()
+        self.canvas = canvas
+        self.previewLine = None
+        self.previewPen = None
+        self.setAttribute(Qt.WidgetAttribute.WA_OpaquePaintEvent)
+
+    def setPreviewLine(self, line, pen=None):
+        # Show or clear the transient line; only the areas of the old and the new line are repainted
+        if self.previewLine is not None:
+            self.update(segment_rect(self.previewLine.p1(), self.previewLine.p2(), self.previewPen.width()))
+        self.previewLine = line
+        self.previewPen = QPen(pen) if pen is not None else None
+        if line is not None:
+            self.update(segment_rect(line.p1(), line.p2(), self.previewPen.width()))
+
+    def paintEvent(self, event):
+        # Only the tiles under the exposed area are drawn
+        painter = QPainter(self)
+        self.canvas.render(painter, event.rect())
+        if self.previewLine is not None:
+            painter.setPen(self.previewPen)
+            painter.drawLine(self.previewLine)
+        painter.end()
+
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
 
-        # Set fixed size and window title
-        self.setFixedSize(800, 600)
+        # Set initial size and window title
+        self.resize(800, 600)
         self.setWindowTitle("Drawing App")
 
         # Variables to manage drawing state
@@ -17,16 +51,25 @@ class MainWindow(QMainWindow):
         self.drawing = False
         self.drawingLine = False
         self.lineStart = QPoint()
-        self.tempCanvas = None
+        self.strokeRect = QRect()
 
-        # Create a white canvas using QPixmap
-        self.label = QLabel()
-        self.canvas = QPixmap(QSize(800, 600))
-        self.canvas.fill(QColor("white"))
+        # Mouse moves are queued and drawn once per display frame
+        self.inputBatch = InputBatch(self, self.processMoves)
 
-        # Set canvas as the pixmap for the label
-        self.label.setPixmap(self.canvas)
-        self.setCentralWidget(self.label)
+        # Create a white canvas made of lazily allocated tiles, so it can grow to poster size
+        self.canvas = TiledCanvas(QSize(800, 600))
+
+        # Show the canvas in a scroll area; the view is never smaller than the canvas
+        self.view = CanvasView(self.canvas)
+        self.scrollArea = QScrollArea()
+        self.scrollArea.setWidgetResizable(True)
+        self.scrollArea.setWidget(self.view)
+        self.setCentralWidget(self.scrollArea)
+        self.view.setMinimumSize(self.canvas.size)
+
+        # Undo history: dirty-region patches plus periodic full checkpoints
+        self.history = RasterHistory()
+        self.history.reset(self.canvas)
 
         # Initialize drawing properties
         self.pen = QPen()
@@ -93,6 +136,17 @@ class MainWindow(QMainWindow):
         eraserAction.triggered.connect(self.useEraser)
         toolbar.addAction(eraserAction)
 
+        # Undo and redo actions
+        undoAction = QAction("Undo", self)
+        undoAction.setShortcut(QKeySequence.StandardKey.Undo)
+        undoAction.triggered.connect(self.undo)
+        toolbar.addAction(undoAction)
+
+        redoAction = QAction("Redo", self)
+        redoAction.setShortcuts(QKeySequence.StandardKey.Redo)
+        redoAction.triggered.connect(self.redo)
+        toolbar.addAction(redoAction)
+
         # Clear canvas action
         clearAction = QAction("Clear Canvas", self)
         clearAction.triggered.connect(self.clearCanvas)
@@ -101,6 +155,22 @@ class MainWindow(QMainWindow):
         # Add toolbar to the main window
         self.addToolBar(toolbar)
 
+    def canvasChanged(self, rect):
+        # Repaint only the changed area and let the view grow with the canvas
+        if self.view.minimumSize() != self.canvas.size:
+            self.view.setMinimumSize(self.canvas.size)
+        self.view.update(rect)
+
+    def canvasPosition(self, event):
+        # Mouse position in canvas coordinates
+        return self.view.mapFrom(self, event.pos())
+
+    def markDirty(self):
+        # The title only changes when the drawing first becomes dirty, not on every stroke event
+        if not self.dirty:
+            self.dirty = True
+            self.updateWindowTitle()
+
     def updateWindowTitle(self):
         # Update window title based on file name and dirty state
         title = "Drawing App"
@@ -135,7 +205,8 @@ class MainWindow(QMainWindow):
             self, "QFileDialog.getOpenFileName()", "", "Images (*.png *.xpm *.jpg)")
         if fileName:
             self.canvas.load(fileName)
-            self.label.setPixmap(self.canvas)
+            self.canvasChanged(self.view.rect())
+            self.history.reset(self.canvas)
             self.currentFileName = fileName
             self.dirty = False
             self.setWindowTitle(f"Drawing App - {self.currentFileName}")
@@ -143,9 +214,13 @@ class MainWindow(QMainWindow):
     def newFile(self):
         # Create a new blank canvas
         self.canvas.fill(QColor("white"))
-        self.label.setPixmap(self.canvas)
+        self.canvas.size = QSize(800, 600)
+        self.view.setMinimumSize(self.canvas.size)
+        self.view.update()
+        self.history.reset(self.canvas)
         self.currentFileName = None
         self.dirty = False
+        self.updateWindowTitle()
 
     def changeColor(self):
         # Change drawing color using QColorDialog
@@ -158,9 +233,27 @@ class MainWindow(QMainWindow):
     def clearCanvas(self):
         # Clear the canvas
         self.canvas.fill(QColor("white"))
-        self.label.setPixmap(self.canvas)
-        self.dirty = True
-        self.updateWindowTitle()
+        self.view.update()
+        self.history.record(self.canvas, self.canvas.rect())
+        self.markDirty()
+
+    def undo(self):
+        # Step back one operation, restoring only the area it touched
+        if self.drawing or self.drawingLine:
+            return
+        rect = self.history.undo(self.canvas)
+        if not rect.isEmpty():
+            self.canvasChanged(rect)
+            self.markDirty()
+
+    def redo(self):
+        # Re-apply the last undone operation
+        if self.drawing or self.drawingLine:
+            return
+        rect = self.history.redo(self.canvas)
+        if not rect.isEmpty():
+            self.canvasChanged(rect)
+            self.markDirty()
 
     def useEraser(self):
         # Set pen color to white for erasing
@@ -174,52 +267,42 @@ class MainWindow(QMainWindow):
         # Handle mouse press events
         if event.buttons() == Qt.MouseButton.LeftButton:
             self.drawing = True
-            self.previousPoint = event.pos()
-            self.previousPoint.setY(self.previousPoint.y() - 20)
+            self.previousPoint = self.canvasPosition(event)
+            self.strokeRect = QRect()
         elif event.buttons() == Qt.MouseButton.RightButton:
             self.drawingLine = True
-            self.lineStart = event.pos()
-            self.lineStart.setY(self.lineStart.y() - 20)
+            self.lineStart = self.canvasPosition(event)
 
     def mouseMoveEvent(self, event):
-        # Handle mouse move events for drawing
-        position = event.pos()
-        position.setY(position.y() - 20)
+        # Queue the move; it is handled with the others of the same frame
+        if (self.previousPoint and self.drawing) or self.drawingLine:
+            self.inputBatch.add(self.canvasPosition(event))
 
+    def processMoves(self, positions):
+        # Draw all moves of one frame in one go, with one repaint
         if self.previousPoint and self.drawing:
-            painter = QPainter(self.canvas)
-            painter.setPen(self.pen)
-            painter.drawLine(self.previousPoint.x(),
-                             self.previousPoint.y(), position.x(), position.y())
-            self.previousPoint = position
-            painter.end()
-            self.dirty = True
-            self.updateWindowTitle()
+            rect = self.canvas.draw_lines(self.pen, [self.previousPoint] + positions)
+            self.strokeRect = self.strokeRect.united(rect)
+            self.previousPoint = positions[-1]
+            self.canvasChanged(rect)
+            self.markDirty()
         elif self.drawingLine:
-            if self.tempCanvas:
-                self.canvas = self.tempCanvas.copy()
-            else:
-                self.tempCanvas = self.canvas.copy()
-            tempPainter = QPainter(self.canvas)
-            tempPainter.setPen(self.pen)
-            tempPainter.drawLine(self.lineStart, position)
-            tempPainter.end()
-            self.update()
-
-        self.label.setPixmap(self.canvas)
+            # The line is only previewed on top of the canvas until the button is released
+            self.view.setPreviewLine(QLine(self.lineStart, positions[-1]), self.pen)
 
     def mouseReleaseEvent(self, event):
-        # Handle mouse release events
+        # Handle mouse release events, after the moves still queued
+        self.inputBatch.flush()
         if self.drawingLine:
-            position = event.pos()
-            position.setY(position.y() - 20)
+            position = self.canvasPosition(event)
 
-            painter = QPainter(self.canvas)
-            painter.setPen(self.pen)
-            painter.drawLine(self.lineStart, position)
-            painter.end()
-            self.label.setPixmap(self.canvas)
-            self.tempCanvas = None
+            self.view.setPreviewLine(None)
+            rect = self.canvas.draw_line(self.pen, self.lineStart, position)
+            self.canvasChanged(rect)
+            self.history.record(self.canvas, rect)
+            self.markDirty()
+        elif self.drawing and not self.strokeRect.isEmpty():
+            self.history.record(self.canvas, self.strokeRect)
 
         self.drawing = False
         self.drawingLine = False
@@ -251,7 +334,8 @@ class MainWindow(QMainWindow):
 
 
 # Create and run the application
-app = QApplication([])
-window = MainWindow()
-window.show()
-app.exec()
\ No newline at end of file
+if __name__ == '__main__':
+    app = QApplication([])
+    window = MainWindow()
+    window.show()
+    app.exec()
\ No newline at end of file
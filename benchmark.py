@@ -0,0 +1,488 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import random
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtGui import QGuiApplication, QImage, QPainter, QPen, QColor
+from PyQt6.QtCore import Qt, QPoint, QRect, QT_VERSION_STR, PYQT_VERSION_STR
+
+from geometry import segment_rect
+from spatial_index import SpatialGrid
+from stroke_store import StrokeStore
+import draw_format
+from draw_format import (read_text_drawing, write_text_drawing, read_binary_drawing, write_binary_drawing,
+                         append_binary_drawing, decode_text_rows)
+
+COLORS = [QColor(Qt.GlobalColor.black), QColor(Qt.GlobalColor.red), QColor(Qt.GlobalColor.green), QColor(Qt.GlobalColor.blue)]
+WIDTHS = [1, 3, 5, 10]
+## Segments per 800x600 screen worth of area, so bigger drawings cover more area instead of piling up ink
+SEGMENTS_PER_SCREEN = 5000
+## How synthetic strokes are laid out:
+##   walk       random-walk freehand strokes of 5-50 segments spread evenly, like sketching
+##   uniform    single straight segments of up to 40 px anywhere, like the line tool
+##   clustered  random-walk strokes bunched around a few centres, so some areas are far denser than others
+DISTRIBUTIONS = ("walk", "uniform", "clustered")
+## Every benchmark appends its measurements here as flat dicts, for --json
+RESULTS = []
+
+
+def record(benchmark, **values):
+    RESULTS.append(dict(benchmark=benchmark, **values))
+
+
+def world_rect(count):
+    scale = max(1.0, (count / SEGMENTS_PER_SCREEN) ** 0.5)
+    return QRect(0, 0, int(800 * scale), int(600 * scale))
+
+
+## Synthetic strokes as (start, end, color, width) segments over world_rect(count), laid out by distribution
+def synthetic_segments(count, seed=1, distribution="walk"):
+    rng = random.Random(seed)
+    world = world_rect(count)
+    centres = [(rng.randrange(world.width()), rng.randrange(world.height())) for _ in range(8)]
+    spread = min(world.width(), world.height()) / 16
+    produced = 0
+    while produced < count:
+        color, width = rng.choice(COLORS), rng.choice(WIDTHS)
+        if distribution == "uniform":
+            x, y = rng.randrange(world.width()), rng.randrange(world.height())
+            nx = min(max(x + rng.randint(-40, 40), 0), world.width() - 1)
+            ny = min(max(y + rng.randint(-40, 40), 0), world.height() - 1)
+            yield QPoint(x, y), QPoint(nx, ny), color, width
+            produced += 1
+            continue
+        if distribution == "clustered":
+            cx, cy = rng.choice(centres)
+            x = min(max(int(rng.gauss(cx, spread)), 0), world.width() - 1)
+            y = min(max(int(rng.gauss(cy, spread)), 0), world.height() - 1)
+        else:
+            x, y = rng.randrange(world.width()), rng.randrange(world.height())
+        for _ in range(min(rng.randint(5, 50), count - produced)):
+            nx = min(max(x + rng.randint(-8, 8), 0), world.width() - 1)
+            ny = min(max(y + rng.randint(-8, 8), 0), world.height() - 1)
+            yield QPoint(x, y), QPoint(nx, ny), color, width
+            produced += 1
+            x, y = nx, ny
+
+
+def synthetic_lines(count, seed=1, distribution="walk"):
+    return list(synthetic_segments(count, seed, distribution)), world_rect(count)
+
+
+def synthetic_store(count, seed=1, distribution="walk"):
+    store = StrokeStore()
+    for segment in synthetic_segments(count, seed, distribution):
+        store.append_segment(*segment)
+    return store
+
+
+def draw_lines(painter, lines, indices):
+    for i in indices:
+        line = lines[i]
+        painter.setPen(QPen(line[2], line[3], Qt.PenStyle.SolidLine))
+        painter.drawLine(line[0], line[1])
+
+
+def time_call(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+## Repaint a 200x200 exposed rect (e.g. after a dialog closes) with a linear scan versus the spatial index
+def bench_spatial_index(counts=(1000, 10000, 100000, 200000), repeat=20):
+    print("segments  linear_ms  indexed_ms  drawn")
+    for count in counts:
+        lines, world = synthetic_lines(count)
+        grid = SpatialGrid()
+        for i, line in enumerate(lines):
+            grid.insert(i, segment_rect(line[0], line[1], line[3]))
+        exposed = QRect(world.center().x() - 100, world.center().y() - 100, 200, 200)
+        image = QImage(world.size(), QImage.Format.Format_ARGB32_Premultiplied)
+        painter = QPainter(image)
+        painter.setClipRect(exposed)
+
+        def linear():
+            hits = [i for i, line in enumerate(lines) if exposed.intersects(segment_rect(line[0], line[1], line[3]))]
+            draw_lines(painter, lines, hits)
+
+        def indexed():
+            draw_lines(painter, lines, grid.query(exposed))
+
+        linear_time = time_call(linear, max(1, repeat // 10))
+        indexed_time = time_call(indexed, repeat)
+        painter.end()
+        drawn = len(grid.query(exposed))
+        print(f"{count:8d}  {linear_time * 1000:9.2f}  {indexed_time * 1000:10.3f}  {drawn:5d}")
+        record("spatial", segments=count, linear_ms=linear_time * 1000, indexed_ms=indexed_time * 1000, drawn=drawn)
+
+
+## Resident set size from /proc on Linux, peak RSS from getrusage elsewhere
+def resident_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_segment_memory(layout, count):
+    app = QGuiApplication.instance() or QGuiApplication([])
+    gc.collect()
+    before = resident_bytes()
+    if layout == "tuple list":
+        ## A fresh QColor per segment, like the colour dialog and load_drawing produce
+        lines = [(start, end, QColor(color), width) for start, end, color, width in synthetic_segments(count)]
+    else:
+        lines = synthetic_store(count)
+    gc.collect()
+    return (resident_bytes() - before) / count
+
+
+## Resident memory per segment: list of (QPoint, QPoint, QColor, int) tuples versus StrokeStore.
+## Each layout is measured in a fresh process so freed memory from one run cannot hide the cost of the next.
+def bench_segment_memory(count=200000):
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    print("layout          bytes_per_segment")
+    results = {}
+    for layout in ("tuple list", "StrokeStore"):
+        with context.Pool(1) as pool:
+            results[layout] = pool.apply(_measure_segment_memory, (layout, count))
+        print(f"{layout:14s}  {results[layout]:17.1f}")
+        record("memory", layout=layout, segments=count, bytes_per_segment=results[layout])
+    print(f"reduction: {results['tuple list'] / max(results['StrokeStore'], 1e-9):.1f}x")
+
+
+## Full canvas redraw: a fresh QPen and drawLine per segment versus StrokeStore.draw's cached pens and polylines
+def bench_batched_redraw(counts=(1000, 100000), repeat=3):
+    print("segments  per_segment_ms  batched_ms  speedup")
+    for count in counts:
+        lines, world = synthetic_lines(count)
+        store = synthetic_store(count)
+        image = QImage(world.size(), QImage.Format.Format_ARGB32_Premultiplied)
+        painter = QPainter(image)
+        per_segment = time_call(lambda: draw_lines(painter, lines, range(len(lines))), repeat)
+        batched = time_call(lambda: store.draw(painter), repeat)
+        painter.end()
+        print(f"{count:8d}  {per_segment * 1000:14.1f}  {batched * 1000:10.1f}  {per_segment / batched:6.1f}x")
+        record("batching", segments=count, per_segment_ms=per_segment * 1000, batched_ms=batched * 1000)
+
+
+## Save and load throughput of the text .draw format versus the binary v3 format, and of saving a v3 file again after
+## one more stroke, which only appends
+def bench_file_format(counts=(10000, 200000)):
+    print("segments  format  save_s  load_s  size_mb  load_segments_per_s")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in counts:
+            store = synthetic_store(count)
+            for name, write, read in (("text", write_text_drawing, read_text_drawing),
+                                      ("v3", write_binary_drawing, read_binary_drawing)):
+                path = os.path.join(directory, f"{name}.draw")
+                save_time = time_call(lambda: write(path, store), 1)
+                load_time = time_call(lambda: read(path), 1)
+                size = os.path.getsize(path) / 1e6
+                print(f"{count:8d}  {name:6s}  {save_time:6.3f}  {load_time:6.3f}  {size:7.2f}  {count / load_time:19,.0f}")
+                record("format", segments=count, format=name, save_s=save_time, load_s=load_time, size_mb=size)
+            store.add_stroke([QPoint(i, i % 7) for i in range(20)], QColor("black"), 3)
+            save_time = time_call(lambda: append_binary_drawing(path, store, len(store) - 1), 1)
+            load_time = time_call(lambda: read_binary_drawing(path), 1)
+            size = os.path.getsize(path) / 1e6
+            print(f"{count:8d}  {'append':6s}  {save_time:6.3f}  {load_time:6.3f}  {size:7.2f}  {count / load_time:19,.0f}")
+            record("format", segments=count, format="append", save_s=save_time, load_s=load_time, size_mb=size)
+
+
+## Reading text .draw files line by line versus the bulk NumPy decoder, for original.py's 5-column layout and the
+## 6-column one with widths
+def bench_text_parser(counts=(100000, 1000000)):
+    if draw_format.numpy is None:
+        print("NumPy is not installed, text drawings are only read line by line")
+        return
+    print("segments  columns  lines_s  bulk_s  speedup")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in counts:
+            for columns in (5, 6):
+                path = os.path.join(directory, f"{count}_{columns}.draw")
+                with open(path, 'w') as f:
+                    for start, end, color, width in synthetic_segments(count):
+                        f.write(f"{start.x()},{start.y()},{end.x()},{end.y()},{color.name()}"
+                                + (f",{width}\n" if columns == 6 else "\n"))
+                def read_lines():
+                    with open(path, 'rb') as f:
+                        decode_text_rows(f.read())
+                lines_time = time_call(read_lines, 1)
+                bulk_time = time_call(lambda: read_text_drawing(path), 1)
+                print(f"{count:8d}  {columns:7d}  {lines_time:7.2f}  {bulk_time:6.2f}  {lines_time / bulk_time:6.1f}x")
+                record("text_parser", segments=count, columns=columns, lines_s=lines_time, bulk_s=bulk_time)
+
+
+## A big bottom layer under a small top layer: re-rendering the whole view, as a drawing without layers has to after
+## any change to stored strokes, versus hiding and showing the bottom layer and adding and undoing a stroke on top
+def bench_layers(counts=(10000, 200000), repeat=5):
+    from PyQt6.QtTest import QTest
+    print("segments  rebuild_ms  toggle_ms  top_edit_ms")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in counts:
+            path = os.path.join(directory, "drawing.draw")
+            write_binary_drawing(path, synthetic_store(count))
+            window = _app_window("drawing_program", directory)
+            window.load_drawing(path)
+            window.resize(800, 600)
+            window.show()
+            QTest.qWaitForWindowExposed(window)
+            window.new_layer()
+            bottom, top = window.layers
+            def rebuild():
+                window.rebuild_canvas()
+                window.repaint()
+            def toggle():
+                for layer in (bottom, top):
+                    window.set_active_layer(layer)
+                    window.toggle_layer_visible()
+                    window.repaint()
+            def edit():
+                window.commit_stroke([QPoint(300 + i, 300 + i % 5) for i in range(0, 100, 5)])
+                window.repaint()
+                window.undo()
+                window.repaint()
+            rebuild_time, toggle_time, edit_time = (time_call(rebuild, repeat), time_call(toggle, repeat) / 2,
+                                                    time_call(edit, repeat))
+            print(f"{count:8d}  {rebuild_time * 1000:10.2f}  {toggle_time * 1000:9.2f}  {edit_time * 1000:11.2f}")
+            record("layers", segments=count, rebuild_ms=rebuild_time * 1000, toggle_ms=toggle_time * 1000,
+                   top_edit_ms=edit_time * 1000)
+            window.dirty = False
+            window.close()
+
+
+## Select every stroke of a drawing and drag it around: picking it up, each frame of the drag and putting it down.
+## Only the pick-up and the drop should grow with the selection; a drag frame just moves one image.
+def bench_selection(counts=(10000, 50000), frames=60):
+    from PyQt6.QtTest import QTest
+    print("segments  select_ms  lift_ms  frame_ms  drop_ms  undo_ms")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in counts:
+            path = os.path.join(directory, "drawing.draw")
+            write_binary_drawing(path, synthetic_store(count))
+            window = _app_window("drawing_program", directory)
+            window.load_drawing(path)
+            window.resize(800, 600)
+            window.show()
+            QTest.qWaitForWindowExposed(window)
+            start = time.perf_counter()
+            window.select_all()
+            select_time = time.perf_counter() - start
+            anchor = window.selection_rect.center()
+            start = time.perf_counter()
+            window.start_selection_drag(anchor)
+            window.repaint()
+            lift_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for frame in range(1, frames + 1):
+                window.drag_selection(anchor + QPoint(frame, frame // 2))
+                window.repaint()
+            frame_time = (time.perf_counter() - start) / frames
+            start = time.perf_counter()
+            window.drop_selection()
+            window.repaint()
+            drop_time = time.perf_counter() - start
+            start = time.perf_counter()
+            window.undo()
+            window.repaint()
+            undo_time = time.perf_counter() - start
+            print(f"{count:8d}  {select_time * 1000:9.2f}  {lift_time * 1000:7.2f}  {frame_time * 1000:8.2f}  "
+                  f"{drop_time * 1000:7.2f}  {undo_time * 1000:7.2f}")
+            record("selection", segments=count, select_ms=select_time * 1000, lift_ms=lift_time * 1000,
+                   frame_ms=frame_time * 1000, drop_ms=drop_time * 1000, undo_ms=undo_time * 1000)
+            window.dirty = False
+            window.close()
+
+
+def peak_resident_bytes():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+## Time function() over and over until repeat runs or budget seconds are used up; returns the mean and the run count
+def time_within(function, repeat, budget):
+    start = time.perf_counter()
+    runs = 0
+    while runs < repeat and (runs == 0 or time.perf_counter() - start < budget):
+        function()
+        runs += 1
+    return (time.perf_counter() - start) / runs, runs
+
+
+def _app_window(name, directory):
+    if name == "drawing_program":
+        import drawing_program
+        ## Keep the crash-recovery journal out of the home directory
+        drawing_program.JOURNAL_PATH = os.path.join(directory, "journal")
+        return drawing_program.DrawingProgram()
+    if name == "original":
+        import original
+        return original.DrawingProgram()
+    if name == "test":
+        import test
+        return test.DrawingProgram()
+    import andrei
+    return andrei.MainWindow()
+
+
+## One application at one scale point, run in its own process: load a synthetic drawing (for andrei, an image of the
+## same area) and save it straight back, then time full repaints and freehand input latency through QTest, and report
+## the peak memory
+def _measure_app(name, count, distribution, events, budget):
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtTest import QTest
+    app = QApplication.instance() or QApplication([])
+    result = {"app": name, "segments": count, "distribution": distribution}
+    with tempfile.TemporaryDirectory() as directory:
+        store = synthetic_store(count, distribution=distribution)
+        world = world_rect(count)
+        window = _app_window(name, directory)
+        if name == "andrei":
+            path, saved = os.path.join(directory, "drawing.png"), os.path.join(directory, "saved.png")
+            image = QImage(world.size(), QImage.Format.Format_RGB32)
+            image.fill(QColor("white"))
+            painter = QPainter(image)
+            store.draw(painter)
+            painter.end()
+            image.save(path)
+            del image
+            load = lambda: window.canvas.load(path)
+            save = lambda: window.canvas.save(saved)
+            target = window.view
+        else:
+            path, saved = os.path.join(directory, "drawing.draw"), os.path.join(directory, "saved.draw")
+            (write_binary_drawing if name == "drawing_program" else write_text_drawing)(path, store)
+            load = lambda: window.load_drawing(path)
+            save = lambda: window.save_drawing_to_file(saved)
+            target = window
+            if name == "drawing_program":
+                window.set_free_draw_mode(True)
+        del store
+        gc.collect()
+        result["file_mb"] = os.path.getsize(path) / 1e6
+        result["load_s"] = time_call(load, 1)
+        result["load_segments_per_s"] = count / result["load_s"]
+        result["save_s"] = time_call(save, 1)
+        result["save_segments_per_s"] = count / result["save_s"]
+        window.resize(800, 600)
+        window.show()
+        QTest.qWaitForWindowExposed(window)
+        app.processEvents()
+
+        paint_time, result["paint_runs"] = time_within(target.repaint, 20, budget)
+        result["paint_ms"] = paint_time * 1000
+
+        rng = random.Random(2)
+        position = QPoint(400, 300)
+        QTest.mousePress(target, Qt.MouseButton.LeftButton, Qt.KeyboardModifier.NoModifier, position)
+        latencies = []
+        ## Moves are normally held until the next frame tick; flushing each one times the full handling of a move
+        batch = getattr(window, "input_batch", None) or getattr(window, "inputBatch", None)
+        started = time.perf_counter()
+        while len(latencies) < events and (not latencies or time.perf_counter() - started < budget):
+            position = QPoint(min(max(position.x() + rng.randint(-8, 8), 10), 790),
+                              min(max(position.y() + rng.randint(-8, 8), 10), 560))
+            start = time.perf_counter()
+            QTest.mouseMove(target, position)
+            if batch is not None:
+                batch.flush()
+            app.processEvents()
+            latencies.append(time.perf_counter() - start)
+        QTest.mouseRelease(target, Qt.MouseButton.LeftButton, Qt.KeyboardModifier.NoModifier, position)
+        app.processEvents()
+        latencies.sort()
+        result["input_mean_us"] = sum(latencies) / len(latencies) * 1e6
+        result["input_p95_us"] = latencies[int(len(latencies) * 0.95)] * 1e6
+        result["input_events"] = len(latencies)
+
+        result["peak_rss_mb"] = peak_resident_bytes() / 1e6
+        ## No unsaved-changes dialog on the way out
+        window.dirty = False
+        window.hide()
+    return result
+
+
+## Load, full repaint, per-event input latency, save and peak memory of every drawing app at each scale point.
+## Each (app, scale) pair runs in a fresh process so its peak memory is its own.
+def bench_apps(counts=(1000, 100000, 1000000), distribution="walk", events=200, budget=10.0,
+               apps=("drawing_program", "original", "test", "andrei")):
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    print("app               segments  load_s  paint_ms  input_us  input_p95_us  save_s  peak_mb")
+    for name in apps:
+        for count in counts:
+            with context.Pool(1) as pool:
+                result = pool.apply(_measure_app, (name, count, distribution, events, budget))
+            print(f"{name:16s}  {count:8d}  {result['load_s']:6.2f}  {result['paint_ms']:8.2f}  "
+                  f"{result['input_mean_us']:8.0f}  {result['input_p95_us']:12.0f}  {result['save_s']:6.2f}  "
+                  f"{result['peak_rss_mb']:7.0f}")
+            record("apps", **result)
+
+
+BENCHMARKS = {
+    "spatial": bench_spatial_index,
+    "memory": bench_segment_memory,
+    "batching": bench_batched_redraw,
+    "format": bench_file_format,
+    "text": bench_text_parser,
+    "layers": bench_layers,
+    "selection": bench_selection,
+    "apps": bench_apps,
+}
+
+
+## Commit the benchmark ran against, so saved results can be matched to builds
+def source_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drawing app benchmarks, run under the offscreen Qt platform.")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--json", metavar="FILE", help="also write every measurement to FILE as JSON")
+    parser.add_argument("--scales", default="1000,100000,1000000",
+                        help="comma separated segment counts for the apps benchmark (default: 1000,100000,1000000)")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="walk",
+                        help="synthetic stroke layout for the apps benchmark (default: walk)")
+    parser.add_argument("--events", type=int, default=200, help="mouse moves per input latency run (default: 200)")
+    parser.add_argument("--budget", type=float, default=10.0,
+                        help="seconds after which a repaint or input run stops early (default: 10)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+    from PyQt6.QtWidgets import QApplication
+    app = QApplication(sys.argv[:1])
+    for name in args.names or BENCHMARKS:
+        print(f"## {name}")
+        if name == "apps":
+            bench_apps(tuple(int(count) for count in args.scales.split(",")), args.distribution, args.events, args.budget)
+        else:
+            BENCHMARKS[name]()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"revision": source_revision(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                       "python": platform.python_version(), "qt": QT_VERSION_STR, "pyqt": PYQT_VERSION_STR,
+                       "platform": platform.platform(), "results": RESULTS}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import warnings
+import zlib
+from array import array
+
+from PyQt6.QtCore import Qt, QPoint
+from PyQt6.QtGui import QColor
+
+from stroke_store import StrokeStore
+
+try:
+    import numpy
+except ImportError:
+    ## Text drawings then go through the line-by-line decoder only
+    numpy = None
+
+## .draw v3 layout, all little-endian:
+##   header   magic b"DRAW", uint16 version, uint16 layer count, uint32 palette count, uint32 palette capacity
+##   palette  capacity x uint32 ARGB, unused slots zero
+##   layers   one 64-byte entry per layer, bottom first: uint32 first record, uint32 flags, 56-byte UTF-8 name
+##   records  one 12-byte record per point: int32 x, int32 y, uint32 meta
+## meta packs the stroke style: bits 0-14 width, bit 15 set on the first point of a stroke, bits 16-31 palette index.
+## A layer's records run from its first record up to the next layer's; the palette is shared by all layers. The
+## palette has spare capacity and the top layer's records come last, so strokes added to the top layer can later be
+## appended without moving anything.
+## v2 files have the same layout without the layer table (the layer count field is zero) and hold a single layer.
+MAGIC = b"DRAW"
+VERSION = 3
+HEADER = struct.Struct("<4sHHII")
+LAYER = struct.Struct("<II56s")
+LAYER_HIDDEN = 0x1
+RECORD_SIZE = 12
+STROKE_START = 0x8000
+WIDTH_MASK = 0x7FFF
+MIN_PALETTE_CAPACITY = 256
+## Name of the one layer of a drawing saved without layers
+FIRST_LAYER_NAME = "Layer 1"
+## Text format: typical bytes per line, used to turn line counts into read sizes, and lines decoded at a time
+TEXT_LINE_SIZE = 24
+TEXT_BLOCK_LINES = 262144
+
+
+def palette_capacity(count):
+    capacity = MIN_PALETTE_CAPACITY
+    while capacity < count:
+        capacity *= 2
+    return capacity
+
+
+def is_binary_drawing(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+## Load a .draw file of any supported kind as a list of (name, visible, StrokeStore) layers, bottom first
+def read_drawing_layers(file_path):
+    if is_binary_drawing(file_path):
+        return read_binary_layers(file_path)
+    return [(FIRST_LAYER_NAME, True, read_text_drawing(file_path))]
+
+
+## Load a .draw file of any supported kind into a single StrokeStore holding what it shows: its visible layers
+def read_drawing(file_path):
+    return flatten_layers(read_drawing_layers(file_path))
+
+
+## The visible layers merged into one store, bottom first. A drawing with a single visible layer comes back as it is.
+def flatten_layers(layers):
+    stores = [store for _, visible, store in layers if visible]
+    if len(stores) == 1:
+        return stores[0]
+    flat = StrokeStore()
+    for store in stores:
+        flat.append_store(store)
+    return flat
+
+
+## Layers to write: a plain StrokeStore is a drawing with one visible layer
+def as_layers(drawing):
+    if isinstance(drawing, StrokeStore):
+        return [(FIRST_LAYER_NAME, True, drawing)]
+    return drawing
+
+
+## Text format: one "x1,y1,x2,y2,color,width" segment per line. Files from original.py have no width column and get
+## the widths that program draws with (12 for the eraser, 3 otherwise). Read in blocks to bound the decoder's memory.
+def read_text_drawing(file_path):
+    store = StrokeStore()
+    for _, chunk, _, _ in iter_text_chunks(file_path, TEXT_BLOCK_LINES, TEXT_BLOCK_LINES):
+        store.append_store(chunk)
+    return store
+
+
+## Decode a block of text-format lines. Returns the store and the offset in data of the line that starts its last
+## stroke, which the next block may still continue.
+def decode_text(data):
+    if numpy is not None:
+        decoded = decode_text_columns(data)
+        if decoded is not None:
+            return decoded
+    return decode_text_rows(data)
+
+
+## Reference decoder, one line at a time through append_segment; copes with blank, short and mixed lines. Values the
+## store cannot hold (coordinates beyond int32, widths beyond uint16) raise ValueError like malformed numbers do.
+def decode_text_rows(data):
+    store = StrokeStore()
+    white = QColor(Qt.GlobalColor.white)
+    offset = last_start = 0
+    for line in data.splitlines(keepends=True):
+        parts = line.decode().strip().split(',')
+        if len(parts) >= 5:
+            color = QColor(parts[4])
+            width = int(parts[5]) if len(parts) > 5 else (12 if color == white else 3)
+            x0, y0, x1, y1 = map(int, parts[:4])
+            if not all(-2 ** 31 <= value < 2 ** 31 for value in (x0, y0, x1, y1)):
+                raise ValueError(f"coordinate out of range in line {line!r}")
+            if not 0 <= width <= 0xFFFF:
+                raise ValueError(f"pen width out of range in line {line!r}")
+            strokes = len(store)
+            store.append_segment(QPoint(x0, y0), QPoint(x1, y1), color, width)
+            if len(store) > strokes:
+                last_start = offset
+        offset += len(line)
+    return store, last_start
+
+
+## Bulk decoder for uniform 5- or 6-column blocks. Field boundaries and stroke joins are worked out with array
+## operations over the raw bytes, the integers are parsed by NumPy's C text reader once the colour column has been
+## blanked out, and each distinct colour spelling becomes a QColor once. Returns None for anything decode_text_rows
+## might read differently (blank or ragged lines, malformed numbers, out-of-range values), which then goes through it.
+def decode_text_columns(data):
+    size = len(data.rstrip(b"\r\n"))
+    if not size:
+        return None
+    buf = numpy.frombuffer(data, numpy.uint8, size).copy()
+    newline = buf == 10
+    line_ends = numpy.flatnonzero(newline)
+    ends = numpy.append(numpy.flatnonzero(newline | (buf == 44)), size)
+    lines = len(line_ends) + 1
+    if len(ends) % lines or len(ends) // lines not in (5, 6):
+        return None
+    columns = len(ends) // lines
+    ## Every line has to end right after its last column
+    if not numpy.array_equal(ends[columns - 1:-1:columns], line_ends):
+        return None
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    ## Only CRLF line ends may carry a \r
+    carriage = numpy.flatnonzero(buf == 13)
+    if len(carriage) and (carriage[-1] + 1 >= size or not newline[carriage + 1].all()):
+        return None
+    lengths = ends - starts
+    ## Colours: the spellings padded into fixed-width byte strings, so numpy.unique can group them
+    color_starts, color_lengths = starts[4::columns], lengths[4::columns]
+    width = int(color_lengths.max())
+    if not 0 < width <= 64:
+        return None
+    offsets = numpy.arange(width)
+    spelled = buf[numpy.minimum(color_starts[:, None] + offsets, size - 1)]
+    spelled[offsets >= color_lengths[:, None]] = 0
+    names, spelling = numpy.unique(spelled.view(f"S{width}").ravel(), return_inverse=True)
+
+    ## Integers: with the colours turned into zeros and the lines joined, the block is one long comma separated list
+    for offset in range(width):
+        inside = color_lengths > offset
+        buf[color_starts[inside] + offset] = 48
+    buf[carriage] = 32
+    buf[line_ends] = 44
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            values = numpy.fromstring(buf.tobytes(), numpy.int64, sep=",")
+    except (ValueError, DeprecationWarning):
+        return None
+    if len(values) != len(ends):
+        return None
+    values = values.reshape(lines, columns)
+    coordinates = values[:, :4]
+    if coordinates.min() < -2 ** 31 or coordinates.max() >= 2 ** 31:
+        return None
+
+    store = StrokeStore()
+    white = QColor(Qt.GlobalColor.white)
+    colors = [QColor(name.decode().strip()) for name in names]
+    slots = numpy.array([store.color_index(color) for color in colors], numpy.uint16)[spelling]
+    if columns == 6:
+        widths = values[:, 5]
+        if widths.min() < 0 or widths.max() > 0xFFFF:
+            return None
+    else:
+        widths = numpy.array([12 if color == white else 3 for color in colors])[spelling]
+
+    ## A segment continues the previous stroke when it starts where that ended in the same colour and width
+    joins = numpy.zeros(lines, bool)
+    joins[1:] = ((coordinates[1:, 0] == coordinates[:-1, 2]) & (coordinates[1:, 1] == coordinates[:-1, 3])
+                 & (slots[1:] == slots[:-1]) & (widths[1:] == widths[:-1]))
+    first = ~joins
+    end_points = numpy.arange(lines) + numpy.cumsum(first)
+    points = numpy.empty((lines + int(first.sum()), 2), numpy.int32)
+    points[end_points] = coordinates[:, 2:]
+    points[end_points[first] - 1] = coordinates[first, :2]
+    store.set_columns(array('i', points.tobytes()), array('I', (end_points[first] - 1).astype(numpy.uint32).tobytes()),
+                      array('H', slots[first].tobytes()), array('H', widths[first].astype(numpy.uint16).tobytes()),
+                      store.palette)
+    line_starts = starts[0::columns]
+    return store, int(line_starts[numpy.flatnonzero(first)[-1]])
+
+
+## Erased segments are never written; see StrokeStore.compacted()
+def write_text_drawing(file_path, store):
+    store = store.compacted()
+    with open(file_path, 'w') as f:
+        for start, end, color, width in store.segments():
+            f.write(f"{start.x()},{start.y()},{end.x()},{end.y()},{color.name()},{width}\n")
+
+
+## Records for a range of strokes as one int32 array (x, y, meta per point), ready to be written out. remap, when
+## given, translates the store's palette indexes into the file's.
+def encode_records(store, first_stroke=0, remap=None):
+    metas = array('I')
+    for i in range(first_stroke, len(store)):
+        begin, end = store.stroke_range(i)
+        color = store.colors[i] if remap is None else remap[store.colors[i]]
+        meta = color << 16 | (store.widths[i] & WIDTH_MASK)
+        metas.append(meta | STROKE_START)
+        metas.extend(array('I', [meta]) * (end - begin - 1))
+    begin = store.starts[first_stroke] if first_stroke < len(store) else store.point_count()
+    points = store.points[2 * begin:]
+    records = array('i', bytes(RECORD_SIZE * len(metas)))
+    records[0::3] = points[0::2]
+    records[1::3] = points[1::2]
+    records[2::3] = array('i', metas.tobytes())
+    if sys.byteorder == 'big':
+        records.byteswap()
+    return records
+
+
+def encode_palette(palette, capacity):
+    colors = array('I', [color.rgba() for color in palette])
+    colors.extend(array('I', [0]) * (capacity - len(palette)))
+    if sys.byteorder == 'big':
+        colors.byteswap()
+    return colors.tobytes()
+
+
+def encode_layer(name, visible, first_record):
+    return LAYER.pack(first_record, 0 if visible else LAYER_HIDDEN, name.encode()[:LAYER.size - 8])
+
+
+## Write a StrokeStore, or a list of (name, visible, StrokeStore) layers bottom first. Several layers are merged into
+## one store first so they share one palette.
+def write_binary_drawing(file_path, drawing):
+    layers = as_layers(drawing)
+    if len(layers) == 1:
+        store, firsts = layers[0][2].compacted(), [0]
+    else:
+        store, firsts = StrokeStore(), []
+        for _, _, layer in layers:
+            firsts.append(store.point_count())
+            store.append_store(layer.compacted())
+    capacity = palette_capacity(len(store.palette))
+    with open(file_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(layers), len(store.palette), capacity))
+        f.write(encode_palette(store.palette, capacity))
+        f.write(b"".join(encode_layer(name, visible, first) for (name, visible, _), first in zip(layers, firsts)))
+        f.write(encode_records(store).tobytes())
+
+
+## Write to a temporary file next to the target, flush it to disk and rename it into place, so a crash mid-save
+## leaves the existing file untouched. Takes a StrokeStore or layers like write_binary_drawing.
+def save_drawing_atomically(file_path, drawing):
+    directory = os.path.dirname(os.path.abspath(file_path))
+    handle, temp_path = tempfile.mkstemp(prefix=".", suffix=".draw.tmp", dir=directory)
+    os.close(handle)
+    try:
+        write_binary_drawing(temp_path, drawing)
+        with open(temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_path)
+        else:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+## Append strokes first_stroke onwards of store to the top layer of the v3 file at file_path, which must hold store's
+## strokes before first_stroke as written by write_binary_drawing. Colours the file does not have yet go into the
+## palette's spare slots. Raises ValueError when the file cannot take the append (other format, palette full, torn
+## records), in which case it is left as it was and the drawing has to be rewritten. Unlike save_drawing_atomically
+## this writes in place: a failed write is truncated away, but a crash half way can leave a torn last stroke.
+def append_binary_drawing(file_path, store, first_stroke):
+    with open(file_path, 'r+b') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{file_path}: not a version {VERSION} drawing")
+        magic, version, layer_count, count, capacity = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or not layer_count:
+            raise ValueError(f"{file_path}: not a version {VERSION} drawing")
+        lookup = {rgba: i for i, rgba in enumerate(decode_palette(f.read(4 * count)))}
+        added, remap = [], []
+        for color in store.palette:
+            i = lookup.get(color.rgba())
+            if i is None:
+                i = lookup[color.rgba()] = count + len(added)
+                added.append(color)
+            remap.append(i)
+        if count + len(added) > capacity:
+            raise ValueError(f"{file_path}: palette does not fit")
+        records = encode_records(store, first_stroke, remap).tobytes()
+        end = f.seek(0, 2)
+        if (end - HEADER.size - 4 * capacity - LAYER.size * layer_count) % RECORD_SIZE:
+            raise ValueError(f"{file_path}: torn records at the end")
+        try:
+            ## Palette first: spare colours are harmless, records pointing past the palette are not
+            if added:
+                f.seek(HEADER.size + 4 * count)
+                f.write(encode_palette(added, len(added)))
+                f.seek(0)
+                f.write(HEADER.pack(MAGIC, VERSION, layer_count, count + len(added), capacity))
+            f.seek(end)
+            f.write(records)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.truncate(end)
+            raise
+
+
+## Size, modification time and a CRC of the last 4 KiB of a file: cheap to take, and enough to tell whether a file is
+## still the one this program wrote
+def file_signature(file_path):
+    with open(file_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        f.seek(max(stat.st_size - 4096, 0))
+        return stat.st_size, stat.st_mtime_ns, zlib.crc32(f.read())
+
+
+def decode_palette(data):
+    colors = array('I', data)
+    if sys.byteorder == 'big':
+        colors.byteswap()
+    return colors
+
+
+## Check the header of a mapped v2 or v3 file. Returns its palette, its layers as (name, visible, first record,
+## end record) and the offset of the first record. Raises ValueError for anything it cannot read, truncated files
+## included.
+def read_header(mapped, file_path):
+    if len(mapped) < HEADER.size:
+        raise ValueError(f"{file_path}: truncated header")
+    magic, version, layer_count, count, capacity = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version not in (2, VERSION):
+        raise ValueError(f"{file_path}: unsupported drawing format version {version}")
+    if count > capacity:
+        raise ValueError(f"{file_path}: palette count exceeds its capacity")
+    offset = HEADER.size + 4 * capacity
+    if version == VERSION:
+        if not layer_count:
+            raise ValueError(f"{file_path}: drawing has no layers")
+        if len(mapped) < offset + LAYER.size * layer_count:
+            raise ValueError(f"{file_path}: truncated palette or layer table")
+    elif len(mapped) < offset:
+        raise ValueError(f"{file_path}: truncated palette")
+    palette = [QColor.fromRgba(rgba) for rgba in decode_palette(mapped[HEADER.size:HEADER.size + 4 * count])]
+    if version == 2:
+        return palette, [(FIRST_LAYER_NAME, True, 0, (len(mapped) - offset) // RECORD_SIZE)], offset
+    table = [LAYER.unpack_from(mapped, offset + LAYER.size * k) for k in range(layer_count)]
+    offset += LAYER.size * layer_count
+    total = (len(mapped) - offset) // RECORD_SIZE
+    firsts = [first for first, _, _ in table] + [total]
+    if firsts[0] != 0 or any(a > b for a, b in zip(firsts, firsts[1:])):
+        raise ValueError(f"{file_path}: layer table does not match the records")
+    layers = [(name.rstrip(b"\0").decode(errors="ignore"), not flags & LAYER_HIDDEN, first, end)
+              for (first, flags, name), end in zip(table, firsts[1:])]
+    return palette, layers, offset
+
+
+## Turn raw little-endian records into a StrokeStore. Coordinates are copied out column-wise with strided slices;
+## only the per-stroke fields need a Python-level pass.
+def decode_records(data, palette, file_path):
+    records = array('i', data)
+    if sys.byteorder == 'big':
+        records.byteswap()
+    points = array('i', bytes(8 * (len(records) // 3)))
+    points[0::2] = records[0::3]
+    points[1::2] = records[1::3]
+    metas = array('I', records[2::3].tobytes())
+    if metas and not metas[0] & STROKE_START:
+        raise ValueError(f"{file_path}: records do not start with a stroke")
+    starts = array('I', [i for i, meta in enumerate(metas) if meta & STROKE_START])
+    colors = array('H', [metas[i] >> 16 for i in starts])
+    if colors and max(colors) >= len(palette):
+        raise ValueError(f"{file_path}: records use colours missing from the palette")
+    store = StrokeStore()
+    store.set_columns(points, starts, colors, array('H', [metas[i] & WIDTH_MASK for i in starts]), palette)
+    return store
+
+
+## Map the file and decode the records of every layer in bulk; returns (name, visible, StrokeStore) layers
+def read_binary_layers(file_path):
+    with open(file_path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            return [(FIRST_LAYER_NAME, True, StrokeStore())]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            palette, layers, offset = read_header(mapped, file_path)
+            return [(name, visible, decode_records(mapped[offset + RECORD_SIZE * first:offset + RECORD_SIZE * end],
+                                                   palette, file_path))
+                    for name, visible, first, end in layers]
+
+
+def read_binary_drawing(file_path):
+    return flatten_layers(read_binary_layers(file_path))
+
+
+## Names and visibility of a drawing's layers, bottom first, without decoding any strokes
+def read_layer_table(file_path):
+    if not is_binary_drawing(file_path):
+        return [(FIRST_LAYER_NAME, True)]
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        _, layers, _ = read_header(mapped, file_path)
+    return [(name, visible) for name, visible, _, _ in layers]
+
+
+## Decode a drawing piece by piece, yielding (layer position, chunk store, bytes done, total bytes) with layers in
+## the order of read_layer_table. Chunks always end on a stroke boundary and never span layers; they start small,
+## doubling up to max_chunk points or lines, so the first strokes can be shown right away.
+def iter_drawing_chunks(file_path, first_chunk=4096, max_chunk=262144):
+    if is_binary_drawing(file_path):
+        return iter_binary_chunks(file_path, first_chunk, max_chunk)
+    return iter_text_chunks(file_path, first_chunk, max_chunk)
+
+
+def iter_binary_chunks(file_path, first_chunk, max_chunk):
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        palette, layers, offset = read_header(mapped, file_path)
+        chunk = first_chunk
+        for layer, (_, _, position, total) in enumerate(layers):
+            while position < total:
+                end = min(position + chunk, total)
+                ## Push the end forward to the next stroke start so no stroke is split between chunks
+                while end < total and not struct.unpack_from("<I", mapped, offset + RECORD_SIZE * end + 8)[0] & STROKE_START:
+                    end += 1
+                data = mapped[offset + RECORD_SIZE * position:offset + RECORD_SIZE * end]
+                yield layer, decode_records(data, palette, file_path), offset + RECORD_SIZE * end, len(mapped)
+                position, chunk = end, min(chunk * 2, max_chunk)
+
+
+## Text chunks are read as blocks of about chunk lines and decoded in one go each
+def iter_text_chunks(file_path, first_chunk, max_chunk):
+    total = os.path.getsize(file_path)
+    chunk = first_chunk
+    carried = b""
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(TEXT_LINE_SIZE * chunk)
+            if not block:
+                break
+            data = carried + block + f.readline()
+            store, last_start = decode_text(data)
+            if len(store) > 1:
+                ## The newest stroke may still continue on the next line, so its lines go round again with the next block
+                store.remove_last_stroke()
+                carried = data[last_start:]
+                yield 0, store, f.tell(), total
+                chunk = min(chunk * 2, max_chunk)
+            else:
+                carried = data
+    yield 0, decode_text(carried)[0], total, total
@@ -1,25 +1,192 @@
 import sys
 import os
-from PyQt6.QtWidgets import QApplication, QMainWindow, QFileDialog, QMessageBox, QWidget, QVBoxLayout, QToolBar, QColorDialog, QMenu, QToolButton
-from PyQt6.QtGui import QPainter, QPen, QColor, QAction
-from PyQt6.QtCore import Qt, QPoint
+import time
+from PyQt6.QtWidgets import QApplication, QMainWindow, QFileDialog, QMessageBox, QWidget, QVBoxLayout, QToolBar, QColorDialog, QMenu, QToolButton, QProgressBar, QPushButton, QInputDialog
+from PyQt6.QtGui import QPainter, QPen, QColor, QAction, QActionGroup, QFontDatabase, QImage, QPolygon
+from PyQt6.QtCore import Qt, QPoint, QPointF, QRect, QRectF, QSize, QObject, QThread, QTimer, pyqtSignal
+from geometry import segment_rect
+from draw_format import (read_drawing_layers, read_layer_table, save_drawing_atomically, append_binary_drawing,
+                         file_signature, is_binary_drawing, iter_drawing_chunks, FIRST_LAYER_NAME)
+from journal import claim_journal, read_journal
+from undo import UndoStack, AddStrokeCommand, EraseCommand, MoveCommand
+from instrumentation import Instrumentation
+from overview_cache import OverviewCache
+from input_batch import InputBatch
+from layers import Layer
+from selection import strokes_in_rect, strokes_in_polygon, strokes_rect, erased_entirely
+
+## Zoom range of the view, as window pixels per drawing unit
+MIN_ZOOM = 1 / 64
+MAX_ZOOM = 16
+
+## Edits not yet saved are journaled to JOURNAL_PATH.<n>, one journal per running window, and replayed by the next
+## window to start if the program did not exit cleanly
+JOURNAL_PATH = os.path.join(os.path.expanduser("~"), ".drawing_program.journal")
+
+## Parses a drawing on a worker thread and hands it to the GUI chunk by chunk, after the (name, visible) table of its
+## layers; each chunk comes with the position of the layer it belongs to
+class DrawingLoader(QObject):
+    layers_found = pyqtSignal(list)
+    chunk_loaded = pyqtSignal(int, object)
+    progress = pyqtSignal(int)
+    finished = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, file_path):
+        super().__init__()
+        self.file_path = file_path
+        self.cancelled = False
+
+    def run(self):
+        try:
+            self.layers_found.emit(read_layer_table(self.file_path))
+            for layer, chunk, done, total in iter_drawing_chunks(self.file_path):
+                if self.cancelled:
+                    return
+                self.chunk_loaded.emit(layer, chunk)
+                self.progress.emit(100 * done // max(total, 1))
+        except (OSError, ValueError) as error:
+            self.failed.emit(str(error))
+            return
+        ## Anything else a damaged file trips the parsers over must still end the load, not the program
+        except Exception as error:
+            self.failed.emit(f"{self.file_path}: {type(error).__name__}: {error}")
+            return
+        self.finished.emit()
+
+## Serializes a snapshot of a drawing's layers on a worker thread, replacing the target file atomically. With
+## append_from the file already holds everything up to that stroke of the top layer and only the rest is appended,
+## unless the file turns out not to allow it.
+class DrawingSaver(QObject):
+    finished = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, file_path, snapshot, append_from=None):
+        super().__init__()
+        self.file_path = file_path
+        self.snapshot = snapshot
+        self.append_from = append_from
+
+    def run(self):
+        try:
+            write_drawing(self.file_path, self.snapshot, self.append_from)
+        except OSError as error:
+            self.failed.emit(str(error))
+        else:
+            self.finished.emit()
+        finally:
+            ## One save per thread; ending the loop here lets wait_for_saves() join it without the GUI event loop
+            self.thread().quit()
+
+## Save (name, visible, store) layers to file_path, appending the top layer's strokes from append_from when given and
+## possible, rewriting the file otherwise
+def write_drawing(file_path, layers, append_from=None):
+    if append_from is not None:
+        try:
+            append_binary_drawing(file_path, layers[-1][2], append_from)
+            return
+        except ValueError:
+            pass
+    save_drawing_atomically(file_path, layers)
 
 class DrawingProgram(QMainWindow):
     ## Initialize the drawing application's state, including UI, drawing settings, and temporary file management.
     def __init__(self):
         super().__init__()
         self.initUI()
-        self.lines = []
+        ## Layers bottom first; drawing, erasing and undo act on the active one
+        self.layers = [Layer(FIRST_LAYER_NAME)]
+        self.layer = self.layers[0]
+        ## View transform: window = (world - view_origin) * zoom. Each layer's image caches the view at view_size,
+        ## which can be bigger than the window after it shrank, not the drawing.
+        self.zoom = 1.0
+        self.view_origin = QPointF(0, 0)
+        self.view_size = QSize()
+        ## Zoomed-out views fill in missing overview tiles over several passes
+        self.overview_timer = QTimer(self)
+        self.overview_timer.setSingleShot(True)
+        self.overview_timer.timeout.connect(self.rebuild_canvas)
+        self.panning = False
+        self.pan_anchor = QPoint()
+        ## Mouse moves are queued and handled once per display frame, at the screen's refresh rate unless
+        ## DRAWING_PROGRAM_FRAME_RATE or input_batch.set_frame_rate() says otherwise
+        self.input_batch = InputBatch(self, self.process_moves, float(os.environ.get("DRAWING_PROGRAM_FRAME_RATE", 0)))
+        ## Frame, input, load and save timings; off unless the debug HUD is shown or DRAWING_PROGRAM_INSTRUMENT is set
+        self.instrument_always = bool(os.environ.get("DRAWING_PROGRAM_INSTRUMENT"))
+        self.instruments = Instrumentation(enabled=self.instrument_always)
+        ## Time of the first mouse move not painted yet, and start times of the running load and save
+        self.input_time = None
+        self.load_started = 0.0
+        self.save_started = 0.0
+        self.hud_visible = False
+        self.hud_text = ""
+        self.hud_timer = QTimer(self)
+        self.hud_timer.setInterval(500)
+        self.hud_timer.timeout.connect(self.refresh_hud)
         self.current_color = Qt.GlobalColor.black
         self.current_width = 3
         self.dirty = False
+        ## Bumped on every edit, so a finished background save can tell whether the drawing changed meanwhile
+        self.revision = 0
         self.temp_file_path = None
+        ## Background save in progress: the worker, the store and revision it snapshotted, and a save queued behind it
+        self.saver = None
+        self.saver_thread = None
+        self.saving_source = None
+        self.saving_revision = 0
+        self.pending_save = None
+        self.saving_layout = None
+        ## (path, layout, signature) of the file known to hold the drawing as it stood in layout (see layer_layout)
+        ## unchanged, from the last save or load; lets the next save append only what was added to the top layer since
+        self.saved_file = None
+        ## Background load in progress, and what to go back to if it is cancelled
+        self.loader = None
+        self.loader_thread = None
+        self.previous_drawing = None
+        ## Undo/redo command log, capped by memory
+        self.history = UndoStack()
+        ## Crash-recovery journal, appended to in small batches by a timer
+        self.journal = claim_journal(JOURNAL_PATH)
+        self.saving_journal_mark = 0
+        self.journal_timer = QTimer(self)
+        self.journal_timer.setInterval(1000)
+        self.journal_timer.timeout.connect(self.journal.flush)
+        self.journal_timer.start()
         self.setStyleSheet("QMainWindow { background-color:white; }")
+        self.rebuild_canvas()
         self.load_temp_drawing()
         self.__leftMouseButtonDown = False
         self.__startPosition = QPoint()
         self.__endPosition = QPoint()
         self.free_draw_mode = False
+        ## Eraser drag in progress and the (stroke, segment, t0, t1) cuts it has made so far
+        self.erasing = False
+        self.erase_cuts = []
+        ## Index of the freehand stroke being drawn, None between strokes
+        self.live_stroke = None
+        self.stroke_samples = 0
+        self.stroke_rect = QRect()
+        ## Ramer-Douglas-Peucker tolerance in pixels applied when a freehand stroke is released, 0 keeps every sample
+        self.simplify_tolerance = 1.0
+        ## Running totals of freehand segments received from the mouse and actually stored after simplification
+        self.simplify_stats = {"segments_in": 0, "segments_out": 0}
+        ## Repaint only the region touched by the current segment instead of the whole window
+        self.partial_updates = True
+        ## What the left button does: "draw" (pen, or eraser by colour), or select strokes of the active layer with a
+        ## "rectangle" or a "lasso"
+        self.tool = "draw"
+        ## Selected strokes of the active layer and their bounding rectangle, in drawing coordinates
+        self.selection = []
+        self.selection_rect = QRect()
+        ## Region being dragged out by the selection tool, in drawing coordinates; None when not selecting
+        self.select_path = None
+        ## Selection being dragged: where the drag started and how far it got (drawing units), and the selected strokes
+        ## rendered once at the start into an image that follows the mouse, placed at floating_rect (window coordinates)
+        self.moving = False
+        self.move_anchor = QPoint()
+        self.move_offset = QPoint()
+        self.floating = None
+        self.floating_rect = QRect()
 
     def initUI(self):
     ## Window setup
@@ -56,6 +223,34 @@ class DrawingProgram(QMainWindow):
         save_action.setShortcut("Ctrl+S")
         save_action.triggered.connect(self.save_drawing)
         window_actions_menu.addAction(save_action)
+        undo_action = QAction("Undo", self)
+        undo_action.setShortcut("Ctrl+Z")
+        undo_action.triggered.connect(self.undo)
+        window_actions_menu.addAction(undo_action)
+        redo_action = QAction("Redo", self)
+        redo_action.setShortcuts(["Ctrl+Y", "Ctrl+Shift+Z"])
+        redo_action.triggered.connect(self.redo)
+        window_actions_menu.addAction(redo_action)
+        hud_action = QAction("Debug HUD", self)
+        hud_action.setShortcut("F12")
+        hud_action.setCheckable(True)
+        hud_action.toggled.connect(self.set_hud_visible)
+        window_actions_menu.addAction(hud_action)
+        export_timings_action = QAction("Export Timings...", self)
+        export_timings_action.triggered.connect(self.export_timings)
+        window_actions_menu.addAction(export_timings_action)
+        zoom_in_action = QAction("Zoom In", self)
+        zoom_in_action.setShortcuts(["Ctrl++", "Ctrl+="])
+        zoom_in_action.triggered.connect(lambda: self.zoom_at(QPointF(self.rect().center()), 1.25))
+        window_actions_menu.addAction(zoom_in_action)
+        zoom_out_action = QAction("Zoom Out", self)
+        zoom_out_action.setShortcut("Ctrl+-")
+        zoom_out_action.triggered.connect(lambda: self.zoom_at(QPointF(self.rect().center()), 0.8))
+        window_actions_menu.addAction(zoom_out_action)
+        actual_size_action = QAction("Actual Size", self)
+        actual_size_action.setShortcut("Ctrl+0")
+        actual_size_action.triggered.connect(self.reset_view)
+        window_actions_menu.addAction(actual_size_action)
         close_action = QAction("Close", self)
         close_action.setShortcut("Ctrl+W")
         close_action.triggered.connect(self.close)
@@ -116,6 +311,12 @@ class DrawingProgram(QMainWindow):
         width_10_action.setShortcut("9")
         width_10_action.triggered.connect(lambda: self.set_width(10))
         brush_size_menu.addAction(width_10_action)
+        brush_size_menu.addSeparator()
+        freehand_action = QAction("Freehand", self)
+        freehand_action.setShortcut("F")
+        freehand_action.setCheckable(True)
+        freehand_action.toggled.connect(self.set_free_draw_mode)
+        brush_size_menu.addAction(freehand_action)
 
         ## Brush size button
         brush_size_button = QToolButton(self)
@@ -124,39 +325,732 @@ class DrawingProgram(QMainWindow):
         brush_size_button.setText("Brush Size")
         toolbar.addWidget(brush_size_button)
 
+        ## Select menu: the left button's tool, and what to do with the selected strokes
+        select_menu = QMenu("Select", self)
+        tool_group = QActionGroup(self)
+        draw_tool_action = QAction("Draw", self)
+        draw_tool_action.setShortcut("D")
+        draw_tool_action.setCheckable(True)
+        draw_tool_action.setChecked(True)
+        draw_tool_action.triggered.connect(lambda: self.set_tool("draw"))
+        tool_group.addAction(draw_tool_action)
+        select_menu.addAction(draw_tool_action)
+        rectangle_tool_action = QAction("Rectangle Select", self)
+        rectangle_tool_action.setShortcut("R")
+        rectangle_tool_action.setCheckable(True)
+        rectangle_tool_action.triggered.connect(lambda: self.set_tool("rectangle"))
+        tool_group.addAction(rectangle_tool_action)
+        select_menu.addAction(rectangle_tool_action)
+        lasso_tool_action = QAction("Lasso Select", self)
+        lasso_tool_action.setShortcut("L")
+        lasso_tool_action.setCheckable(True)
+        lasso_tool_action.triggered.connect(lambda: self.set_tool("lasso"))
+        tool_group.addAction(lasso_tool_action)
+        select_menu.addAction(lasso_tool_action)
+        self.tool_actions = {"draw": draw_tool_action, "rectangle": rectangle_tool_action, "lasso": lasso_tool_action}
+        select_menu.addSeparator()
+        select_all_action = QAction("Select All", self)
+        select_all_action.setShortcut("Ctrl+A")
+        select_all_action.triggered.connect(self.select_all)
+        select_menu.addAction(select_all_action)
+        deselect_action = QAction("Deselect", self)
+        deselect_action.setShortcut("Escape")
+        deselect_action.triggered.connect(self.clear_selection)
+        select_menu.addAction(deselect_action)
+        delete_selection_action = QAction("Delete Selection", self)
+        delete_selection_action.setShortcut("Delete")
+        delete_selection_action.triggered.connect(self.delete_selection)
+        select_menu.addAction(delete_selection_action)
+
+        ## Select button
+        select_button = QToolButton(self)
+        select_button.setMenu(select_menu)
+        select_button.setPopupMode(QToolButton.ToolButtonPopupMode.InstantPopup)
+        select_button.setText("Select")
+        toolbar.addWidget(select_button)
+
+        ## Layers menu: operations on the active layer, then every layer top first to pick the active one from
+        self.layers_menu = QMenu("Layers", self)
+        new_layer_action = QAction("New Layer", self)
+        new_layer_action.setShortcut("Ctrl+Shift+N")
+        new_layer_action.triggered.connect(self.new_layer)
+        self.layers_menu.addAction(new_layer_action)
+        delete_layer_action = QAction("Delete Layer", self)
+        delete_layer_action.triggered.connect(self.delete_layer)
+        self.layers_menu.addAction(delete_layer_action)
+        rename_layer_action = QAction("Rename Layer...", self)
+        rename_layer_action.triggered.connect(self.rename_layer)
+        self.layers_menu.addAction(rename_layer_action)
+        raise_layer_action = QAction("Raise Layer", self)
+        raise_layer_action.setShortcut("Ctrl+]")
+        raise_layer_action.triggered.connect(lambda: self.move_layer(1))
+        self.layers_menu.addAction(raise_layer_action)
+        lower_layer_action = QAction("Lower Layer", self)
+        lower_layer_action.setShortcut("Ctrl+[")
+        lower_layer_action.triggered.connect(lambda: self.move_layer(-1))
+        self.layers_menu.addAction(lower_layer_action)
+        toggle_layer_action = QAction("Show/Hide Layer", self)
+        toggle_layer_action.setShortcut("Ctrl+H")
+        toggle_layer_action.triggered.connect(self.toggle_layer_visible)
+        self.layers_menu.addAction(toggle_layer_action)
+        self.layers_menu.addSeparator()
+        self.layer_actions = QActionGroup(self)
+        self.layers_menu.aboutToShow.connect(self.fill_layers_menu)
+
+        ## Layers button
+        layers_button = QToolButton(self)
+        layers_button.setMenu(self.layers_menu)
+        layers_button.setPopupMode(QToolButton.ToolButtonPopupMode.InstantPopup)
+        layers_button.setText("Layers")
+        toolbar.addWidget(layers_button)
+
+        ## Loading progress, only shown while a drawing is being opened
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.cancel_load_button = QPushButton("Cancel", self)
+        self.cancel_load_button.clicked.connect(self.cancel_loading)
+        self.cancel_load_button.hide()
+        self.statusBar().addPermanentWidget(self.cancel_load_button)
+
+    ## Render the visible part of the drawing into the layers' images. Only needed on load, new drawing, resize, zoom,
+    ## or while a zoomed-out view is still filling in. Hidden layers are left until they are shown again.
+    def rebuild_canvas(self):
+        self.view_size = self.size()
+        for layer in self.layers:
+            if layer.visible:
+                self.render_layer(layer)
+            else:
+                layer.stale = True
+        self.update()
+
+    ## Render the whole view of one layer onto a fresh image
+    def render_layer(self, layer):
+        layer.reset_image(self.view_size, self.devicePixelRatioF())
+        painter = QPainter(layer.image)
+        self.render_view(painter, self.rect(), layer)
+        painter.end()
+
+    ## Make painter, which draws in window coordinates, take drawing coordinates instead
+    def apply_view(self, painter):
+        painter.scale(self.zoom, self.zoom)
+        painter.translate(-self.view_origin)
+
+    def to_world(self, position):
+        return QPoint(round(position.x() / self.zoom + self.view_origin.x()),
+                      round(position.y() / self.zoom + self.view_origin.y()))
+
+    ## Window rectangle covering a drawing-space rectangle, and the other way round
+    def window_rect(self, rect):
+        return QRectF((rect.x() - self.view_origin.x()) * self.zoom, (rect.y() - self.view_origin.y()) * self.zoom,
+                      rect.width() * self.zoom, rect.height() * self.zoom).toAlignedRect().adjusted(-1, -1, 1, 1)
+
+    def world_rect(self, rect):
+        return QRectF(rect.x() / self.zoom + self.view_origin.x(), rect.y() / self.zoom + self.view_origin.y(),
+                      rect.width() / self.zoom, rect.height() / self.zoom).toAlignedRect().adjusted(-1, -1, 1, 1)
+
+    ## Draw the window area rect of the current view of a layer. From LOD_ZOOM up, only the strokes touching it are
+    ## drawn, found through the layer's spatial index; further out it is composed from the layer's overview tiles, and
+    ## if some are not rendered yet another pass is scheduled.
+    def render_view(self, painter, rect, layer):
+        painter.save()
+        painter.setClipRect(rect)
+        self.apply_view(painter)
+        world = self.world_rect(rect)
+        if OverviewCache.level_for(self.zoom):
+            complete, indices = layer.overview.draw(painter, layer.store, layer.index, self.zoom, world, layer.lifted)
+            if not complete:
+                self.overview_timer.start(0)
+        else:
+            indices = layer.index.query(world)
+            if layer.lifted:
+                indices = [i for i in indices if i not in layer.lifted]
+            layer.store.draw(painter, indices, min_size=1 / self.zoom if self.zoom < 1 else 0)
+        painter.restore()
+        self.count_drawn(layer.store, indices)
+
+    ## Zoom by factor keeping the drawing point under position (window coordinates) in place. The view stays put while
+    ## a selection is dragged, as its floating image is rendered for it.
+    def zoom_at(self, position, factor):
+        zoom = min(max(self.zoom * factor, MIN_ZOOM), MAX_ZOOM)
+        if zoom == self.zoom or self.moving:
+            return
+        self.view_origin += position / self.zoom - position / zoom
+        self.zoom = zoom
+        self.statusBar().showMessage(f"Zoom {zoom * 100:.0f}%", 2000)
+        self.rebuild_canvas()
+
+    def reset_view(self):
+        if self.moving:
+            return
+        self.zoom = 1.0
+        self.view_origin = QPointF(0, 0)
+        self.rebuild_canvas()
+
+    ## Scroll the view by delta window pixels: the cached pixels of each visible layer move along and only the exposed
+    ## strips are rendered
+    def pan_by(self, delta):
+        if delta.isNull():
+            return
+        self.view_origin -= QPointF(delta) / self.zoom
+        size = self.view_size
+        dx, dy = delta.x(), delta.y()
+        for layer in self.layers:
+            if not layer.visible:
+                layer.stale = True
+                continue
+            old_image = layer.image
+            layer.reset_image(size, old_image.devicePixelRatio())
+            painter = QPainter(layer.image)
+            painter.drawImage(delta, old_image)
+            if dx:
+                self.render_view(painter, QRect(0 if dx > 0 else size.width() + dx, 0, abs(dx), size.height()), layer)
+            if dy:
+                self.render_view(painter, QRect(0, 0 if dy > 0 else size.height() + dy, size.width(), abs(dy)), layer)
+            painter.end()
+        self.update()
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if steps:
+            self.zoom_at(event.position(), 1.25 ** steps)
+
+    ## Add the segments of the given strokes of store to the current frame's count, when instrumented
+    def count_drawn(self, store, indices):
+        if self.instruments.enabled:
+            self.instruments.count("segments_per_frame",
+                                   sum(max(end - begin - 1, 1) for begin, end in map(store.stroke_range, indices)))
+
+    def rebuild_index(self):
+        for layer in self.layers:
+            layer.rebuild_index()
+
+    ## Point the journal's stroke and cut entries at layer
+    def journal_layer(self, layer):
+        self.journal.select_layer(self.layers.index(layer))
+
+    ## Store a finished stroke in the active layer and draw it onto the layer's image so paintEvent never has to
+    ## replay it.
+    def commit_stroke(self, points):
+        layer, store = self.layer, self.layer.store
+        i = store.add_stroke(points, self.current_color, self.current_width)
+        layer.index_strokes(i)
+        self.journal_layer(layer)
+        self.journal.record_stroke(store, i)
+        self.history.push(AddStrokeCommand(self, i, layer))
+        layer.overview.invalidate(store.bounding_rect(i))
+        painter = QPainter(layer.image)
+        self.apply_view(painter)
+        store.draw(painter, (i,))
+        painter.end()
+        self.count_drawn(store, (i,))
+
+    ## Freehand input: the first move opens a stroke, later moves extend it unless they repeat or straighten the last
+    ## point. The samples of one frame go onto the layer's image with a single painter.
+    def extend_stroke(self, start, points):
+        layer, store = self.layer, self.layer.store
+        painter = QPainter(layer.image)
+        self.apply_view(painter)
+        painter.setPen(store.pen(store.color_index(self.current_color), self.current_width))
+        drawn = 0
+        for end in points:
+            self.stroke_samples += 1
+            if self.live_stroke is None:
+                self.live_stroke = store.add_stroke((start, end), self.current_color, self.current_width)
+                self.stroke_rect = QRect()
+            elif not store.add_sample(end):
+                start = end
+                continue
+            for rect in store.segment_rects(self.live_stroke, store.point_count() - 2):
+                layer.index.insert(self.live_stroke, rect)
+                self.stroke_rect = self.stroke_rect.united(rect)
+            painter.drawLine(start, end)
+            drawn += 1
+            start = end
+        painter.end()
+        if self.instruments.enabled:
+            self.instruments.count("segments_per_frame", drawn)
+
+    ## Simplify the released freehand stroke and redraw its area as one polyline so it gets proper joins
+    def finish_stroke(self):
+        layer = self.layer
+        ## The stroke was indexed sample by sample, all inside stroke_rect; index what is left of it after simplifying
+        layer.index.remove_items({self.live_stroke}, layer.index.rect_cells(self.stroke_rect))
+        _, kept = layer.store.simplify_last_stroke(self.simplify_tolerance)
+        layer.index_stroke(self.live_stroke)
+        stored = max(kept - 1, 1)
+        self.simplify_stats["segments_in"] += self.stroke_samples
+        self.simplify_stats["segments_out"] += stored
+        self.statusBar().showMessage(f"Stroke simplified from {self.stroke_samples} to {stored} segments", 3000)
+        ## The tiles under the stroke were dropped by this repaint as well
+        self.repaint_canvas_region(self.stroke_rect, layer)
+        self.journal_layer(layer)
+        self.journal.record_stroke(layer.store, self.live_stroke)
+        self.history.push(AddStrokeCommand(self, self.live_stroke, layer))
+        self.live_stroke = None
+        self.stroke_samples = 0
+
+    ## Geometric eraser: cut the parts of the active layer's segments that the eraser path from start through points
+    ## passes over out of the drawing, finding them through the spatial index, instead of painting white over them.
+    ## Each step is applied before the next so it does not cut the same range twice; journal and repaint happen once
+    ## per path.
+    def erase_along(self, start, points):
+        layer, store = self.layer, self.layer.store
+        cuts = []
+        for end in points:
+            step = []
+            for i in layer.index.query(segment_rect(start, end, self.current_width)):
+                for k, t0, t1 in store.hit_segments(i, start.x(), start.y(), end.x(), end.y(), self.current_width / 2):
+                    step.append((i, k, t0, t1))
+            store.erase(step)
+            cuts.extend(step)
+            start = end
+        if cuts:
+            self.journal_layer(layer)
+            self.journal.record_cuts("E", cuts)
+            self.repaint_segments(cuts, layer)
+            self.erase_cuts.extend(cuts)
+
+    def erase_segments(self, cuts, layer):
+        layer.store.erase(cuts)
+        self.journal_layer(layer)
+        self.journal.record_cuts("E", cuts)
+        self.repaint_segments(cuts, layer)
+
+    ## Undo of an erase
+    def restore_segments(self, cuts, layer):
+        layer.store.restore(cuts)
+        self.journal_layer(layer)
+        self.journal.record_cuts("R", cuts)
+        self.repaint_segments(cuts, layer)
+
+    def repaint_segments(self, cuts, layer):
+        rect = QRect()
+        for cut in cuts:
+            rect = rect.united(layer.store.cut_bounds(*cut))
+        self.repaint_canvas_region(rect, layer)
+        self.mark_dirty()
+
+    def finish_erase(self):
+        if self.erase_cuts:
+            self.history.push(EraseCommand(self, self.erase_cuts, self.layer))
+        self.erasing = False
+        self.erase_cuts = []
+
+    ## A load, a freehand stroke, an eraser drag or a selection drag is in progress; undo and layer changes wait until
+    ## it is over
+    def busy(self):
+        return (self.loader is not None or self.live_stroke is not None or self.erasing or self.moving
+                or self.select_path is not None)
+
+    ## The selection is dropped, as the strokes it names may be the ones that change
+    def undo(self):
+        if not self.busy():
+            self.clear_selection()
+            self.history.undo()
+
+    def redo(self):
+        if not self.busy():
+            self.clear_selection()
+            self.history.redo()
+
+    ## Undo of an added stroke: drop the newest stroke of the layer and repaint only the area it covered
+    def remove_last_stroke(self, layer):
+        store = layer.store
+        i = len(store) - 1
+        rect = store.bounding_rect(i)
+        layer.unindex_stroke(i)
+        store.remove_last_stroke()
+        self.journal_layer(layer)
+        self.journal.record("U")
+        self.repaint_canvas_region(rect, layer)
+        self.mark_dirty()
+
+    ## Redo of an added stroke
+    def restore_stroke(self, coordinates, color, width, layer):
+        i = layer.store.add_stroke_coordinates(coordinates, color, width)
+        layer.index_strokes(i)
+        self.journal_layer(layer)
+        self.journal.record_stroke(layer.store, i)
+        self.repaint_canvas_region(layer.store.bounding_rect(i), layer)
+        self.mark_dirty()
+
+    ## Move strokes of a layer by (dx, dy) drawing units, re-index them and repaint where they were and where they are
+    def move_strokes(self, indices, dx, dy, layer):
+        store = layer.store
+        old_rect = strokes_rect(store, indices)
+        cells = set()
+        for i in indices:
+            cells |= layer.stroke_cells(i)
+        layer.index.remove_items(set(indices), cells)
+        store.translate(indices, dx, dy)
+        for i in indices:
+            layer.index_stroke(i)
+        self.journal_layer(layer)
+        self.journal.record_move(indices, dx, dy)
+        new_rect = old_rect.translated(dx, dy)
+        if new_rect.intersects(old_rect):
+            self.repaint_canvas_region(old_rect.united(new_rect), layer)
+        else:
+            self.repaint_canvas_region(old_rect, layer)
+            self.repaint_canvas_region(new_rect, layer)
+        self.mark_dirty()
+
+    ## Re-render one area (drawing coordinates) of a layer from its store, e.g. after strokes in it changed. The other
+    ## layers' images stay as they are; a hidden layer is only marked for rendering when it is shown.
+    def repaint_canvas_region(self, rect, layer):
+        layer.overview.invalidate(rect)
+        if not layer.visible:
+            layer.stale = True
+            return
+        rect = self.window_rect(rect)
+        layer.clear_region(rect)
+        painter = QPainter(layer.image)
+        self.render_view(painter, rect, layer)
+        painter.end()
+        self.update(rect)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        ## Shrinking keeps the bigger images, only growing past them needs new pixels
+        if self.width() > self.view_size.width() or self.height() > self.view_size.height():
+            self.grow_canvas(self.view_size)
+
+    ## Keep the already rendered pixels and only draw segments in the newly exposed strips
+    def grow_canvas(self, old_size):
+        ratio = self.devicePixelRatioF()
+        if any(layer.image.isNull() or ratio != layer.image.devicePixelRatio() for layer in self.layers if layer.visible):
+            self.rebuild_canvas()
+            return
+        size = old_size.expandedTo(self.size())
+        self.view_size = size
+        for layer in self.layers:
+            if not layer.visible:
+                layer.stale = True
+                continue
+            old_image = layer.image
+            layer.reset_image(size, ratio)
+            painter = QPainter(layer.image)
+            painter.drawImage(0, 0, old_image)
+            if size.width() > old_size.width():
+                self.render_view(painter, QRect(old_size.width(), 0, size.width() - old_size.width(), size.height()), layer)
+            if size.height() > old_size.height():
+                self.render_view(painter, QRect(0, old_size.height(), old_size.width(), size.height() - old_size.height()), layer)
+            painter.end()
+        self.update()
+
+    ## Invalidate the window area covered by a segment in drawing coordinates, or the whole window when partial
+    ## updates are off
+    def update_segment(self, start, end, width):
+        if self.partial_updates:
+            self.update(self.window_rect(segment_rect(start, end, width)))
+        else:
+            self.update()
+
     def paintEvent(self, event):
+        if self.instruments.enabled:
+            start = time.perf_counter()
         painter = QPainter(self)
-        for line in self.lines:
-            painter.setPen(QPen(line[2], line[3], Qt.PenStyle.SolidLine))
-            painter.drawLine(line[0], line[1])
+        rect = event.rect()
+        ## Stack the cached images of the visible layers, bottom first
+        painter.fillRect(rect, QColor("white"))
+        for layer in self.layers:
+            if layer.visible:
+                ratio = layer.image.devicePixelRatio()
+                painter.drawImage(rect, layer.image, QRect(rect.topLeft() * ratio, rect.size() * ratio))
+        if self.floating is not None:
+            painter.drawImage(QPointF(self.floating_rect.topLeft()) + QPointF(self.move_offset) * self.zoom, self.floating)
+        if self.selection or self.select_path is not None:
+            self.draw_selection(painter)
 
-        if self.__leftMouseButtonDown:
+        if self.__leftMouseButtonDown and not self.erasing and self.tool == "draw":
+            painter.save()
+            self.apply_view(painter)
             painter.setPen(QPen(self.current_color, self.current_width, Qt.PenStyle.SolidLine))
             painter.drawLine(self.__startPosition, self.__endPosition)
+            painter.restore()
+
+        if self.instruments.enabled:
+            self.record_frame(start)
+        if self.hud_visible and rect.intersects(self.hud_rect()):
+            self.draw_hud(painter)
+
+    def record_frame(self, start):
+        end = time.perf_counter()
+        self.instruments.record("frame_ms", (end - start) * 1000)
+        self.instruments.flush_count("segments_per_frame")
+        if self.input_time is not None:
+            self.instruments.record("latency_ms", (end - self.input_time) * 1000)
+            self.input_time = None
+
+    ## Debug HUD showing frame and input percentiles; turning it on starts the instrumentation it reads from
+    def set_hud_visible(self, visible):
+        self.hud_visible = visible
+        self.instruments.enabled = visible or self.instrument_always
+        if visible:
+            self.refresh_hud()
+            self.hud_timer.start()
+        else:
+            self.hud_timer.stop()
+            self.update(self.hud_rect())
+
+    def hud_rect(self):
+        return QRect(8, self.centralWidget().geometry().top() + 8, 360, 128)
+
+    ## Recompute the HUD text a couple of times a second instead of on every frame
+    def refresh_hud(self):
+        summary = self.instruments.summary()
+        lines = []
+        for name, label, unit in (("frame_ms", "frame", "ms"), ("input_ms", "input", "ms"),
+                                  ("latency_ms", "input to paint", "ms"), ("segments_per_frame", "segments/frame", "")):
+            if name in summary:
+                values = summary[name]
+                lines.append(f"{label:15s} p50 {values['p50']:7.2f}  p95 {values['p95']:7.2f}  p99 {values['p99']:7.2f} {unit}")
+            else:
+                lines.append(f"{label:15s} -")
+        batch = self.input_batch
+        lines.append(f"{'input frames':15s} {batch.frames} for {batch.samples} moves, {batch.frames_dropped} dropped "
+                     f"at {batch.frame_rate:.0f} Hz")
+        for name, label in (("load_s", "last load"), ("save_s", "last save")):
+            if name in summary:
+                lines.append(f"{label:15s} {self.instruments.buffers[name].values()[-1]:.3f} s")
+        self.hud_text = "\n".join(lines)
+        self.update(self.hud_rect())
+
+    def draw_hud(self, painter):
+        rect = self.hud_rect()
+        painter.fillRect(rect, QColor(0, 0, 0, 180))
+        painter.setPen(QColor("white"))
+        painter.setFont(QFontDatabase.systemFont(QFontDatabase.SystemFont.FixedFont))
+        painter.drawText(rect.adjusted(6, 4, -6, -4), Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignTop, self.hud_text)
+
+    ## Write the recorded timings as JSON or CSV
+    def export_timings(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Timings", "", "JSON (*.json);;CSV (*.csv)")
+        if file_path:
+            try:
+                self.instruments.dump(file_path)
+            except OSError as error:
+                QMessageBox.warning(self, "Export Timings", f"Could not write the timings: {error}")
 
+    ## Mouse positions are kept in drawing coordinates; the middle button pans the view
     def mousePressEvent(self, event):
+        ## A dragged selection's image is laid out for the view it was lifted in, so the view cannot pan under it
+        if event.button() == Qt.MouseButton.MiddleButton and not self.moving:
+            self.panning = True
+            self.pan_anchor = event.pos()
+            return
+        ## No drawing into a store that is still receiving chunks
+        if self.loader is not None:
+            return
         if event.button() == Qt.MouseButton.LeftButton:
+            if not self.layer.visible:
+                self.statusBar().showMessage(f"{self.layer.name} is hidden", 3000)
+                return
+            if self.tool != "draw" and self.panning:
+                return
+            position = self.to_world(event.pos())
             self.__leftMouseButtonDown = True
-            self.__startPosition = event.pos()
-            self.__endPosition = event.pos()
-            if self.current_color == Qt.GlobalColor.white:
-                self.free_draw_mode = True
+            self.__startPosition = position
+            self.__endPosition = position
+            if self.tool != "draw":
+                self.start_selection_drag(position)
+            elif self.current_color == Qt.GlobalColor.white:
+                self.erasing = True
+                self.erase_along(position, (position,))
 
     def mouseMoveEvent(self, event):
-        if self.__leftMouseButtonDown:
-            self.__endPosition = event.pos()
-            if self.current_color == Qt.GlobalColor.white and self.free_draw_mode:
-                self.lines.append((self.__startPosition, self.__endPosition, self.current_color, self.current_width))
-                self.__startPosition = self.__endPosition
-            self.update()
+        if self.panning or self.__leftMouseButtonDown:
+            if self.instruments.enabled and self.input_time is None:
+                self.input_time = time.perf_counter()
+            self.input_batch.add(event.pos())
+
+    ## Handle the mouse positions queued since the last frame in one go, with one repaint for all of them
+    def process_moves(self, positions):
+        if self.instruments.enabled:
+            start = time.perf_counter()
+        if self.panning:
+            self.pan_by(positions[-1] - self.pan_anchor)
+            self.pan_anchor = positions[-1]
+        elif self.moving:
+            self.drag_selection(self.to_world(positions[-1]))
+        elif self.select_path is not None:
+            self.extend_select_path([self.to_world(position) for position in positions])
+        elif self.__leftMouseButtonDown and self.erasing:
+            points = [self.to_world(position) for position in positions]
+            self.erase_along(self.__endPosition, points)
+            self.__startPosition = self.__endPosition = points[-1]
+        elif self.__leftMouseButtonDown and self.free_draw_mode:
+            points = [self.to_world(position) for position in positions]
+            self.extend_stroke(self.__startPosition, points)
+            rect = segment_rect(self.__startPosition, points[0], self.current_width)
+            for previous, end in zip(points, points[1:]):
+                rect = rect.united(segment_rect(previous, end, self.current_width))
+            self.update(self.window_rect(rect) if self.partial_updates else self.rect())
+            self.__startPosition = self.__endPosition = points[-1]
+        elif self.__leftMouseButtonDown:
+            ## The previous rubber-band line has to be wiped as well as the new one drawn; ends in between never showed
+            self.update_segment(self.__startPosition, self.__endPosition, self.current_width)
+            self.__endPosition = self.to_world(positions[-1])
+            self.update_segment(self.__startPosition, self.__endPosition, self.current_width)
+        if self.instruments.enabled:
+            self.instruments.record("input_ms", (time.perf_counter() - start) * 1000)
 
     def mouseReleaseEvent(self, event):
-        if self.__leftMouseButtonDown:
+        ## Moves still waiting for the next frame belong to the stroke being released
+        self.input_batch.flush()
+        if event.button() == Qt.MouseButton.MiddleButton:
+            self.panning = False
+        elif self.__leftMouseButtonDown:
             self.__leftMouseButtonDown = False
-            if not (self.current_color == Qt.GlobalColor.white and self.free_draw_mode):
-                self.lines.append((self.__startPosition, self.__endPosition, self.current_color, self.current_width))
-            self.dirty = True
-            self.free_draw_mode = False
+            if self.moving:
+                self.drop_selection()
+                return
+            if self.select_path is not None:
+                self.finish_select_path()
+                return
+            if self.erasing:
+                self.finish_erase()
+                return
+            if self.live_stroke is not None:
+                self.finish_stroke()
+            elif not self.free_draw_mode:
+                self.commit_stroke((self.__startPosition, self.__endPosition))
+            self.mark_dirty()
+            self.update_segment(self.__startPosition, self.__endPosition, self.current_width)
+
+    ## Pick the left button's tool; a selection does not survive the change
+    def set_tool(self, tool):
+        if self.busy():
+            self.tool_actions[self.tool].setChecked(True)
+            return
+        self.tool = tool
+        self.clear_selection()
+
+    def clear_selection(self):
+        if self.selection:
+            self.update(self.selection_window_rect())
+        self.selection = []
+        self.selection_rect = QRect()
+
+    def set_selection(self, indices):
+        self.clear_selection()
+        self.selection = indices
+        self.selection_rect = strokes_rect(self.layer.store, indices)
+        self.update(self.selection_window_rect())
+        self.statusBar().showMessage(f"{len(indices)} strokes selected", 3000)
+
+    def select_all(self):
+        if self.busy():
+            return
+        if self.tool == "draw":
+            self.tool_actions["rectangle"].setChecked(True)
+            self.tool = "rectangle"
+        store = self.layer.store
+        self.set_selection([i for i in range(len(store)) if not erased_entirely(store, i)])
+
+    ## Delete the selected strokes by cutting them out whole, as the eraser would, so undo brings them back the same way
+    def delete_selection(self):
+        if self.busy() or not self.selection:
+            return
+        layer = self.layer
+        cuts = layer.store.whole_cuts(self.selection)
+        self.clear_selection()
+        self.erase_segments(cuts, layer)
+        self.history.push(EraseCommand(self, cuts, layer))
+
+    ## Window area of the selection outline, where it is being dragged to
+    def selection_window_rect(self):
+        return self.window_rect(self.selection_rect.translated(self.move_offset)).adjusted(-2, -2, 2, 2)
+
+    ## A press inside the selection picks it up; anywhere else starts a new region
+    def start_selection_drag(self, position):
+        if self.selection and self.selection_rect.contains(position):
+            self.lift_selection(position)
+        else:
+            self.clear_selection()
+            self.select_path = QPolygon([position])
+
+    def extend_select_path(self, points):
+        old_rect = self.window_rect(self.select_path.boundingRect())
+        if self.tool == "rectangle":
+            self.select_path = QPolygon([self.select_path.first(), points[-1]])
+        else:
+            for point in points:
+                self.select_path.append(point)
+        self.update(old_rect.united(self.window_rect(self.select_path.boundingRect())).adjusted(-2, -2, 2, 2))
+
+    ## Select the strokes of the active layer inside the finished region
+    def finish_select_path(self):
+        path, self.select_path = self.select_path, None
+        self.update(self.window_rect(path.boundingRect()).adjusted(-2, -2, 2, 2))
+        layer = self.layer
+        if self.tool == "rectangle":
+            self.set_selection(strokes_in_rect(layer.store, layer.index, path.boundingRect()))
+        elif len(path) >= 3:
+            self.set_selection(strokes_in_polygon(layer.store, layer.index, path))
+
+    ## Pick the selection up: its strokes are rendered once into a floating image, which is all that moves while the
+    ## mouse drags it, and the layer is re-rendered without them where they were. The image covers at most a window's
+    ## size around the view, so a zoomed-in selection stays cheap.
+    def lift_selection(self, position):
+        layer = self.layer
+        self.moving = True
+        self.move_anchor = position
+        self.move_offset = QPoint()
+        view = self.rect()
+        self.floating_rect = self.window_rect(self.selection_rect).intersected(
+            view.adjusted(-view.width(), -view.height(), view.width(), view.height()))
+        ratio = self.devicePixelRatioF()
+        self.floating = QImage(self.floating_rect.size() * ratio, QImage.Format.Format_ARGB32_Premultiplied)
+        self.floating.setDevicePixelRatio(ratio)
+        self.floating.fill(Qt.GlobalColor.transparent)
+        painter = QPainter(self.floating)
+        painter.translate(-QPointF(self.floating_rect.topLeft()))
+        self.apply_view(painter)
+        layer.store.draw(painter, self.selection, min_size=1 / self.zoom if self.zoom < 1 else 0)
+        painter.end()
+        layer.lifted = set(self.selection)
+        self.repaint_canvas_region(self.selection_rect, layer)
+
+    def drag_selection(self, position):
+        old_rect = self.selection_window_rect()
+        self.move_offset = position - self.move_anchor
+        self.update(old_rect.united(self.selection_window_rect()))
+
+    ## Put the selection down where it was dragged to; only now do its strokes move in the store
+    def drop_selection(self):
+        layer = self.layer
+        offset = self.move_offset
+        self.update(self.selection_window_rect())
+        self.moving = False
+        self.floating = None
+        self.move_offset = QPoint()
+        layer.lifted = set()
+        if offset.isNull():
+            self.repaint_canvas_region(self.selection_rect, layer)
+            return
+        self.move_strokes(self.selection, offset.x(), offset.y(), layer)
+        self.history.push(MoveCommand(self, self.selection, offset.x(), offset.y(), layer))
+        self.selection_rect = self.selection_rect.translated(offset)
+        self.update(self.selection_window_rect())
+
+    ## Dashed outline of the selection, or of the region being dragged out
+    def draw_selection(self, painter):
+        painter.save()
+        self.apply_view(painter)
+        pen = QPen(QColor(0, 120, 215), 1, Qt.PenStyle.DashLine)
+        pen.setCosmetic(True)
+        painter.setPen(pen)
+        painter.setBrush(Qt.BrushStyle.NoBrush)
+        if self.select_path is None:
+            painter.drawRect(self.selection_rect.translated(self.move_offset))
+        elif self.tool == "rectangle":
+            painter.drawRect(self.select_path.boundingRect())
+        else:
+            painter.drawPolygon(self.select_path)
+        painter.restore()
 
     def change_color(self):
         color_dialog = QColorDialog(self)
@@ -173,28 +1067,179 @@ class DrawingProgram(QMainWindow):
         self.canvas.fill(QColor("white"))
         self.label.setPixmap(self.canvas)
 
+    def mark_dirty(self):
+        self.revision += 1
+        if not self.dirty:
+            self.dirty = True
+            self.update_title()
+
+    def update_title(self):
+        title = "Drawing Program"
+        if self.temp_file_path:
+            title += f" - {self.temp_file_path}"
+        if self.dirty:
+            title += " *"
+        self.setWindowTitle(title)
+
     def save_drawing(self):
         if not self.temp_file_path:
             self.save_drawing_as()
         else:
-            self.save_drawing_to_file(self.temp_file_path)
+            self.start_saving(self.temp_file_path)
 
     def save_drawing_as(self):
+        if self.loader is not None:
+            self.refuse_save()
+            return
         file_path, _ = QFileDialog.getSaveFileName(self, "Save Drawing", "", "Drawing Files (*.draw)")
         if file_path:
-            with open(file_path, 'w') as f:
-                for line in self.lines:
-                    color = QColor(line[2])
-                    f.write(f"{line[0].x()},{line[0].y()},{line[1].x()},{line[1].y()},{color.name()}\n")
-            self.save_drawing_to_file(file_path)
-            self.temp_file_path = file_path
-            self.dirty = False
+            self.start_saving(file_path)
 
+    ## Synchronous save; atomic unless it appends
     def save_drawing_to_file(self, file_path):
-        with open(file_path, 'w') as f:
-            for line in self.lines:
-                color = QColor(line[2])
-                f.write(f"{line[0].x()},{line[0].y()},{line[1].x()},{line[1].y()},{color.name()},{line[3]}\n")
+        start = time.perf_counter()
+        append_from = self.append_from(file_path)
+        layout = self.layer_layout()
+        for layer in self.layers:
+            layer.store.mark_unchanged()
+        try:
+            write_drawing(file_path, [layer.saved() for layer in self.layers], append_from)
+        except OSError:
+            self.saved_file = None
+            raise
+        self.remember_saved_file(file_path, layout)
+        if self.instruments.enabled:
+            self.instruments.record("save_s", time.perf_counter() - start)
+
+    ## The layers in order with their names, visibility and stroke counts, as a save writes them
+    def layer_layout(self):
+        return tuple((layer, layer.name, layer.visible, len(layer.store)) for layer in self.layers)
+
+    ## First stroke of the top layer to append when saving to file_path, or None when the file has to be written from
+    ## scratch: the file must be the one last saved or loaded, untouched since, with the same layers, every stroke it
+    ## holds unchanged in the drawing and new strokes on the top layer only
+    def append_from(self, file_path):
+        if self.saved_file is None:
+            return None
+        saved_path, layout, signature = self.saved_file
+        if saved_path != file_path or [entry[:3] for entry in layout] != [entry[:3] for entry in self.layer_layout()]:
+            return None
+        if any(layer.store.changed_from < strokes or len(layer.store) != strokes for layer, _, _, strokes in layout[:-1]):
+            return None
+        store, strokes = layout[-1][0].store, layout[-1][3]
+        if store.changed_from < strokes or len(store) < strokes:
+            return None
+        ## Erased strokes are written compacted, which the append cannot do
+        if any(i >= strokes for i in store.erased):
+            return None
+        try:
+            if file_signature(file_path) != signature:
+                return None
+        except OSError:
+            return None
+        return strokes
+
+    def remember_saved_file(self, file_path, layout):
+        try:
+            self.saved_file = (file_path, layout, file_signature(file_path))
+        except OSError:
+            self.saved_file = None
+
+    ## Snapshot the store and write it out on a worker thread so drawing can go on during a large save.
+    ## A save requested while another one runs is queued and starts from a fresh snapshot afterwards.
+    def start_saving(self, file_path):
+        if self.loader is not None:
+            self.refuse_save()
+            return
+        if self.saver is not None:
+            self.pending_save = file_path
+            return
+        ## Compacting renumbers strokes that a stroke, erase or move in progress still refers to; wait until it is over
+        editing = self.live_stroke is not None or self.erasing or self.moving
+        if editing and any(layer.store.erased for layer in self.layers):
+            self.pending_save = file_path
+            QTimer.singleShot(100, self.start_pending_save)
+            return
+        self.compact_layers()
+        self.saving_source = self.layers
+        self.saving_revision = self.revision
+        self.saving_journal_mark = self.journal.mark()
+        self.save_started = time.perf_counter()
+        append_from = self.append_from(file_path)
+        self.saving_layout = self.layer_layout()
+        ## Edits made while the save runs lower the marks again
+        for layer in self.layers:
+            layer.store.mark_unchanged()
+        self.saver_thread = QThread(self)
+        self.saver = DrawingSaver(file_path, [(layer.name, layer.visible, layer.store.copy()) for layer in self.layers],
+                                  append_from)
+        self.saver.moveToThread(self.saver_thread)
+        self.saver_thread.started.connect(self.saver.run)
+        self.saver.finished.connect(self.saving_finished)
+        self.saver.failed.connect(self.saving_failed)
+        self.statusBar().showMessage(f"Saving {file_path}")
+        self.saver_thread.start()
+
+    def saving_finished(self):
+        file_path = self.saver.file_path
+        if self.instruments.enabled:
+            self.instruments.record("save_s", time.perf_counter() - self.save_started)
+        ## The drawing may have been replaced (new/open) while the save ran; its state is then none of our business
+        if self.saving_source is self.layers:
+            self.temp_file_path = file_path
+            self.dirty = self.revision != self.saving_revision
+            self.update_title()
+            ## The saved file now holds everything up to the snapshot; only later edits stay in the journal
+            self.journal.rebase(file_path, self.saving_journal_mark)
+            self.remember_saved_file(file_path, self.saving_layout)
+        self.stop_saver()
+        self.statusBar().showMessage(f"Saved {file_path}", 3000)
+
+    def saving_failed(self, message):
+        if self.saving_source is self.layers:
+            self.saved_file = None
+        self.stop_saver()
+        self.statusBar().clearMessage()
+        QMessageBox.warning(self, "Save Drawing", f"Could not save the drawing: {message}")
+
+    def stop_saver(self):
+        self.saver_thread.quit()
+        self.saver_thread.wait()
+        self.saver.deleteLater()
+        self.saver_thread.deleteLater()
+        self.saver = None
+        self.saver_thread = None
+        self.saving_source = None
+        self.start_pending_save()
+
+    ## While a drawing is being opened the window holds only part of it, and the file path is still the previous one's
+    def refuse_save(self):
+        self.statusBar().showMessage("Cannot save while a drawing is being opened", 3000)
+
+    def start_pending_save(self):
+        if self.pending_save and self.saver is None:
+            file_path, self.pending_save = self.pending_save, None
+            self.start_saving(file_path)
+
+    ## A save writes every layer compacted (StrokeStore.compacted()), which drops erased parts and renumbers the
+    ## strokes. The layers are compacted the same way before the snapshot, so that the journal entries left after the
+    ## save name strokes as the file has them. Undo history is dropped with the old numbers its commands refer to.
+    def compact_layers(self):
+        if not any(layer.store.erased for layer in self.layers):
+            return
+        self.clear_selection()
+        for layer in self.layers:
+            if layer.store.erased:
+                layer.store = layer.store.compacted()
+                layer.rebuild_index()
+        self.history.clear()
+        self.journal.record("K")
+
+    ## Block until running and queued saves are on disk, e.g. before the window goes away
+    def wait_for_saves(self):
+        while self.saver is not None:
+            self.saver_thread.wait()
+            QApplication.processEvents()
 
     def set_color(self, color):
         self.current_color = color
@@ -202,71 +1247,332 @@ class DrawingProgram(QMainWindow):
     def set_width(self, width):
         self.current_width = width
 
+    ## Freehand strokes follow the mouse; otherwise a drag draws a straight line from press to release
+    def set_free_draw_mode(self, enabled):
+        self.free_draw_mode = enabled
+
+    ## Layer the next strokes go into; picking one is not an edit and is not journaled
+    def set_active_layer(self, layer):
+        if self.busy() or layer is self.layer:
+            return
+        self.clear_selection()
+        self.layer = layer
+        self.statusBar().showMessage(f"Drawing on {layer.name}", 2000)
+
+    ## One checkable entry per layer, top first, rebuilt each time the menu opens
+    def fill_layers_menu(self):
+        for action in self.layer_actions.actions():
+            self.layer_actions.removeAction(action)
+            self.layers_menu.removeAction(action)
+            action.deleteLater()
+        for layer in reversed(self.layers):
+            action = QAction(layer.name if layer.visible else f"{layer.name} (hidden)", self)
+            action.setCheckable(True)
+            action.setChecked(layer is self.layer)
+            action.triggered.connect(lambda checked, layer=layer: self.set_active_layer(layer))
+            self.layer_actions.addAction(action)
+            self.layers_menu.addAction(action)
+
+    ## Insert an empty layer above the active one and draw on it
+    def new_layer(self):
+        if self.busy():
+            return
+        names = {layer.name for layer in self.layers}
+        number = len(self.layers) + 1
+        while f"Layer {number}" in names:
+            number += 1
+        layer = Layer(f"Layer {number}")
+        position = self.layers.index(self.layer) + 1
+        self.layers.insert(position, layer)
+        self.render_layer(layer)
+        self.journal.record(f"A,{position},{layer.name}")
+        self.set_active_layer(layer)
+        self.mark_dirty()
+
+    ## Delete the active layer, after asking if it has strokes. Undo history is cleared, as it may refer to them.
+    def delete_layer(self):
+        if self.busy() or len(self.layers) == 1:
+            return
+        layer = self.layer
+        if layer.store and QMessageBox.question(
+                self, "Delete Layer", f"Delete {layer.name} and its strokes? This cannot be undone.") != QMessageBox.StandardButton.Yes:
+            return
+        position = self.layers.index(layer)
+        del self.layers[position]
+        self.journal.record(f"D,{position}")
+        self.history.clear()
+        self.set_active_layer(self.layers[max(position - 1, 0)])
+        self.update()
+        self.mark_dirty()
+
+    def rename_layer(self):
+        if self.busy():
+            return
+        name, accepted = QInputDialog.getText(self, "Rename Layer", "Name:", text=self.layer.name)
+        ## One line, as the journal stores it
+        name = " ".join(name.split())
+        if accepted and name and name != self.layer.name:
+            self.layer.name = name
+            self.journal.record(f"N,{self.layers.index(self.layer)},{name}")
+            self.mark_dirty()
+
+    ## Move the active layer step places up (positive) or down the stack; nothing is rendered, only composited anew
+    def move_layer(self, step):
+        position = self.layers.index(self.layer)
+        target = position + step
+        if self.busy() or not 0 <= target < len(self.layers):
+            return
+        self.layers.insert(target, self.layers.pop(position))
+        self.journal.record(f"M,{position},{target}")
+        self.update()
+        self.mark_dirty()
+
+    ## Hide or show the active layer. Hiding costs nothing; showing re-renders the layer only if the view changed
+    ## while it was hidden.
+    def toggle_layer_visible(self):
+        if self.busy():
+            return
+        layer = self.layer
+        self.clear_selection()
+        layer.visible = not layer.visible
+        if layer.visible and layer.stale:
+            self.render_layer(layer)
+        self.journal.record(f"V,{self.layers.index(layer)},{int(layer.visible)}")
+        self.statusBar().showMessage(f"{layer.name} {'shown' if layer.visible else 'hidden'}", 2000)
+        self.update()
+        self.mark_dirty()
+
+    ## Offer to save unsaved changes before the drawing is replaced or closed. False when it has to stay: the user
+    ## cancelled, or chose to save and the save failed or its dialog was cancelled, leaving the drawing dirty.
+    def confirm_discard(self):
+        if not self.dirty:
+            return True
+        response = QMessageBox.question(self, "Save Changes?", "Do you want to save the current drawing?",
+                                        QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No | QMessageBox.StandardButton.Cancel)
+        if response == QMessageBox.StandardButton.Yes:
+            self.save_drawing()
+            self.wait_for_saves()
+            return not self.dirty
+        return response != QMessageBox.StandardButton.Cancel
+
     def new_drawing(self):
-        if self.dirty:
-            response = QMessageBox.question(self, "Save Changes?", "Do you want to save the current drawing?",
-                                            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No | QMessageBox.StandardButton.Cancel)
-            if response == QMessageBox.StandardButton.Yes:
-                self.save_drawing()
-            elif response == QMessageBox.StandardButton.Cancel:
-                return
-        self.lines = []
+        if not self.confirm_discard():
+            return
+        self.clear_selection()
+        self.layers = [Layer(FIRST_LAYER_NAME)]
+        self.layer = self.layers[0]
         self.dirty = False
         self.temp_file_path = None
-        self.canvas.fill(QColor("white"))
-        self.label.setPixmap(self.canvas)
-        self.update()
+        self.saved_file = None
+        self.journal.start(None)
+        self.history.clear()
+        self.update_title()
+        self.rebuild_canvas()
 
     def open_drawing(self):
-        if self.dirty:
-            response = QMessageBox.question(self, "Save Changes?", "Do you want to save the current drawing?",
-                                            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No | QMessageBox.StandardButton.Cancel)
-            if response == QMessageBox.StandardButton.Yes:
-                self.save_drawing()
-            elif response == QMessageBox.StandardButton.Cancel:
-                return
+        if not self.confirm_discard():
+            return
         file_path, _ = QFileDialog.getOpenFileName(self, "Open Drawing", "", "Drawing Files (*.draw)")
         if file_path:
-            self.load_drawing(file_path)
-            self.temp_file_path = file_path
-            self.dirty = False
-            self.update()
+            self.start_loading(file_path)
 
-    def load_drawing(self, file_path):
-        with open(file_path, 'r') as f:
-            self.lines = []
-            for line in f:
-                parts = line.strip().split(',')
-                start = QPoint(int(parts[0]), int(parts[1]))
-                end = QPoint(int(parts[2]), int(parts[3]))
-                color = QColor(parts[4])
-                width = int(parts[5])
-                self.lines.append((start, end, color, width))
-        self.canvas.fill(QColor("white"))
+    ## Open a drawing without blocking the GUI: the file is parsed on a worker thread and strokes appear on the canvas
+    ## chunk by chunk. The current drawing is kept aside so cancelling goes straight back to it.
+    def start_loading(self, file_path):
+        self.cancel_loading()
+        self.clear_selection()
+        self.previous_drawing = (self.layers, self.layer, self.temp_file_path, self.dirty, self.zoom,
+                                 QPointF(self.view_origin), self.view_size)
+        self.layers = [Layer(FIRST_LAYER_NAME)]
+        self.layer = self.layers[0]
+        self.rebuild_canvas()
+        self.load_started = time.perf_counter()
+        self.loader_thread = QThread(self)
+        self.loader = DrawingLoader(file_path)
+        self.loader.moveToThread(self.loader_thread)
+        self.loader_thread.started.connect(self.loader.run)
+        self.loader.layers_found.connect(self.add_loaded_layers)
+        self.loader.chunk_loaded.connect(self.add_loaded_chunk)
+        self.loader.progress.connect(self.progress_bar.setValue)
+        self.loader.finished.connect(self.loading_finished)
+        self.loader.failed.connect(self.loading_failed)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_load_button.show()
+        self.statusBar().showMessage(f"Opening {file_path}")
+        self.loader_thread.start()
+
+    ## The file's layers, still empty; the top one becomes active
+    def add_loaded_layers(self, table):
+        self.layers = [Layer(name, visible=visible) for name, visible in table]
+        self.layer = self.layers[-1]
+        self.rebuild_canvas()
+
+    def add_loaded_chunk(self, position, chunk):
+        layer = self.layers[position]
+        store = layer.store
+        first = store.append_store(chunk)
+        layer.index_strokes(first)
+        if layer.overview.tiles:
+            rect = QRect()
+            for i in range(first, len(store)):
+                rect = rect.united(store.bounding_rect(i))
+            layer.overview.invalidate(rect)
+        if not layer.visible:
+            return
+        painter = QPainter(layer.image)
+        self.apply_view(painter)
+        store.draw(painter, range(first, len(store)), min_size=1 / self.zoom if self.zoom < 1 else 0)
+        painter.end()
+        self.count_drawn(store, range(first, len(store)))
+        self.update()
+
+    def loading_finished(self):
+        if self.instruments.enabled:
+            self.instruments.record("load_s", time.perf_counter() - self.load_started)
+        self.temp_file_path = self.loader.file_path
+        self.dirty = False
+        self.previous_drawing = None
+        self.stop_loader()
+        self.remember_loaded_file(self.temp_file_path)
+        self.journal.start(self.temp_file_path)
+        self.history.clear()
+        self.update_title()
+        self.statusBar().showMessage(f"Opened {self.temp_file_path}", 3000)
+
+    def loading_failed(self, message):
+        self.cancel_loading()
+        QMessageBox.warning(self, "Open Drawing", f"Could not open the drawing: {message}")
+
+    ## Abandon a running load and restore the drawing that was open before it
+    def cancel_loading(self):
+        if self.loader is None:
+            return
+        self.loader.cancelled = True
+        self.stop_loader()
+        self.layers, self.layer, self.temp_file_path, self.dirty, zoom, origin, size = self.previous_drawing
+        self.previous_drawing = None
+        self.update_title()
+        self.statusBar().clearMessage()
+        ## The kept layer images show the view as it was when loading started
+        if (zoom != self.zoom or origin != self.view_origin or self.width() > size.width()
+                or self.height() > size.height()):
+            self.rebuild_canvas()
+        else:
+            self.view_size = size
         self.update()
 
+    def stop_loader(self):
+        ## Chunks still queued from the worker must not reach the canvas any more
+        self.loader.layers_found.disconnect()
+        self.loader.chunk_loaded.disconnect()
+        self.loader.progress.disconnect()
+        self.loader.finished.disconnect()
+        self.loader.failed.disconnect()
+        self.loader_thread.quit()
+        self.loader_thread.wait()
+        self.loader.deleteLater()
+        self.loader_thread.deleteLater()
+        self.loader = None
+        self.loader_thread = None
+        self.progress_bar.hide()
+        self.cancel_load_button.hide()
+
+    def load_drawing(self, file_path):
+        start = time.perf_counter()
+        self.clear_selection()
+        self.layers = [Layer(name, store, visible) for name, visible, store in read_drawing_layers(file_path)]
+        self.layer = self.layers[-1]
+        self.remember_loaded_file(file_path)
+        self.rebuild_index()
+        self.rebuild_canvas()
+        if self.instruments.enabled:
+            self.instruments.record("load_s", time.perf_counter() - start)
+
+    ## A freshly read binary drawing matches its file stroke for stroke, so saving it back can append. Text files are
+    ## converted by the first save.
+    def remember_loaded_file(self, file_path):
+        self.saved_file = None
+        if is_binary_drawing(file_path):
+            for layer in self.layers:
+                layer.store.mark_unchanged()
+            self.remember_saved_file(file_path, self.layer_layout())
+
+    ## Replay the journal of a session that did not exit cleanly: reopen its base file and redo the unsaved strokes and
+    ## layer changes. When the base file cannot be read any more the edits have nothing to apply to; the journal is then
+    ## moved aside, so that it is neither lost nor tried again on every start, and the window starts empty.
     def load_temp_drawing(self):
-        if self.temp_file_path and os.path.exists(self.temp_file_path):
-            with open(self.temp_file_path, 'r') as f:
-                self.lines = []
-                for line in f:
-                    parts = line.strip().split(',')
-                    start = QPoint(int(parts[0]), int(parts[1]))
-                    end = QPoint(int(parts[2]), int(parts[3]))
-                    color = QColor(parts[4])
-                    width = int(parts[5])
-                    self.lines.append((start, end, color, width))
-            self.update()
+        base_path, entries = read_journal(self.journal.path)
+        if not entries:
+            self.journal.start(None)
+            return
+        self.temp_file_path = base_path if base_path and os.path.exists(base_path) else None
+        if self.temp_file_path:
+            try:
+                layers = read_drawing_layers(self.temp_file_path)
+            except (OSError, ValueError) as error:
+                self.temp_file_path = None
+                aside = self.journal.path + ".unrecovered"
+                os.replace(self.journal.path, aside)
+                self.journal.start(None)
+                QMessageBox.warning(self, "Recover Drawing", f"Unsaved edits from an earlier session could not be "
+                                    f"recovered: {error}\nThey were kept in {aside}.")
+                return
+            self.layers = [Layer(name, store, visible) for name, visible, store in layers]
+            self.remember_loaded_file(self.temp_file_path)
+        target = 0
+        for entry in entries:
+            kind = entry[0]
+            if kind == "L":
+                target = entry[1]
+            elif kind == "A":
+                self.layers.insert(entry[1], Layer(entry[2]))
+            elif kind == "K":
+                for layer in self.layers:
+                    layer.store = layer.store.compacted()
+            elif kind in ("D", "M", "V", "N"):
+                if entry[1] >= len(self.layers):
+                    continue
+                if kind == "D":
+                    del self.layers[entry[1]]
+                elif kind == "M":
+                    self.layers.insert(entry[2], self.layers.pop(entry[1]))
+                elif kind == "V":
+                    self.layers[entry[1]].visible = entry[2]
+                else:
+                    self.layers[entry[1]].name = entry[2]
+            elif target < len(self.layers):
+                store = self.layers[target].store
+                if kind == "S":
+                    store.add_stroke_coordinates(*entry[1:])
+                elif kind == "U" and store:
+                    store.remove_last_stroke()
+                elif kind == "E":
+                    store.erase([cut for cut in entry[1] if cut[0] < len(store)])
+                elif kind == "R":
+                    store.restore(entry[1])
+                elif kind == "T":
+                    store.translate([i for i in entry[3] if i < len(store)], entry[1], entry[2])
+        if not self.layers:
+            self.layers = [Layer(FIRST_LAYER_NAME)]
+        self.layer = self.layers[min(target, len(self.layers) - 1)]
+        self.journal.resume(target)
+        self.rebuild_index()
+        self.rebuild_canvas()
+        self.mark_dirty()
+        self.statusBar().showMessage(f"Recovered {len(entries)} unsaved edits", 5000)
 
     def closeEvent(self, event):
-        if self.dirty:
-            response = QMessageBox.question(self, "Save Changes?", "Do you want to save the current drawing?",
-                                            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No | QMessageBox.StandardButton.Cancel)
-            if response == QMessageBox.StandardButton.Yes:
-                self.save_drawing()
-            elif response == QMessageBox.StandardButton.Cancel:
-                event.ignore()
-                return
+        ## A drawing still being opened is given up; the question is about the one it would have replaced
+        self.cancel_loading()
+        ## Unless the drawing was saved or let go, the window stays open and keeps the journal
+        if not self.confirm_discard():
+            event.ignore()
+            return
+        self.wait_for_saves()
+        ## The user has dealt with the unsaved work, by saving it or by letting it go
+        self.journal.discard()
+        self.journal.release()
         event.accept()
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+import math
+
+from PyQt6.QtCore import QRect
+
+
+def segment_margin(width):
+    return width // 2 + 2
+
+
+## Bounding rectangle of a segment, inflated by half the pen width plus a little slack for caps and antialiasing
+def segment_rect(start, end, width):
+    margin = segment_margin(width)
+    return QRect(start, end).normalized().adjusted(-margin, -margin, margin, margin)
+
+
+def point_segment_distance_sq(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq:
+        t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+        ax, ay = ax + t * dx, ay + t * dy
+    return (px - ax) ** 2 + (py - ay) ** 2
+
+
+## Parameter range {t: low <= p + q * t <= high}, unbounded when q is 0, None when empty
+def _linear_range(p, q, low, high):
+    if q == 0:
+        return (-math.inf, math.inf) if low <= p <= high else None
+    t0, t1 = (low - p) / q, (high - p) / q
+    return min(t0, t1), max(t0, t1)
+
+
+## Parameter range of the line c + t * direction lying within radius of the point p
+def _disk_range(cx, cy, direction_x, direction_y, px, py, radius):
+    a = direction_x * direction_x + direction_y * direction_y
+    b = direction_x * (cx - px) + direction_y * (cy - py)
+    c = (cx - px) ** 2 + (cy - py) ** 2 - radius * radius
+    if a == 0:
+        return (-math.inf, math.inf) if c <= 0 else None
+    discriminant = b * b - a * c
+    if discriminant < 0:
+        return None
+    root = math.sqrt(discriminant)
+    return (-b - root) / a, (-b + root) / a
+
+
+## Part of the segment c-d within radius of the segment a-b, as a parameter range (t0, t1) with 0 <= t0 <= t1 <= 1
+## along c-d, or None when they stay further apart. The area around a-b is a capsule, two end disks and the band
+## between them; it is convex, so the part of c-d inside it is a single range spanning the three pieces.
+def capsule_range(cx, cy, dx, dy, ax, ay, bx, by, radius):
+    direction_x, direction_y = dx - cx, dy - cy
+    ranges = [_disk_range(cx, cy, direction_x, direction_y, ax, ay, radius),
+              _disk_range(cx, cy, direction_x, direction_y, bx, by, radius)]
+    ux, uy = bx - ax, by - ay
+    length_sq = ux * ux + uy * uy
+    if length_sq:
+        along = _linear_range((cx - ax) * ux + (cy - ay) * uy, direction_x * ux + direction_y * uy, 0, length_sq)
+        reach = radius * math.sqrt(length_sq)
+        across = _linear_range(ux * (cy - ay) - uy * (cx - ax), ux * direction_y - uy * direction_x, -reach, reach)
+        if along and across and max(along[0], across[0]) <= min(along[1], across[1]):
+            ranges.append((max(along[0], across[0]), min(along[1], across[1])))
+    ranges = [r for r in ranges if r is not None]
+    if not ranges:
+        return None
+    t0, t1 = max(0.0, min(r[0] for r in ranges)), min(1.0, max(r[1] for r in ranges))
+    return (t0, t1) if t0 <= t1 else None
+
+
+## True when c continues the straight run a -> b in the same direction, so b adds nothing to the polyline
+def continues_straight(ax, ay, bx, by, cx, cy):
+    return (bx - ax) * (cy - by) == (by - ay) * (cx - bx) and (bx - ax) * (cx - bx) + (by - ay) * (cy - by) > 0
+
+
+## Ramer-Douglas-Peucker over a flat (x0, y0, x1, y1, ...) coordinate sequence. Returns the kept coordinates in the
+## same flat layout; the first and last points always survive.
+def simplify_polyline(coordinates, tolerance):
+    count = len(coordinates) // 2
+    if count < 3 or tolerance <= 0:
+        return list(coordinates)
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay, bx, by = coordinates[2 * first], coordinates[2 * first + 1], coordinates[2 * last], coordinates[2 * last + 1]
+        farthest, farthest_sq = -1, tolerance_sq
+        for i in range(first + 1, last):
+            distance_sq = point_segment_distance_sq(coordinates[2 * i], coordinates[2 * i + 1], ax, ay, bx, by)
+            if distance_sq > farthest_sq:
+                farthest, farthest_sq = i, distance_sq
+        if farthest >= 0:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [coordinate for i in range(count) if keep[i] for coordinate in (coordinates[2 * i], coordinates[2 * i + 1])]
@@ -0,0 +1,70 @@
+import time
+
+from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtGui import QGuiApplication
+
+## Used when the screen does not report its refresh rate
+DEFAULT_FRAME_RATE = 60
+
+
+## Coalesces mouse samples to the display's frame rate. A sample arriving while the input is idle is handled right
+## away, so the first one costs no latency; after that samples are queued and handed to process(samples) as one batch
+## per frame tick, and the timer stops at the first tick without input. Qt widgets have no vsync callback, so ticks
+## follow a precise timer at the screen's refresh rate, which update() then folds into the next paint.
+class InputBatch:
+    def __init__(self, parent, process, frame_rate=None):
+        self.process = process
+        self.pending = []
+        self.timer = QTimer(parent)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.last_tick = None
+        ## Batches processed, samples received, and frame ticks missed because a tick came too late
+        self.frames = 0
+        self.samples = 0
+        self.frames_dropped = 0
+        self.set_frame_rate(frame_rate)
+
+    ## Frames per second, or None for the refresh rate of the primary screen
+    def set_frame_rate(self, frame_rate=None):
+        if not frame_rate:
+            screen = QGuiApplication.primaryScreen()
+            frame_rate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else DEFAULT_FRAME_RATE
+        self.frame_rate = frame_rate
+        self.interval = 1 / frame_rate
+        self.timer.setInterval(max(1, round(1000 / frame_rate)))
+
+    def add(self, sample):
+        self.samples += 1
+        if self.timer.isActive():
+            self.pending.append(sample)
+            return
+        self.last_tick = time.perf_counter()
+        self.timer.start()
+        self.frames += 1
+        self.process([sample])
+
+    def tick(self):
+        now = time.perf_counter()
+        missed = int((now - self.last_tick) / self.interval + 0.5) - 1
+        if missed > 0:
+            self.frames_dropped += missed
+        self.last_tick = now
+        if not self.pending:
+            self.timer.stop()
+            return
+        self.flush()
+
+    ## Process whatever is queued now, e.g. before the button is released
+    def flush(self):
+        if self.pending:
+            samples = self.pending
+            self.pending = []
+            self.frames += 1
+            self.process(samples)
+
+    ## Drop queued samples and counters
+    def reset(self):
+        self.pending = []
+        self.timer.stop()
+        self.frames = self.samples = self.frames_dropped = 0
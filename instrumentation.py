@@ -0,0 +1,81 @@
+import csv
+import json
+from array import array
+
+## Series recorded by the drawing window:
+##   frame_ms            time spent in paintEvent
+##   input_ms            time spent handling the mouse moves of one frame
+##   latency_ms          from the first unpainted mouse move to the end of the paintEvent showing it
+##   segments_per_frame  segments rasterized between two paints
+##   load_s, save_s      opening and saving a drawing, start to finish
+SERIES = ("frame_ms", "input_ms", "latency_ms", "segments_per_frame", "load_s", "save_s")
+
+
+## Fixed-capacity buffer of floats that overwrites its oldest samples, so recording never allocates
+class RingBuffer:
+    def __init__(self, capacity):
+        self.samples = array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.next = 0
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    ## Samples oldest first
+    def values(self):
+        if self.count < self.capacity:
+            return self.samples[:self.count].tolist()
+        return (self.samples[self.next:] + self.samples[:self.next]).tolist()
+
+
+## Opt-in timings for the hot paths. Callers check enabled before taking any timestamp, so a disabled instance costs
+## one attribute test per hook. Counters accumulate between frames and land in a series when the frame ends.
+class Instrumentation:
+    def __init__(self, capacity=1024, enabled=False):
+        self.enabled = enabled
+        self.buffers = {name: RingBuffer(capacity) for name in SERIES}
+        self.counters = {}
+
+    def record(self, name, value):
+        self.buffers[name].add(value)
+
+    def count(self, name, amount):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    ## Move an accumulated counter into its series and reset it
+    def flush_count(self, name):
+        self.record(name, self.counters.pop(name, 0))
+
+    def clear(self):
+        for name, buffer in self.buffers.items():
+            self.buffers[name] = RingBuffer(buffer.capacity)
+        self.counters = {}
+
+    ## p50/p95/p99, mean and max of each series that has samples, nearest-rank percentiles
+    def summary(self):
+        summary = {}
+        for name, buffer in self.buffers.items():
+            values = sorted(buffer.values())
+            if not values:
+                continue
+            rank = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+            summary[name] = {"count": len(values), "p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99),
+                             "mean": sum(values) / len(values), "max": values[-1]}
+        return summary
+
+    ## Write the summary and every raw sample; CSV when the file name ends in .csv, JSON otherwise
+    def dump(self, file_path):
+        if file_path.lower().endswith(".csv"):
+            with open(file_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(("series", "sample", "value"))
+                for name, buffer in self.buffers.items():
+                    for i, value in enumerate(buffer.values()):
+                        writer.writerow((name, i, value))
+        else:
+            with open(file_path, 'w') as f:
+                json.dump({"summary": self.summary(),
+                           "samples": {name: buffer.values() for name, buffer in self.buffers.items()}}, f, indent=1)
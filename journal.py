@@ -0,0 +1,179 @@
+import os
+from array import array
+from itertools import chain, count
+
+from PyQt6.QtCore import QLockFile
+from PyQt6.QtGui import QColor
+
+
+## Append-only log of edits made since the drawing was last opened or saved, used to recover unsaved work after a crash.
+## Line based, one entry per line:
+##   B,<path>                      base file the edits apply to (empty for a new drawing); always the first line
+##   S,<argb>,<width>,x0,y0,...     a committed stroke
+##   U                              the newest stroke was removed (undo)
+##   E,i,k,t0,t1,...                the eraser cut the range t0..t1 out of segment k of stroke i, one group per cut
+##   R,i,k,t0,t1,...                those cuts were taken back (undo of an erase)
+##   T,dx,dy,i,...                  strokes i, ... were moved by (dx, dy)
+##   K                              every layer was compacted as a save writes it, renumbering the strokes
+##   L,<layer>                      S, U, E, R and T entries after it apply to the layer at that position (bottom is 0)
+##   A,<layer>,<name>               an empty layer was inserted at that position
+##   D,<layer>                      the layer at that position was deleted
+##   M,<layer>,<to>                 the layer at that position was moved to another one
+##   V,<layer>,<0|1>                the layer was hidden or shown
+##   N,<layer>,<name>               the layer was renamed
+## Until the first L entry, stroke and cut entries apply to layer 0. Layer positions are taken as they stand when an
+## entry is replayed, so they follow the same inserts, deletes and moves that the drawing went through.
+## Entries are buffered and appended in small batches by flush(), so the cost follows the edits, not the drawing size.
+## A torn last line from a crash is ignored on replay.
+class DrawingJournal:
+    def __init__(self, path, lock=None):
+        self.path = path
+        ## QLockFile held while this journal belongs to a running window, see claim_journal()
+        self.lock = lock
+        self.pending = []
+        self.size = 0
+        ## Layer position the stroke and cut entries currently apply to
+        self.layer = 0
+
+    ## Begin a fresh journal for the drawing at base_path (None for an unsaved drawing)
+    def start(self, base_path):
+        self.pending = []
+        self.layer = 0
+        self.write_file(f"B,{base_path or ''}\n".encode())
+
+    ## Keep appending to a journal left behind by an earlier session, whose replay ended on the given layer
+    def resume(self, layer=0):
+        self.pending = []
+        self.layer = layer
+        self.size = os.path.getsize(self.path)
+
+    def record(self, entry):
+        self.pending.append(entry.encode() + b"\n")
+
+    def record_stroke(self, store, i):
+        begin, end = store.stroke_range(i)
+        coordinates = ",".join(map(str, store.points[2 * begin:2 * end]))
+        self.record(f"S,{store.palette[store.colors[i]].rgba():08x},{store.widths[i]},{coordinates}")
+
+    def record_cuts(self, kind, cuts):
+        self.record(kind + "," + ",".join(f"{i},{k},{t0!r},{t1!r}" for i, k, t0, t1 in cuts))
+
+    def record_move(self, indices, dx, dy):
+        self.record(f"T,{dx},{dy}," + ",".join(map(str, indices)))
+
+    ## Direct the stroke and cut entries that follow at the layer at position
+    def select_layer(self, position):
+        if position != self.layer:
+            self.layer = position
+            self.record(f"L,{position}")
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        self.pending = []
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(data)
+
+    ## Logical end of the journal, including entries not flushed yet, and the layer selected there
+    def mark(self):
+        return self.size + sum(len(entry) for entry in self.pending), self.layer
+
+    ## After the drawing was saved to base_path as it stood at mark, keep only the entries recorded after mark
+    def rebase(self, base_path, mark):
+        offset, layer = mark
+        self.flush()
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            tail = f.read()
+        head = f"B,{base_path or ''}\n" + (f"L,{layer}\n" if layer else "")
+        self.write_file(head.encode() + tail)
+
+    def discard(self):
+        self.pending = []
+        self.size = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    ## Let another session have the journal, e.g. once the window has closed
+    def release(self):
+        if self.lock is not None:
+            self.lock.unlock()
+            self.lock = None
+
+    def write_file(self, data):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.size = len(data)
+
+
+## Numbers n of the journals <prefix>.<n> that exist, lowest first
+def journal_slots(prefix):
+    directory, name = os.path.split(os.path.abspath(prefix))
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(int(entry[len(name) + 1:]) for entry in entries
+                  if entry.startswith(name + ".") and entry[len(name) + 1:].isdigit())
+
+
+## The journal for a new session: <prefix>.<n> for the first n that no running instance holds, trying the journals
+## that exist first so that one left behind by a crash is replayed. Each is guarded by a QLockFile next to it; a lock
+## whose process has died is taken over, so only a live window keeps others away from its journal.
+def claim_journal(prefix):
+    for n in chain(journal_slots(prefix), count()):
+        lock = QLockFile(f"{prefix}.{n}.lock")
+        lock.setStaleLockTime(0)
+        if lock.tryLock(0):
+            return DrawingJournal(f"{prefix}.{n}", lock)
+
+
+## Read a journal back as (base path or None, entries). Entries are ("S", coordinates, color, width) for a stroke,
+## ("U",) for removing the newest one, ("E", cuts) / ("R", cuts) for made and undone (stroke, segment, t0, t1) cuts
+## ("T", dx, dy, strokes) for moved strokes and ("K",) for compacted layers; layer entries are ("L", layer), ("A", layer, name), ("D", layer),
+## ("M", layer, to), ("V", layer, visible) and ("N", layer, name). (None, []) when there is nothing to replay.
+def read_journal(path):
+    if not os.path.exists(path):
+        return None, []
+    with open(path, 'rb') as f:
+        data = f.read()
+    base_path, entries = None, []
+    for raw in data.split(b"\n")[:-1]:
+        entry = raw.decode(errors="replace")
+        kind, _, rest = entry.partition(",")
+        try:
+            if kind == "B":
+                base_path = rest or None
+            elif kind == "S":
+                parts = rest.split(",")
+                coordinates = array('i', map(int, parts[2:]))
+                if len(coordinates) >= 2 and len(coordinates) % 2 == 0:
+                    entries.append(("S", coordinates, QColor.fromRgba(int(parts[0], 16)), int(parts[1])))
+            elif kind in ("U", "K"):
+                entries.append((kind,))
+            elif kind == "T":
+                parts = list(map(int, rest.split(",")))
+                entries.append(("T", parts[0], parts[1], parts[2:]))
+            elif kind in ("L", "D"):
+                entries.append((kind, int(rest)))
+            elif kind in ("A", "N"):
+                layer, _, name = rest.partition(",")
+                entries.append((kind, int(layer), name))
+            elif kind in ("M", "V"):
+                layer, _, value = rest.partition(",")
+                entries.append((kind, int(layer), int(value) if kind == "M" else value == "1"))
+            elif kind in ("E", "R"):
+                parts = rest.split(",")
+                entries.append((kind, [(int(parts[j]), int(parts[j + 1]), float(parts[j + 2]), float(parts[j + 3]))
+                                       for j in range(0, len(parts) - 3, 4)]))
+        except (ValueError, IndexError):
+            continue
+    return base_path, entries
@@ -0,0 +1,67 @@
+from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QImage, QPainter
+
+from geometry import segment_margin
+from overview_cache import OverviewCache
+from spatial_index import SpatialGrid
+from stroke_store import StrokeStore
+
+
+## One layer of a vector drawing: its strokes with their own spatial index and overview tiles, plus a rendering of
+## the current view on a transparent, window-sized image. An edit re-renders only its own layer's image and the window
+## stacks the images of the visible layers when it paints, so hiding, showing or reordering a layer draws no strokes,
+## and the cost of an edit follows the size of its layer rather than of the whole drawing.
+class Layer:
+    def __init__(self, name, store=None, visible=True):
+        self.name = name
+        self.visible = visible
+        self.store = store if store is not None else StrokeStore()
+        self.index = SpatialGrid()
+        self.overview = OverviewCache()
+        self.image = QImage()
+        ## The image shows an older view, or nothing yet; a hidden layer is only brought up to date when shown again
+        self.stale = True
+        ## Strokes left out of the image and overview tiles while the selection tool drags them around
+        self.lifted = set()
+
+    def rebuild_index(self):
+        self.overview.clear()
+        self.index.clear()
+        self.index_strokes(0)
+
+    ## Add the segments of strokes first onwards to the index
+    def index_strokes(self, first):
+        for i in range(first, len(self.store)):
+            self.index_stroke(i)
+
+    def index_stroke(self, i):
+        store = self.store
+        begin, end = store.stroke_range(i)
+        self.index.insert_polyline(i, store.points[2 * begin:2 * end], segment_margin(store.widths[i]))
+
+    ## Index cells that index_stroke(i) put stroke i into, as long as its points have not changed since
+    def stroke_cells(self, i):
+        store = self.store
+        begin, end = store.stroke_range(i)
+        return self.index.polyline_cells(store.points[2 * begin:2 * end], segment_margin(store.widths[i]))
+
+    def unindex_stroke(self, i):
+        self.index.remove_items({i}, self.stroke_cells(i))
+
+    ## Start the view image over, blank, at size (device-independent pixels) and pixel ratio
+    def reset_image(self, size, ratio):
+        self.image = QImage(size * ratio, QImage.Format.Format_ARGB32_Premultiplied)
+        self.image.setDevicePixelRatio(ratio)
+        self.image.fill(Qt.GlobalColor.transparent)
+        self.stale = False
+
+    ## Blank the window area rect of the image before it is rendered again
+    def clear_region(self, rect):
+        painter = QPainter(self.image)
+        painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+        painter.fillRect(rect, Qt.GlobalColor.transparent)
+        painter.end()
+
+    ## Layer as draw_format reads and writes it
+    def saved(self):
+        return self.name, self.visible, self.store
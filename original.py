@@ -1,16 +1,36 @@
 import sys
 from PyQt6.QtWidgets import QApplication, QMainWindow, QFileDialog, QMessageBox, QWidget, QVBoxLayout
-from PyQt6.QtGui import QPainter, QPen, QColor, QAction
-from PyQt6.QtCore import Qt, QPoint
+from PyQt6.QtGui import QPainter, QAction
+from PyQt6.QtCore import Qt, QRect
+from geometry import segment_rect
+from spatial_index import SpatialGrid
+from stroke_store import StrokeStore
+from draw_format import read_drawing
+from undo import UndoStack, AddStrokeCommand
+from input_batch import InputBatch
 
 class DrawingProgram(QMainWindow):
     def __init__(self):
         super().__init__()
         self.initUI()
-        self.lines = []
+        self.lines = StrokeStore()
+        self.index = SpatialGrid()
+        self.history = UndoStack()
+        ## Index of the stroke being drawn, None between strokes
+        self.live_stroke = None
+        self.stroke_samples = 0
+        self.stroke_rect = QRect()
+        ## Ramer-Douglas-Peucker tolerance in pixels applied when a stroke is released, 0 keeps every sample
+        self.simplify_tolerance = 1.0
+        ## Running totals of segments received from the mouse and actually stored after simplification
+        self.simplify_stats = {"segments_in": 0, "segments_out": 0}
         self.current_color = Qt.GlobalColor.black
         self.dirty = False
         self.file_path = None
+        ## Repaint only the region touched by the newest segment instead of the whole window
+        self.partial_updates = True
+        ## Mouse moves are queued and handled once per display frame
+        self.input_batch = InputBatch(self, self.process_moves)
         self.setStyleSheet("QMainWindow { background-color:white; }")
 
     def initUI(self):
@@ -28,6 +48,7 @@ class DrawingProgram(QMainWindow):
         menubar = self.menuBar()
         file_menu = menubar.addMenu('File')
         color_menu = menubar.addMenu('Color')
+        edit_menu = menubar.addMenu('Edit')
 
         ## File menu actions
         new_action = QAction('New', self)
@@ -55,6 +76,17 @@ class DrawingProgram(QMainWindow):
         exit_action.triggered.connect(self.close)
         file_menu.addAction(exit_action)
 
+        ## Edit menu actions
+        undo_action = QAction('Undo', self)
+        undo_action.setShortcut("Ctrl+Z")
+        undo_action.triggered.connect(self.undo)
+        edit_menu.addAction(undo_action)
+
+        redo_action = QAction('Redo', self)
+        redo_action.setShortcuts(["Ctrl+Y", "Ctrl+Shift+Z"])
+        redo_action.triggered.connect(self.redo)
+        edit_menu.addAction(redo_action)
+
         ## Color menu actions
         black_action = QAction('Black', self)
         black_action.setShortcut("1")
@@ -81,26 +113,89 @@ class DrawingProgram(QMainWindow):
         white_action.triggered.connect(lambda: self.set_color(Qt.GlobalColor.white))
         color_menu.addAction(white_action)
 
+    def line_width(self, color):
+        return 12 if color == Qt.GlobalColor.white else 3
+
     def paintEvent(self, event):
         painter = QPainter(self)
-        for line in self.lines:
-            if line[2] == Qt.GlobalColor.white:
-                painter.setPen(QPen(line[2], 12, Qt.PenStyle.SolidLine))  # Set pen width to 9 for white color
-            else:
-                painter.setPen(QPen(line[2], 3, Qt.PenStyle.SolidLine))  # Set pen width to 3 for other colors
-            painter.drawLine(line[0], line[1])
+        self.lines.draw(painter, self.index.query(event.rect()))
 
     def mousePressEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
             self.last_point = event.pos()
+            self.live_stroke = None
+            self.stroke_samples = 0
+            self.stroke_rect = QRect()
 
     def mouseMoveEvent(self, event):
         if event.buttons() & Qt.MouseButton.LeftButton:
-            new_point = event.pos()
-            self.lines.append((self.last_point, new_point, self.current_color))
+            self.input_batch.add(event.pos())
+
+    ## Add the mouse positions queued since the last frame to the stroke and repaint the area they cover once
+    def process_moves(self, positions):
+        width = self.line_width(self.current_color)
+        dirty = QRect()
+        for new_point in positions:
+            self.stroke_samples += 1
+            ## The first move of a press opens a stroke, later moves extend it unless they repeat or straighten the last point
+            if self.live_stroke is None:
+                self.live_stroke = self.lines.add_stroke((self.last_point, new_point), self.current_color, width)
+            elif not self.lines.add_sample(new_point):
+                continue
+            rect = segment_rect(self.last_point, new_point, width)
+            self.index.insert(self.live_stroke, rect)
+            dirty = dirty.united(rect)
             self.last_point = new_point
-            self.update()
             self.dirty = True
+        if dirty.isEmpty():
+            return
+        self.stroke_rect = self.stroke_rect.united(dirty)
+        if self.partial_updates:
+            self.update(dirty)
+        else:
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        self.input_batch.flush()
+        if event.button() == Qt.MouseButton.LeftButton and self.live_stroke is not None:
+            ## The stroke was indexed sample by sample, all inside stroke_rect; index what is left of it after simplifying
+            self.index.remove_items({self.live_stroke}, self.index.rect_cells(self.stroke_rect))
+            _, kept = self.lines.simplify_last_stroke(self.simplify_tolerance)
+            for rect in self.lines.segment_rects(self.live_stroke):
+                self.index.insert(self.live_stroke, rect)
+            stored = max(kept - 1, 1)
+            self.simplify_stats["segments_in"] += self.stroke_samples
+            self.simplify_stats["segments_out"] += stored
+            self.statusBar().showMessage(f"Stroke simplified from {self.stroke_samples} to {stored} segments", 3000)
+            self.update(self.stroke_rect)
+            self.history.push(AddStrokeCommand(self, self.live_stroke))
+            self.live_stroke = None
+
+    def undo(self):
+        if self.live_stroke is None:
+            self.history.undo()
+
+    def redo(self):
+        if self.live_stroke is None:
+            self.history.redo()
+
+    ## Undo of an added stroke: drop the newest stroke and repaint only the area it covered
+    def remove_last_stroke(self):
+        i = len(self.lines) - 1
+        rect = self.lines.bounding_rect(i)
+        for segment in self.lines.segment_rects(i):
+            self.index.remove(i, segment)
+        self.lines.remove_last_stroke()
+        self.update(rect)
+        self.dirty = True
+
+    ## Redo of an added stroke
+    def restore_stroke(self, coordinates, color, width):
+        i = self.lines.add_stroke_coordinates(coordinates, color, width)
+        for rect in self.lines.segment_rects(i):
+            self.index.insert(i, rect)
+        self.update(self.lines.bounding_rect(i))
+        self.dirty = True
 
     def set_color(self, color):
         self.current_color = color
@@ -112,7 +207,9 @@ class DrawingProgram(QMainWindow):
                 self.save_drawing()
             elif response == QMessageBox.StandardButton.Cancel:
                 return
-        self.lines = []
+        self.lines = StrokeStore()
+        self.index.clear()
+        self.history.clear()
         self.dirty = False
         self.file_path = None
         self.update()
@@ -146,19 +243,20 @@ class DrawingProgram(QMainWindow):
 
     def save_drawing_to_file(self, file_path):
         with open(file_path, 'w') as f:
-            for line in self.lines:
-                f.write(f"{line[0].x()},{line[0].y()},{line[1].x()},{line[1].y()},{line[2].name()}\n")
+            for start, end, color, width in self.lines.segments():
+                f.write(f"{start.x()},{start.y()},{end.x()},{end.y()},{color.name()}\n")
         self.update_title()
 
     def load_drawing(self, file_path):
-        self.lines = []
-        with open(file_path, 'r') as f:
-            for line in f:
-                parts = line.strip().split(',')
-                start = QPoint(int(parts[0]), int(parts[1]))
-                end = QPoint(int(parts[2]), int(parts[3]))
-                color = QColor(parts[4])
-                self.lines.append((start, end, color))
+        self.lines = read_drawing(file_path)
+        self.history.clear()
+        self.rebuild_index()
+
+    def rebuild_index(self):
+        self.index.clear()
+        for i in range(len(self.lines)):
+            for rect in self.lines.segment_rects(i):
+                self.index.insert(i, rect)
 
     def closeEvent(self, event):
         if self.dirty:
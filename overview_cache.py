@@ -0,0 +1,84 @@
+import math
+import time
+
+from PyQt6.QtCore import Qt, QRect, QRectF
+from PyQt6.QtGui import QImage, QPainter
+
+## Below this zoom factor views are composed from cached rasters instead of drawing strokes
+LOD_ZOOM = 0.5
+
+
+## Level-of-detail rasters of a drawing for zoomed-out views. Level n holds the drawing at scale 1/2^n, cut into square
+## tiles that are rendered on first sight and then reused, so panning and zooming around a huge drawing blits a few
+## cached images instead of drawing every segment again. Strokes smaller than a pixel at the tile's scale are drawn as
+## points. Edits drop the tiles they touch at every level. Tiles are transparent where there are no strokes, so the
+## overviews of several layers can be stacked.
+class OverviewCache:
+    def __init__(self, tile_size=256, frame_budget=0.030):
+        self.tile_size = tile_size
+        ## Seconds of tile rendering allowed per frame; tiles beyond it are left for the next pass
+        self.frame_budget = frame_budget
+        self.tiles = {}
+
+    ## Pyramid level for a zoom factor: 0 from LOD_ZOOM up, where the strokes are drawn directly, otherwise the finest
+    ## level whose scale still has at least as many pixels as the screen
+    @staticmethod
+    def level_for(zoom):
+        if zoom >= LOD_ZOOM:
+            return 0
+        return int(math.floor(math.log2(1 / zoom)))
+
+    ## World-space area covered by tile (column, row) of a level
+    def tile_world_rect(self, level, column, row):
+        span = self.tile_size << level
+        return QRect(column * span, row * span, span, span)
+
+    def clear(self):
+        self.tiles = {}
+
+    ## Forget every cached tile that overlaps world_rect
+    def invalidate(self, world_rect):
+        if not self.tiles or world_rect.isEmpty():
+            return
+        for key in [key for key in self.tiles if self.tile_world_rect(*key).intersects(world_rect)]:
+            del self.tiles[key]
+
+    ## Strokes in skip are left out, e.g. ones being dragged around on their own
+    def render_tile(self, store, index, level, column, row, skip=()):
+        rect = self.tile_world_rect(level, column, row)
+        indices = index.query(rect)
+        if skip:
+            indices = [i for i in indices if i not in skip]
+        tile = QImage(self.tile_size, self.tile_size, QImage.Format.Format_ARGB32_Premultiplied)
+        tile.fill(Qt.GlobalColor.transparent)
+        painter = QPainter(tile)
+        painter.scale(1 / (1 << level), 1 / (1 << level))
+        painter.translate(-rect.left(), -rect.top())
+        store.draw(painter, indices, min_size=1 << level)
+        painter.end()
+        self.tiles[(level, column, row)] = tile
+        return indices
+
+    ## Paint world_rect of the drawing onto painter, which maps world to window coordinates at the given zoom.
+    ## Missing tiles are rendered, without the strokes in skip, until the frame budget runs out and left blank after
+    ## that. Returns whether every tile was available, and the stroke indices rendered into new tiles.
+    def draw(self, painter, store, index, zoom, world_rect, skip=()):
+        level = self.level_for(zoom)
+        span = self.tile_size << level
+        deadline = time.perf_counter() + self.frame_budget
+        complete = True
+        drawn = []
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        for row in range(world_rect.top() // span, world_rect.bottom() // span + 1):
+            for column in range(world_rect.left() // span, world_rect.right() // span + 1):
+                tile = self.tiles.get((level, column, row))
+                if tile is None:
+                    if time.perf_counter() > deadline:
+                        complete = False
+                        continue
+                    drawn.extend(self.render_tile(store, index, level, column, row, skip))
+                    tile = self.tiles[(level, column, row)]
+                painter.drawImage(QRectF(self.tile_world_rect(level, column, row)), tile)
+        painter.restore()
+        return complete, drawn
@@ -0,0 +1,143 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt6.QtGui import QGuiApplication, QImage, QPainter, QColor
+from PyQt6.QtCore import QSize
+
+from draw_format import read_drawing
+
+## One QGuiApplication per worker process, created by the pool initializer
+app = None
+
+
+## Area a drawing covers, measured from the origin like the drawing window does, pen widths included
+def drawing_extent(store):
+    if not store:
+        return QSize(1, 1)
+    margin = max(store.widths) // 2 + 1
+    return QSize(max(store.points[0::2]) + margin, max(store.points[1::2]) + margin)
+
+
+## Render a stroke store into a new image. With a size, the drawing is scaled to fit inside it keeping its aspect
+## ratio; otherwise the image is the drawing's extent times scale.
+def render_drawing(store, size=None, scale=1.0, background=QColor("white")):
+    extent = drawing_extent(store)
+    if size is not None:
+        scale = min(size.width() / extent.width(), size.height() / extent.height())
+    else:
+        size = QSize(max(1, round(extent.width() * scale)), max(1, round(extent.height() * scale)))
+    image = QImage(size, QImage.Format.Format_ARGB32_Premultiplied)
+    image.fill(background)
+    painter = QPainter(image)
+    painter.scale(scale, scale)
+    store.draw(painter)
+    painter.end()
+    return image
+
+
+def start_worker():
+    global app
+    app = QGuiApplication.instance() or QGuiApplication([])
+
+
+## Pool task: render one file and write the image; returns (input path, output path, error message or None)
+def render_file(task):
+    file_path, output_path, options = task
+    try:
+        image = render_drawing(read_drawing(file_path), options["size"], options["scale"], QColor(options["background"]))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    except (OSError, ValueError) as error:
+        return file_path, output_path, str(error)
+    ## Whatever else a corrupt file trips over fails that file only, not the whole run
+    except Exception as error:
+        return file_path, output_path, f"{type(error).__name__}: {error}"
+    if not image.save(output_path, None, options["quality"]):
+        return file_path, output_path, "could not write image"
+    return file_path, output_path, None
+
+
+## .draw files named on the command line as (path, output name without extension); directories are searched
+## recursively and their files keep their path below the directory in the output name
+def collect_drawings(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.endswith(".draw"):
+                        file_path = os.path.join(directory, name)
+                        yield file_path, os.path.splitext(os.path.relpath(file_path, path))[0]
+        else:
+            yield path, os.path.splitext(os.path.basename(path))[0]
+
+
+## Image path for every drawing under directory; names that would still collide, e.g. the same file name given
+## twice or found in two directories, get a -2, -3, ... suffix
+def output_paths(drawings, directory, extension):
+    used = set()
+    for file_path, name in drawings:
+        candidate, number = name, 1
+        while os.path.normcase(candidate) in used:
+            number += 1
+            candidate = f"{name}-{number}"
+        used.add(os.path.normcase(candidate))
+        yield file_path, os.path.join(directory, candidate + "." + extension)
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    try:
+        size = QSize(int(width), int(height))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {text!r}")
+    if size.isEmpty():
+        raise argparse.ArgumentTypeError(f"size must be positive, got {text!r}")
+    return size
+
+
+def parse_color(text):
+    if not QColor.isValidColorName(text):
+        raise argparse.ArgumentTypeError(f"unknown colour {text!r}")
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render .draw files to PNG or JPEG images without a display.")
+    parser.add_argument("paths", nargs="+", help=".draw files or directories containing them")
+    parser.add_argument("-o", "--output", default=".", help="directory for the images (default: current directory)")
+    parser.add_argument("-f", "--format", choices=("png", "jpg"), default="png", help="image format (default: png)")
+    parser.add_argument("-s", "--size", type=parse_size, help="fit every drawing into WIDTHxHEIGHT, e.g. 256x192")
+    parser.add_argument("--scale", type=float, default=1.0, help="scale factor when no --size is given (default: 1)")
+    parser.add_argument("-b", "--background", type=parse_color, default="white",
+                        help="background colour name or #rrggbb, 'transparent' for PNG (default: white)")
+    parser.add_argument("-q", "--quality", type=int, default=-1, help="JPEG/PNG quality 0-100 (default: Qt's)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+    if args.scale <= 0:
+        parser.error("--scale must be positive")
+
+    os.makedirs(args.output, exist_ok=True)
+    options = {"size": args.size, "scale": args.scale, "background": args.background, "quality": args.quality}
+    tasks = [(file_path, output_path, options)
+             for file_path, output_path in output_paths(collect_drawings(args.paths), args.output, args.format)]
+
+    start = time.perf_counter()
+    failed = 0
+    ## Spawned workers start clean instead of inheriting Qt state through fork
+    with multiprocessing.get_context("spawn").Pool(max(1, args.jobs), initializer=start_worker) as pool:
+        for file_path, output_path, error in pool.imap_unordered(render_file, tasks, chunksize=8):
+            if error:
+                failed += 1
+                print(f"{file_path}: {error}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    rendered = len(tasks) - failed
+    print(f"Rendered {rendered} of {len(tasks)} drawings in {elapsed:.2f} s ({rendered / max(elapsed, 1e-9):.1f} files/s)")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+from PyQt6.QtCore import Qt, QPoint, QRect
+
+
+## Hit-testing for the selection tool. A stroke is selected when all of its points lie inside the region. Candidates
+## come from the spatial index over the region's bounding rectangle, so a selection costs O(strokes near the region)
+## rather than O(drawing); strokes the eraser has removed entirely are never selected.
+def strokes_in_rect(store, index, rect):
+    left, top, right, bottom = rect.left(), rect.top(), rect.right(), rect.bottom()
+    points = store.points
+    found = []
+    for i in index.query(rect):
+        begin, end = store.stroke_range(i)
+        xs, ys = points[2 * begin:2 * end:2], points[2 * begin + 1:2 * end:2]
+        if left <= min(xs) and max(xs) <= right and top <= min(ys) and max(ys) <= bottom and not erased_entirely(store, i):
+            found.append(i)
+    return found
+
+
+## polygon is a QPolygon in drawing coordinates, closed implicitly
+def strokes_in_polygon(store, index, polygon):
+    points = store.points
+    found = []
+    for i in strokes_in_rect(store, index, polygon.boundingRect()):
+        begin, end = store.stroke_range(i)
+        if all(polygon.containsPoint(QPoint(points[j], points[j + 1]), Qt.FillRule.OddEvenFill)
+               for j in range(2 * begin, 2 * end, 2)):
+            found.append(i)
+    return found
+
+
+def erased_entirely(store, i):
+    return i in store.erased and next(store.remaining_pieces(i), None) is None
+
+
+## Bounding rectangle of the given strokes, pen widths included
+def strokes_rect(store, indices):
+    rect = QRect()
+    for i in indices:
+        rect = rect.united(store.bounding_rect(i))
+    return rect
@@ -0,0 +1,92 @@
+
+## Uniform grid over segment bounding boxes, so a repaint only has to look at segments near the exposed area.
+## Items are plain integers (positions in the store); the grid does not know how they are stored.
+## An item can be inserted once per segment: consecutive inserts of the same item into a cell are collapsed.
+class SpatialGrid:
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cell_range(self, rect):
+        size = self.cell_size
+        return (rect.left() // size, rect.top() // size, rect.right() // size, rect.bottom() // size)
+
+    def insert(self, item, rect):
+        left, top, right, bottom = self._cell_range(rect)
+        cells = self.cells
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                bucket = cells.get((cx, cy))
+                if bucket is None:
+                    cells[(cx, cy)] = [item]
+                elif bucket[-1] != item:
+                    bucket.append(item)
+
+    ## Keys of the cells overlapping rect
+    def rect_cells(self, rect):
+        left, top, right, bottom = self._cell_range(rect)
+        return {(cx, cy) for cx in range(left, right + 1) for cy in range(top, bottom + 1)}
+
+    ## Keys of the cells under the polyline through coordinates (x0, y0, x1, y1, ...), each segment's box grown by
+    ## margin; a single point counts as one segment. Covers the cells of the segments' rectangles (a pixel more for
+    ## right-to-left segments, which QRect.normalized() shrinks) without building a QRect per segment.
+    def polyline_cells(self, coordinates, margin):
+        size = self.cell_size
+        keys = set()
+        xs, ys = coordinates[0::2], coordinates[1::2]
+        if len(xs) == 1:
+            xs, ys = xs * 2, ys * 2
+        for x0, y0, x1, y1 in zip(xs, ys, xs[1:], ys[1:]):
+            left, right = (x0 - margin) // size, (x1 + margin) // size
+            if x1 < x0:
+                left, right = (x1 - margin) // size, (x0 + margin) // size
+            top, bottom = (y0 - margin) // size, (y1 + margin) // size
+            if y1 < y0:
+                top, bottom = (y1 - margin) // size, (y0 + margin) // size
+            keys.update((cx, cy) for cx in range(left, right + 1) for cy in range(top, bottom + 1))
+        return keys
+
+    ## Insert item into the cells of polyline_cells(); take it out again with remove_items() over the same cells
+    def insert_polyline(self, item, coordinates, margin):
+        cells = self.cells
+        for key in self.polyline_cells(coordinates, margin):
+            bucket = cells.get(key)
+            if bucket is None:
+                cells[key] = [item]
+            elif bucket[-1] != item:
+                bucket.append(item)
+
+    def remove(self, item, rect):
+        left, top, right, bottom = self._cell_range(rect)
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                bucket = self.cells.get((cx, cy))
+                if bucket and item in bucket:
+                    bucket[:] = [other for other in bucket if other != item]
+                    if not bucket:
+                        del self.cells[(cx, cy)]
+
+    ## Take a set of items out of the cells with the given keys in one pass, e.g. many strokes that are about to move
+    def remove_items(self, items, keys):
+        cells = self.cells
+        for key in keys:
+            bucket = cells.get(key)
+            if bucket:
+                bucket[:] = [other for other in bucket if other not in items]
+                if not bucket:
+                    del cells[key]
+
+    ## Items whose cells overlap rect, in insertion (z-)order. May include items that only share a cell with rect.
+    def query(self, rect):
+        left, top, right, bottom = self._cell_range(rect)
+        found = set()
+        cells = self.cells
+        for cx in range(left, right + 1):
+            for cy in range(top, bottom + 1):
+                bucket = cells.get((cx, cy))
+                if bucket:
+                    found.update(bucket)
+        return sorted(found)
+
+    def clear(self):
+        self.cells = {}
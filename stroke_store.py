@@ -0,0 +1,408 @@
+from array import array
+
+from PyQt6.QtCore import Qt, QPoint, QLine
+from PyQt6.QtGui import QColor, QPen, QPolygon
+
+from geometry import segment_rect, capsule_range, continues_straight, simplify_polyline
+
+
+## Sorted, non-overlapping union of (t0, t1) ranges
+def merge_ranges(ranges):
+    merged = []
+    for t0, t1 in sorted(ranges):
+        if merged and t0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], t1))
+        else:
+            merged.append((t0, t1))
+    return merged
+
+
+## Parts of [0, 1] not covered by the given cut ranges
+def kept_ranges(cuts):
+    kept, position = [], 0.0
+    for t0, t1 in merge_ranges(cuts):
+        if t0 > position:
+            kept.append((position, t0))
+        position = max(position, t1)
+    if position < 1.0:
+        kept.append((position, 1.0))
+    return kept
+
+
+## Column-oriented store of strokes, one polyline per press/release cycle.
+## Points of all strokes sit back to back in one packed int32 array (x0, y0, x1, y1, ...); each stroke keeps the index
+## of its first point, a uint16 index into a small colour palette and a uint16 width. Shared endpoints are stored once,
+## so a freehand stroke costs 8 bytes per segment instead of two full endpoints.
+class StrokeStore:
+    def __init__(self):
+        self.points = array('i')
+        self.starts = array('I')
+        self.colors = array('H')
+        self.widths = array('H')
+        self.palette = []
+        self.palette_lookup = {}
+        self.pens = {}
+        ## Parts cut out by the eraser, as stroke index -> {segment number: [(t0, t1), ...]} where segment k joins the
+        ## stroke's points k and k + 1 (a single-point stroke has just segment 0) and each (t0, t1) is a cut range along
+        ## it. Stroke indexes stay put, so the spatial index, z-order and undo are unaffected; compacted() turns what is
+        ## left into plain strokes when the drawing is written.
+        self.erased = {}
+        ## Strokes before this index are unchanged since mark_unchanged(); appending strokes leaves it alone, anything
+        ## that alters, removes or erases an existing stroke lowers it. Lets a save append instead of rewriting.
+        self.changed_from = 0
+
+    ## Adopt ready-made columns, e.g. straight from a binary file, without going through add_stroke
+    def set_columns(self, points, starts, colors, widths, palette):
+        self.points, self.starts, self.colors, self.widths = points, starts, colors, widths
+        self.palette = list(palette)
+        self.palette_lookup = {color.rgba(): i for i, color in enumerate(self.palette)}
+        self.pens = {}
+        self.erased = {}
+        self.changed_from = 0
+
+    def mark_unchanged(self):
+        self.changed_from = len(self.starts)
+
+    ## Record that stroke i was altered in place
+    def changed(self, i):
+        if i < self.changed_from:
+            self.changed_from = i
+
+    ## Independent copy of the columns; cheap enough to snapshot a drawing before handing it to another thread
+    def copy(self):
+        store = StrokeStore()
+        store.set_columns(self.points[:], self.starts[:], self.colors[:], self.widths[:], self.palette)
+        store.erased = {i: {k: cuts[:] for k, cuts in segments.items()} for i, segments in self.erased.items()}
+        return store
+
+    ## Palette slot for a QColor or Qt.GlobalColor, adding it on first use
+    def color_index(self, color):
+        color = QColor(color)
+        rgba = color.rgba()
+        index = self.palette_lookup.get(rgba)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(color)
+            self.palette_lookup[rgba] = index
+        return index
+
+    ## One shared pen per (palette index, width) pair instead of a new QPen per stroke
+    def pen(self, color_index, width):
+        pen = self.pens.get((color_index, width))
+        if pen is None:
+            pen = self.pens[(color_index, width)] = QPen(self.palette[color_index], width, Qt.PenStyle.SolidLine)
+        return pen
+
+    def point_count(self):
+        return len(self.points) // 2
+
+    ## Half-open range of point indexes belonging to stroke i
+    def stroke_range(self, i):
+        if i < 0:
+            i += len(self.starts)
+        end = self.starts[i + 1] if i + 1 < len(self.starts) else self.point_count()
+        return self.starts[i], end
+
+    def add_stroke(self, points, color, width):
+        self.starts.append(self.point_count())
+        self.colors.append(self.color_index(color))
+        self.widths.append(width)
+        for point in points:
+            self.points.extend((point.x(), point.y()))
+        return len(self.starts) - 1
+
+    ## Same as add_stroke for a flat (x0, y0, x1, y1, ...) coordinate sequence
+    def add_stroke_coordinates(self, coordinates, color, width):
+        self.starts.append(self.point_count())
+        self.colors.append(self.color_index(color))
+        self.widths.append(width)
+        self.points.extend(coordinates)
+        return len(self.starts) - 1
+
+    ## Extend the newest stroke while it is still being drawn
+    def add_point(self, point):
+        self.points.extend((point.x(), point.y()))
+        self.changed(len(self.starts) - 1)
+
+    ## Extend the newest stroke with a live mouse sample. Repeats of the last point are dropped and a sample that carries
+    ## on in a straight line just moves the last point. Returns False when the sample added nothing.
+    def add_sample(self, point):
+        points = self.points
+        x, y = point.x(), point.y()
+        if points[-2] == x and points[-1] == y:
+            return False
+        self.changed(len(self.starts) - 1)
+        begin, end = self.stroke_range(-1)
+        if end - begin >= 2 and continues_straight(points[-4], points[-3], points[-2], points[-1], x, y):
+            points[-2], points[-1] = x, y
+        else:
+            points.extend((x, y))
+        return True
+
+    ## Run Ramer-Douglas-Peucker over the newest stroke and return its point count before and after
+    def simplify_last_stroke(self, tolerance):
+        begin, end = self.stroke_range(-1)
+        self.changed(len(self.starts) - 1)
+        simplified = simplify_polyline(self.points[2 * begin:], tolerance)
+        del self.points[2 * begin:]
+        self.points.extend(simplified)
+        return end - begin, len(simplified) // 2
+
+    def remove_last_stroke(self):
+        self.changed(len(self.starts) - 1)
+        begin, _ = self.stroke_range(-1)
+        del self.points[2 * begin:]
+        del self.starts[-1]
+        del self.colors[-1]
+        del self.widths[-1]
+        self.erased.pop(len(self.starts), None)
+
+    ## Append every stroke of another store, translating its palette indexes; returns the index of the first one added
+    def append_store(self, other):
+        first = len(self.starts)
+        offset = self.point_count()
+        remap = [self.color_index(color) for color in other.palette]
+        self.starts.extend(array('I', [start + offset for start in other.starts]))
+        self.colors.extend(array('H', [remap[color] for color in other.colors]))
+        self.widths.extend(other.widths)
+        self.points.extend(other.points)
+        for i, segments in other.erased.items():
+            self.erased[first + i] = {k: cuts[:] for k, cuts in segments.items()}
+        return first
+
+    ## Used when reading segment-per-line files: a segment continuing the previous stroke with the same style joins it
+    def append_segment(self, start, end, color, width):
+        points = self.points
+        if (self.starts and self.widths[-1] == width and points[-2] == start.x() and points[-1] == start.y()
+                and self.colors[-1] == self.color_index(color)):
+            self.add_point(end)
+        else:
+            self.add_stroke((start, end), color, width)
+
+    def stroke_points(self, i):
+        begin, end = self.stroke_range(i)
+        coordinates = self.points[2 * begin:2 * end]
+        return [QPoint(x, y) for x, y in zip(coordinates[0::2], coordinates[1::2])]
+
+    def polygon(self, i):
+        begin, end = self.stroke_range(i)
+        polygon = QPolygon()
+        polygon.setPoints(*self.points[2 * begin:2 * end])
+        return polygon
+
+    ## Bounding rectangles of the segments of stroke i from point index first onwards, for the spatial index
+    def segment_rects(self, i, first=None):
+        begin, end = self.stroke_range(i)
+        if first is not None:
+            begin = max(first, begin)
+        width = self.widths[i]
+        points = self.points
+        if end - begin == 1:
+            point = QPoint(points[2 * begin], points[2 * begin + 1])
+            return [segment_rect(point, point, width)]
+        return [segment_rect(QPoint(points[2 * j], points[2 * j + 1]), QPoint(points[2 * j + 2], points[2 * j + 3]), width)
+                for j in range(begin, end - 1)]
+
+    ## Bounding rectangle of stroke i, pen width included
+    def bounding_rect(self, i):
+        begin, end = self.stroke_range(i)
+        xs, ys = self.points[2 * begin:2 * end:2], self.points[2 * begin + 1:2 * end:2]
+        return segment_rect(QPoint(min(xs), min(ys)), QPoint(max(xs), max(ys)), self.widths[i])
+
+    ## Cuts (k, t0, t1) that the eraser segment a-b makes in stroke i: the ranges of its segments lying within reach,
+    ## allowing for the stroke's own half width. Ranges already cut out are skipped.
+    def hit_segments(self, i, ax, ay, bx, by, reach):
+        begin, end = self.stroke_range(i)
+        reach += self.widths[i] / 2
+        left, right, top, bottom = min(ax, bx) - reach, max(ax, bx) + reach, min(ay, by) - reach, max(ay, by) + reach
+        erased = self.erased.get(i, {})
+        points = self.points
+        hits = []
+        for k in range(max(end - begin - 1, 1)):
+            j = 2 * (begin + k)
+            cx, cy = points[j], points[j + 1]
+            dx, dy = (points[j + 2], points[j + 3]) if end - begin > 1 else (cx, cy)
+            if max(cx, dx) < left or min(cx, dx) > right or max(cy, dy) < top or min(cy, dy) > bottom:
+                continue
+            cut = capsule_range(cx, cy, dx, dy, ax, ay, bx, by, reach)
+            if cut is not None and not any(t0 <= cut[0] and cut[1] <= t1 for t0, t1 in merge_ranges(erased.get(k, ()))):
+                hits.append((k,) + cut)
+        return hits
+
+    ## Apply (stroke, segment, t0, t1) cuts
+    def erase(self, cuts):
+        for i, k, t0, t1 in cuts:
+            self.erased.setdefault(i, {}).setdefault(k, []).append((t0, t1))
+            self.changed(i)
+
+    ## Take back cuts made by erase()
+    def restore(self, cuts):
+        for i, k, t0, t1 in cuts:
+            self.changed(i)
+            segments = self.erased.get(i, {})
+            if (t0, t1) in segments.get(k, ()):
+                segments[k].remove((t0, t1))
+                if not segments[k]:
+                    del segments[k]
+                if not segments:
+                    del self.erased[i]
+
+    ## Move the given strokes by (dx, dy). Cut ranges are relative to their segments and move along.
+    def translate(self, indices, dx, dy):
+        points = self.points
+        for i in indices:
+            begin, end = self.stroke_range(i)
+            points[2 * begin:2 * end:2] = array('i', [x + dx for x in points[2 * begin:2 * end:2]])
+            points[2 * begin + 1:2 * end:2] = array('i', [y + dy for y in points[2 * begin + 1:2 * end:2]])
+            self.changed(i)
+
+    ## Cuts that take the given strokes out of the drawing completely, one (i, k, 0, 1) per segment
+    def whole_cuts(self, indices):
+        cuts = []
+        for i in indices:
+            begin, end = self.stroke_range(i)
+            cuts.extend((i, k, 0.0, 1.0) for k in range(max(end - begin - 1, 1)))
+        return cuts
+
+    ## Bounding rectangle of the range t0..t1 of segment k of stroke i, pen width included
+    def cut_bounds(self, i, k, t0, t1):
+        begin, end = self.stroke_range(i)
+        j = 2 * (begin + k)
+        cx, cy = self.points[j], self.points[j + 1]
+        dx, dy = (self.points[j + 2], self.points[j + 3]) if end - begin > 1 else (cx, cy)
+        start = QPoint(round(cx + t0 * (dx - cx)), round(cy + t0 * (dy - cy)))
+        return segment_rect(start, QPoint(round(cx + t1 * (dx - cx)), round(cy + t1 * (dy - cy))), self.widths[i])
+
+    ## What the eraser left of stroke i, as flat (x0, y0, x1, y1, ...) coordinate lists, one per unbroken piece
+    def remaining_pieces(self, i):
+        begin, end = self.stroke_range(i)
+        erased = self.erased.get(i, {})
+        points = self.points
+        if end - begin == 1:
+            if not erased:
+                yield points[2 * begin:2 * end].tolist()
+            return
+        piece = [points[2 * begin], points[2 * begin + 1]]
+        for k in range(end - begin - 1):
+            j = 2 * (begin + k)
+            cx, cy, dx, dy = points[j:j + 4]
+            if k not in erased:
+                piece.extend((dx, dy))
+                continue
+            kept = kept_ranges(erased[k])
+            for t0, t1 in kept:
+                if t0 > 0:
+                    if len(piece) > 2:
+                        yield piece
+                    piece = [round(cx + t0 * (dx - cx)), round(cy + t0 * (dy - cy))]
+                piece.extend((round(cx + t1 * (dx - cx)), round(cy + t1 * (dy - cy))))
+            if not kept or kept[-1][1] < 1:
+                if len(piece) > 2:
+                    yield piece
+                piece = [dx, dy]
+        if len(piece) > 2:
+            yield piece
+
+    ## Store without erased segments: partly erased strokes are split into their remaining pieces, fully erased ones
+    ## disappear. Returns self when nothing was erased.
+    def compacted(self):
+        if not self.erased:
+            return self
+        points, starts, colors, widths = array('i'), array('I'), array('H'), array('H')
+        for i in range(len(self.starts)):
+            if i in self.erased:
+                pieces = self.remaining_pieces(i)
+            else:
+                begin, end = self.stroke_range(i)
+                pieces = (self.points[2 * begin:2 * end],)
+            for piece in pieces:
+                starts.append(len(points) // 2)
+                colors.append(self.colors[i])
+                widths.append(self.widths[i])
+                points.extend(piece)
+        store = StrokeStore()
+        store.set_columns(points, starts, colors, widths, self.palette)
+        return store
+
+    ## Every stroke as (start, end, color, width) segments, the layout of the text .draw format
+    def segments(self):
+        points = self.points
+        for i in range(len(self.starts)):
+            begin, end = self.stroke_range(i)
+            color, width = self.palette[self.colors[i]], self.widths[i]
+            if end - begin == 1:
+                point = QPoint(points[2 * begin], points[2 * begin + 1])
+                yield point, point, color, width
+            for j in range(begin, end - 1):
+                yield QPoint(points[2 * j], points[2 * j + 1]), QPoint(points[2 * j + 2], points[2 * j + 3]), color, width
+
+    ## Draw the given strokes (all of them by default) in order, one drawPolyline per stroke.
+    ## Runs of two-point strokes sharing a style, such as straight lines, still go through a single drawLines call.
+    ## With min_size, strokes spanning less than that many units both ways are drawn as a single point, which is all
+    ## they amount to in a zoomed-out rendering.
+    def draw(self, painter, indices=None, min_size=0):
+        if indices is None:
+            indices = range(len(self.starts))
+        points, colors, widths = self.points, self.colors, self.widths
+        style = None
+        batch = []
+        for i in indices:
+            if (colors[i], widths[i]) != style:
+                if batch:
+                    painter.drawLines(batch)
+                    batch = []
+                style = (colors[i], widths[i])
+                painter.setPen(self.pen(*style))
+            if i in self.erased:
+                if batch:
+                    painter.drawLines(batch)
+                    batch = []
+                self.draw_remaining(painter, i)
+                continue
+            begin, end = self.stroke_range(i)
+            if min_size and end - begin > 1:
+                xs, ys = points[2 * begin:2 * end:2], points[2 * begin + 1:2 * end:2]
+                if max(xs) - min(xs) < min_size and max(ys) - min(ys) < min_size:
+                    if batch:
+                        painter.drawLines(batch)
+                        batch = []
+                    painter.drawPoint(xs[0], ys[0])
+                    continue
+            if end - begin == 2:
+                batch.append(QLine(*points[2 * begin:2 * end]))
+                continue
+            if batch:
+                painter.drawLines(batch)
+                batch = []
+            if end - begin == 1:
+                painter.drawPoint(points[2 * begin], points[2 * begin + 1])
+            else:
+                painter.drawPolyline(self.polygon(i))
+        if batch:
+            painter.drawLines(batch)
+
+    ## Draw each piece of a partly erased stroke as its own polyline; the pen is already set
+    def draw_remaining(self, painter, i):
+        for piece in self.remaining_pieces(i):
+            if len(piece) == 2:
+                painter.drawPoint(*piece)
+            else:
+                polygon = QPolygon()
+                polygon.setPoints(*piece)
+                painter.drawPolyline(polygon)
+
+    def clear(self):
+        self.__init__()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return len(self.starts) > 0
+
+    def __getitem__(self, i):
+        return self.stroke_points(i), self.palette[self.colors[i]], self.widths[i]
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield self[i]
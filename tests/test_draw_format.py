@@ -0,0 +1,117 @@
+import struct
+
+import pytest
+from PyQt6.QtCore import QPoint
+from PyQt6.QtGui import QColor
+
+import draw_format
+from draw_format import (read_drawing, read_drawing_layers, read_layer_table, write_binary_drawing,
+                         write_text_drawing, append_binary_drawing, iter_drawing_chunks, decode_text_rows,
+                         decode_text_columns, HEADER, LAYER, MAGIC)
+from stroke_store import StrokeStore
+
+
+def make_store(offset=0):
+    store = StrokeStore()
+    store.add_stroke([QPoint(offset + 1, 2), QPoint(offset + 30, 40), QPoint(offset + 55, 12)], QColor("black"), 3)
+    store.add_stroke([QPoint(offset + 7, 7)], QColor("#ff8000"), 12)
+    store.add_stroke([QPoint(offset - 5, -9), QPoint(offset + 100, 300)], QColor(10, 20, 30, 128), 1)
+    return store
+
+
+def contents(store):
+    return (list(store.points), list(store.starts), list(store.widths), [store.palette[c].rgba() for c in store.colors])
+
+
+def test_binary_round_trip(tmp_path):
+    path = str(tmp_path / "drawing.draw")
+    store = make_store()
+    write_binary_drawing(path, store)
+    assert contents(read_drawing(path)) == contents(store)
+
+
+def test_binary_layers_round_trip(tmp_path):
+    path = str(tmp_path / "layers.draw")
+    layers = [("Bottom", True, make_store()), ("Empty", False, StrokeStore()), ("Top ünï", True, make_store(500))]
+    write_binary_drawing(path, layers)
+    back = read_drawing_layers(path)
+    assert [(name, visible) for name, visible, _ in back] == [(name, visible) for name, visible, _ in layers]
+    assert [contents(store) for _, _, store in back] == [contents(store) for _, _, store in layers]
+    assert read_layer_table(path) == [(name, visible) for name, visible, _ in layers]
+
+
+def test_erased_parts_are_not_written(tmp_path):
+    path = str(tmp_path / "erased.draw")
+    store = make_store()
+    store.erase([(0, 0, 0.0, 1.0), (0, 1, 0.0, 1.0), (2, 0, 0.25, 0.5)])
+    write_binary_drawing(path, store)
+    assert contents(read_drawing(path)) == contents(store.compacted())
+    assert len(read_drawing(path)) == 3
+
+
+def test_append_round_trip(tmp_path):
+    path = str(tmp_path / "append.draw")
+    store = make_store()
+    write_binary_drawing(path, store)
+    first = len(store)
+    store.add_stroke([QPoint(3, 3), QPoint(9, 9)], QColor("#123456"), 5)
+    append_binary_drawing(path, store, first)
+    assert contents(read_drawing(path)) == contents(store)
+
+
+def test_chunks_cover_every_layer(tmp_path):
+    path = str(tmp_path / "chunks.draw")
+    layers = [("A", True, make_store()), ("B", True, make_store(900))]
+    write_binary_drawing(path, layers)
+    stores = [StrokeStore(), StrokeStore()]
+    for position, chunk, _, _ in iter_drawing_chunks(path, first_chunk=2, max_chunk=4):
+        stores[position].append_store(chunk)
+    assert [contents(store) for store in stores] == [contents(store) for _, _, store in layers]
+
+
+## The text format keeps opaque colours only and writes a single point as a segment onto itself
+def test_text_round_trip(tmp_path):
+    path = str(tmp_path / "drawing.txt")
+    store = StrokeStore()
+    store.add_stroke([QPoint(1, 2), QPoint(30, 40), QPoint(55, 12)], QColor("black"), 3)
+    store.add_stroke([QPoint(7, 7), QPoint(7, 7)], QColor("#ff8000"), 12)
+    store.add_stroke([QPoint(-5, -9), QPoint(100, 300)], QColor(10, 20, 30), 1)
+    write_text_drawing(path, store)
+    assert contents(read_drawing(path)) == contents(store)
+
+
+@pytest.mark.skipif(draw_format.numpy is None, reason="needs NumPy")
+def test_text_decoders_agree():
+    data = b"".join(f"{i},{i + 1},{i + 2},{i + 3},#00ff00,4\n".encode() for i in range(0, 60, 2))
+    data += b"5,5,9,9,white,12\n9,9,1,1,white,12\n"
+    rows, rows_start = decode_text_rows(data)
+    columns, columns_start = decode_text_columns(data)
+    assert contents(columns) == contents(rows)
+    assert columns_start == rows_start
+
+
+@pytest.mark.parametrize("data", [
+    MAGIC + b"\x03\x00",
+    HEADER.pack(MAGIC, 3, 1, 1, 256),
+    HEADER.pack(MAGIC, 3, 2, 1, 4) + bytes(16) + LAYER.pack(0, 0, b"only one"),
+    HEADER.pack(MAGIC, 3, 1, 8, 4) + bytes(16) + LAYER.pack(0, 0, b"x"),
+    HEADER.pack(MAGIC, 3, 1, 1, 4) + bytes(16) + LAYER.pack(0, 0, b"x") + struct.pack("<iiI", 0, 0, 7 << 16 | 0x8000),
+])
+def test_broken_files_raise_value_error(tmp_path, data):
+    path = tmp_path / "broken.draw"
+    path.write_bytes(data)
+    with pytest.raises(ValueError):
+        read_drawing_layers(str(path))
+    with pytest.raises(ValueError):
+        list(iter_drawing_chunks(str(path)))
+
+
+@pytest.mark.parametrize("line", [b"1,1,2,2,#000000,70000\n", b"1,1,2,2,#000000,-3\n", b"1,1,2,4294967296,#000000,3\n",
+                                  b"-2147483649,1,2,2,black\n"])
+def test_text_values_out_of_range_raise_value_error(tmp_path, line):
+    path = tmp_path / "broken.txt"
+    path.write_bytes(line)
+    with pytest.raises(ValueError):
+        read_drawing(str(path))
+    with pytest.raises(ValueError):
+        list(iter_drawing_chunks(str(path)))
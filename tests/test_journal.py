@@ -0,0 +1,136 @@
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import pytest
+from PyQt6.QtCore import QPoint
+from PyQt6.QtGui import QColor
+from PyQt6.QtWidgets import QApplication, QMessageBox
+
+import drawing_program
+from journal import DrawingJournal, read_journal
+from stroke_store import StrokeStore
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+def test_entries_round_trip(tmp_path):
+    journal = DrawingJournal(str(tmp_path / "journal"))
+    journal.start(None)
+    store = StrokeStore()
+    store.add_stroke([QPoint(1, 2), QPoint(3, 4)], QColor("#80ff0000"), 5)
+    journal.record_stroke(store, 0)
+    journal.record_cuts("E", [(0, 0, 0.25, 0.5)])
+    journal.record_move([0], 7, -3)
+    journal.select_layer(1)
+    journal.record("U")
+    journal.record("K")
+    journal.flush()
+    base, entries = read_journal(journal.path)
+    assert base is None
+    assert [entry[0] for entry in entries] == ["S", "E", "T", "L", "U", "K"]
+    kind, coordinates, color, width = entries[0]
+    assert (list(coordinates), color.rgba(), width) == ([1, 2, 3, 4], QColor("#80ff0000").rgba(), 5)
+    assert entries[1] == ("E", [(0, 0, 0.25, 0.5)])
+    assert entries[2] == ("T", 7, -3, [0])
+    assert entries[3] == ("L", 1)
+
+
+## Edits journaled by one window come back in a window opened after it, layers and all
+def test_replay_restores_the_drawing(tmp_path, app, monkeypatch):
+    monkeypatch.setattr(drawing_program, "JOURNAL_PATH", str(tmp_path / "journal"))
+    window = drawing_program.DrawingProgram()
+    for y in (100, 200, 300):
+        window.commit_stroke((QPoint(50, y), QPoint(150, y)))
+    window.erase_segments([(0, 0, 0.0, 0.5)], window.layer)
+    window.move_strokes([2], 10, 20, window.layer)
+    window.new_layer()
+    window.commit_stroke((QPoint(5, 5), QPoint(60, 70)))
+    window.undo()
+    window.commit_stroke((QPoint(8, 8), QPoint(90, 10)))
+    expected = [(layer.name, layer.visible, list(layer.store.compacted().points)) for layer in window.layers]
+    window.journal.flush()
+    window.dirty = False
+    ## As if the window's process had crashed: its journal is left behind, unlocked
+    window.journal.release()
+    recovered = drawing_program.DrawingProgram()
+    assert recovered.journal.path == window.journal.path
+    assert [(layer.name, layer.visible, list(layer.store.compacted().points)) for layer in recovered.layers] == expected
+    recovered.dirty = False
+    window.close()
+    recovered.close()
+
+
+def test_windows_keep_their_own_journals(tmp_path, app, monkeypatch):
+    monkeypatch.setattr(drawing_program, "JOURNAL_PATH", str(tmp_path / "journal"))
+    first = drawing_program.DrawingProgram()
+    first.commit_stroke((QPoint(1, 1), QPoint(9, 9)))
+    first.journal.flush()
+    second = drawing_program.DrawingProgram()
+    assert second.journal.path != first.journal.path
+    assert not any(len(layer.store) for layer in second.layers)
+    second.close()
+    assert os.path.exists(first.journal.path)
+    first.dirty = False
+    first.close()
+
+
+## Answering Yes to saving on close and then cancelling the file dialog keeps the window and the unsaved edits
+def test_close_keeps_journal_when_not_saved(tmp_path, app, monkeypatch):
+    monkeypatch.setattr(drawing_program, "JOURNAL_PATH", str(tmp_path / "journal"))
+    monkeypatch.setattr(QMessageBox, "question", lambda *args: QMessageBox.StandardButton.Yes)
+    monkeypatch.setattr(drawing_program.QFileDialog, "getSaveFileName", lambda *args: ("", ""))
+    window = drawing_program.DrawingProgram()
+    window.commit_stroke((QPoint(1, 1), QPoint(9, 9)))
+    window.mark_dirty()
+    window.journal.flush()
+    assert not window.close()
+    assert os.path.exists(window.journal.path)
+    window.dirty = False
+    assert window.close()
+
+
+## A journal whose base file has become unreadable is kept aside instead of stopping every later start
+def test_unreadable_base_file_sets_journal_aside(tmp_path, app, monkeypatch):
+    monkeypatch.setattr(drawing_program, "JOURNAL_PATH", str(tmp_path / "journal"))
+    warnings = []
+    monkeypatch.setattr(QMessageBox, "warning", lambda *args: warnings.append(args[2]))
+    base = tmp_path / "base.draw"
+    window = drawing_program.DrawingProgram()
+    window.commit_stroke((QPoint(1, 1), QPoint(9, 9)))
+    window.start_saving(str(base))
+    window.wait_for_saves()
+    window.commit_stroke((QPoint(5, 5), QPoint(20, 9)))
+    window.journal.flush()
+    window.journal.release()
+    base.write_bytes(b"DRAW\x03\x00")
+    recovered = drawing_program.DrawingProgram()
+    assert len(warnings) == 1 and "truncated header" in warnings[0]
+    assert not any(len(layer.store) for layer in recovered.layers)
+    assert os.path.exists(window.journal.path + ".unrecovered")
+    recovered.close()
+    again = drawing_program.DrawingProgram()
+    assert len(warnings) == 1
+    again.close()
+    window.dirty = False
+    window.close()
+
+
+## A save that fails after answering Yes keeps the drawing and its journal instead of starting a new one
+def test_new_drawing_keeps_work_when_save_fails(tmp_path, app, monkeypatch):
+    monkeypatch.setattr(drawing_program, "JOURNAL_PATH", str(tmp_path / "journal"))
+    monkeypatch.setattr(QMessageBox, "question", lambda *args: QMessageBox.StandardButton.Yes)
+    monkeypatch.setattr(QMessageBox, "warning", lambda *args: None)
+    window = drawing_program.DrawingProgram()
+    window.commit_stroke((QPoint(1, 1), QPoint(9, 9)))
+    window.mark_dirty()
+    window.temp_file_path = str(tmp_path / "missing" / "drawing.draw")
+    window.new_drawing()
+    assert len(window.layer.store) == 1 and window.dirty
+    window.journal.flush()
+    assert read_journal(window.journal.path)[1]
+    window.dirty = False
+    window.close()
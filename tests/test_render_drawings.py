@@ -0,0 +1,21 @@
+import os
+
+from render_drawings import collect_drawings, output_paths
+
+
+def test_output_names_keep_directories_apart(tmp_path):
+    for name in ("a/x.draw", "b/x.draw", "b/c/x.draw", "b/notes.txt"):
+        path = tmp_path / "in" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+    single = str(tmp_path / "in" / "a" / "x.draw")
+    outputs = [os.path.relpath(output, "out")
+               for _, output in output_paths(collect_drawings([str(tmp_path / "in"), single]), "out", "png")]
+    assert sorted(outputs) == sorted([os.path.join("a", "x.png"), os.path.join("b", "x.png"),
+                                      os.path.join("b", "c", "x.png"), "x.png"])
+
+
+def test_colliding_names_get_a_suffix():
+    drawings = [("one/x.draw", "x"), ("two/x.draw", "x"), ("three/x.draw", "x")]
+    assert [output for _, output in output_paths(drawings, "out", "jpg")] == [
+        os.path.join("out", "x.jpg"), os.path.join("out", "x-2.jpg"), os.path.join("out", "x-3.jpg")]
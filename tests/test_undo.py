@@ -0,0 +1,65 @@
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import pytest
+from PyQt6.QtCore import QPoint, QSize, Qt
+from PyQt6.QtGui import QGuiApplication, QPen
+
+from tiled_canvas import TiledCanvas
+from undo import RasterHistory, image_bytes
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QGuiApplication.instance() or QGuiApplication([])
+
+
+def draw(canvas, history, k):
+    x, y = k * 300 % 4000, k * 517 % 4000
+    history.record(canvas, canvas.draw_line(QPen(Qt.GlobalColor.black, 3), QPoint(x, y), QPoint(x + 250, y + 250)))
+
+
+## Tiles painted after a checkpoint stop being shared with it and have to be paid for in full
+def test_detached_tiles_count_in_full(app):
+    canvas, history = TiledCanvas(QSize(4096, 4096)), RasterHistory()
+    history.reset(canvas)
+    for k in range(64):
+        draw(canvas, history, k)
+    live = {tile.cacheKey() for tile in canvas.tiles.values()}
+    held = {tile.cacheKey() for checkpoint in history.checkpoints.values() for tile in checkpoint.tiles.values()}
+    assert history.bytes >= len(held - live) * canvas.tile_size * canvas.tile_size * 4 > 0
+
+
+def test_max_bytes_bounds_history(app):
+    canvas, history = TiledCanvas(QSize(4096, 4096)), RasterHistory(checkpoint_interval=4, max_bytes=4 * 1024 * 1024)
+    history.reset(canvas)
+    for k in range(64):
+        draw(canvas, history, k)
+        assert history.bytes <= history.max_bytes
+    assert history.first > 0
+
+
+## The running counts agree with counting every held tile again, through undo and redo as well
+def test_running_count_matches_recount(app):
+    canvas, history = TiledCanvas(QSize(4096, 4096)), RasterHistory(checkpoint_interval=4)
+    history.reset(canvas)
+
+    def recount():
+        live = {tile.cacheKey() for tile in canvas.tiles.values()}
+        images = list(history.checkpoints.values()) + [patch for _, patch in history.operations]
+        held = {tile.cacheKey() for image in images if isinstance(image, TiledCanvas) for tile in image.tiles.values()}
+        flat = sum(image_bytes(image) for image in images if not isinstance(image, TiledCanvas))
+        return flat + len(held - live) * canvas.tile_size * canvas.tile_size * 4
+
+    for k in range(20):
+        draw(canvas, history, k)
+        assert history.bytes == recount()
+    for _ in range(9):
+        history.undo(canvas)
+        assert history.bytes == recount()
+    for _ in range(3):
+        history.redo(canvas)
+        assert history.bytes == recount()
+    draw(canvas, history, 99)
+    assert history.bytes == recount()
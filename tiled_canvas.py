@@ -0,0 +1,136 @@
+from PyQt6.QtCore import QLine, QPoint, QRect, QSize
+from PyQt6.QtGui import QColor, QImage, QImageReader, QPainter
+
+from geometry import segment_rect
+
+TILE_SIZE = 256
+
+
+## Raster canvas cut into square QImage tiles that are only allocated once something is painted on them; everywhere
+## else the canvas is plain background. Painting touches just the tiles under the dirty rectangle, so the cost of a
+## stroke does not depend on the size of the image. QImage data is implicitly shared, which makes copy() a cheap
+## snapshot: a tile is only duplicated when one side paints on it afterwards.
+## The canvas grows as paint lands past its current size.
+class TiledCanvas:
+    def __init__(self, size=QSize(800, 600), background=QColor("white"), tile_size=TILE_SIZE):
+        self.size = QSize(size)
+        self.background = QColor(background)
+        self.tile_size = tile_size
+        self.tiles = {}
+
+    def rect(self):
+        return QRect(QPoint(0, 0), self.size)
+
+    def tile_rect(self, key):
+        return QRect(key[0] * self.tile_size, key[1] * self.tile_size, self.tile_size, self.tile_size)
+
+    ## Keys (column, row) of the tiles overlapping rect; the canvas has no tiles left of or above the origin
+    def tile_keys(self, rect):
+        rect = rect.intersected(QRect(0, 0, 1 << 30, 1 << 30))
+        if rect.isEmpty():
+            return []
+        size = self.tile_size
+        return [(column, row) for row in range(rect.top() // size, rect.bottom() // size + 1)
+                for column in range(rect.left() // size, rect.right() // size + 1)]
+
+    ## The tile at key, allocated and filled with the background on first use
+    def tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = QImage(self.tile_size, self.tile_size, QImage.Format.Format_ARGB32_Premultiplied)
+            tile.fill(self.background)
+        return tile
+
+    ## Call draw(painter) once for every tile that rect touches, with the painter translated to canvas coordinates
+    def paint(self, rect, draw):
+        for key in self.tile_keys(rect):
+            painter = QPainter(self.tile(key))
+            painter.translate(-key[0] * self.tile_size, -key[1] * self.tile_size)
+            draw(painter)
+            painter.end()
+
+    ## Draw a line and return the rectangle it dirtied
+    def draw_line(self, pen, start, end):
+        return self.draw_lines(pen, (start, end))
+
+    ## Draw the connected segments through points, each as its own line like draw_line would, opening one painter per
+    ## tile for all of them; returns the rectangle they dirtied
+    def draw_lines(self, pen, points):
+        lines = [QLine(start, end) for start, end in zip(points, points[1:])]
+        def draw(painter):
+            painter.setPen(pen)
+            painter.drawLines(lines)
+        rect = QRect()
+        for line in lines:
+            rect = rect.united(segment_rect(line.p1(), line.p2(), pen.width()))
+        self.paint(rect, draw)
+        self.size = self.size.expandedTo(QSize(max(point.x() for point in points) + 1, max(point.y() for point in points) + 1))
+        return rect
+
+    ## Draw the part of the canvas inside rect; areas without tiles are filled with the background
+    def render(self, painter, rect):
+        for key in self.tile_keys(rect):
+            tile_rect = self.tile_rect(key)
+            area = tile_rect.intersected(rect)
+            tile = self.tiles.get(key)
+            if tile is None:
+                painter.fillRect(area, self.background)
+            else:
+                painter.drawImage(area, tile, area.translated(-tile_rect.topLeft()))
+
+    ## With a rect, the pixels inside it flattened into one QImage. Without, a snapshot of the whole canvas that
+    ## shares its tiles with this one.
+    def copy(self, rect=None):
+        if rect is None:
+            snapshot = TiledCanvas(self.size, self.background, self.tile_size)
+            snapshot.tiles = {key: QImage(tile) for key, tile in self.tiles.items()}
+            return snapshot
+        image = QImage(rect.size(), QImage.Format.Format_ARGB32_Premultiplied)
+        painter = QPainter(image)
+        painter.translate(-rect.left(), -rect.top())
+        self.render(painter, rect)
+        painter.end()
+        return image
+
+    ## Replace the pixels under patch with it. A whole-canvas snapshot from copy() is adopted as it is, tiles and size.
+    def paste(self, point, patch):
+        if isinstance(patch, TiledCanvas):
+            self.size, self.background = QSize(patch.size), QColor(patch.background)
+            self.tiles = {key: QImage(tile) for key, tile in patch.tiles.items()}
+            return
+        def draw(painter):
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+            painter.drawImage(point, patch)
+        self.paint(QRect(point, patch.size()), draw)
+
+    ## Wipe the canvas to one colour; every tile is released
+    def fill(self, color):
+        self.background = QColor(color)
+        self.tiles = {}
+
+    def toImage(self):
+        return self.copy(self.rect())
+
+    def save(self, file_name):
+        return self.toImage().save(file_name)
+
+    ## Replace the canvas with an image file, cut into tiles; the canvas takes the image's size
+    def load(self, file_name):
+        reader = QImageReader(file_name)
+        ## Qt refuses images over 256 MB by default; poster-size drawings are exactly what the tiles are for
+        size = reader.size()
+        needed = size.width() * size.height() * 4 // (1024 * 1024) + 1
+        if QImageReader.allocationLimit() and needed > QImageReader.allocationLimit():
+            QImageReader.setAllocationLimit(needed)
+        image = reader.read()
+        if image.isNull():
+            return False
+        self.tiles = {}
+        self.size = image.size()
+        for key in self.tile_keys(self.rect()):
+            tile_rect = self.tile_rect(key)
+            painter = QPainter(self.tile(key))
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+            painter.drawImage(QPoint(0, 0), image, tile_rect.intersected(image.rect()))
+            painter.end()
+        return True
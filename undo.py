@@ -0,0 +1,276 @@
+from collections import deque
+
+from PyQt6.QtCore import QRect
+from PyQt6.QtGui import QPainter, QPixmap
+
+from tiled_canvas import TiledCanvas
+
+
+## Linear undo/redo over command objects with undo(), redo() and a size estimate in bytes.
+## History is capped by memory: once over max_bytes the oldest commands are forgotten.
+class UndoStack:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.done = deque()
+        self.undone = []
+        self.bytes = 0
+
+    ## Record a command that has already been carried out
+    def push(self, command):
+        self.bytes -= sum(undone.size for undone in self.undone)
+        self.undone = []
+        self.done.append(command)
+        self.bytes += command.size
+        while self.bytes > self.max_bytes and len(self.done) > 1:
+            self.bytes -= self.done.popleft().size
+
+    def undo(self):
+        if not self.done:
+            return False
+        command = self.done.pop()
+        command.undo()
+        self.undone.append(command)
+        return True
+
+    def redo(self):
+        if not self.undone:
+            return False
+        command = self.undone.pop()
+        command.redo()
+        self.done.append(command)
+        return True
+
+    def clear(self):
+        self.done.clear()
+        self.undone = []
+        self.bytes = 0
+
+
+## A stroke appended to a vector drawing. Undo always meets it as the newest stroke, so both directions are O(stroke);
+## the owning window does the store, index and repaint work through remove_last_stroke() and restore_stroke().
+## In a window with layers the command keeps the layer the stroke went into and hands it back to those calls.
+class AddStrokeCommand:
+    def __init__(self, window, i, layer=None):
+        store = window.lines if layer is None else layer.store
+        begin, end = store.stroke_range(i)
+        self.window = window
+        self.layer = layer
+        self.coordinates = store.points[2 * begin:2 * end]
+        self.color = store.palette[store.colors[i]]
+        self.width = store.widths[i]
+        self.size = 8 * (end - begin) + 100
+
+    def undo(self):
+        if self.layer is None:
+            self.window.remove_last_stroke()
+        else:
+            self.window.remove_last_stroke(self.layer)
+
+    def redo(self):
+        if self.layer is None:
+            self.window.restore_stroke(self.coordinates, self.color, self.width)
+        else:
+            self.window.restore_stroke(self.coordinates, self.color, self.width, self.layer)
+
+
+## Cuts made by one eraser drag, on one layer. The store keeps the cut strokes in place, so undo only takes the cuts
+## back.
+class EraseCommand:
+    def __init__(self, window, cuts, layer):
+        self.window = window
+        self.cuts = cuts
+        self.layer = layer
+        self.size = 32 * len(cuts) + 100
+
+    def undo(self):
+        self.window.restore_segments(self.cuts, self.layer)
+
+    def redo(self):
+        self.window.erase_segments(self.cuts, self.layer)
+
+
+## Strokes of one layer moved by the selection tool. The store moves them in place, so undo moves them back.
+class MoveCommand:
+    def __init__(self, window, indices, dx, dy, layer):
+        self.window = window
+        self.indices = indices
+        self.dx, self.dy = dx, dy
+        self.layer = layer
+        self.size = 8 * len(indices) + 100
+
+    def undo(self):
+        self.window.move_strokes(self.indices, -self.dx, -self.dy, self.layer)
+
+    def redo(self):
+        self.window.move_strokes(self.indices, self.dx, self.dy, self.layer)
+
+
+def image_bytes(image):
+    return image.width() * image.height() * image.depth() // 8
+
+
+## Copy patch onto target (a QPixmap or QImage) with its top-left corner at point
+def paste(target, point, patch):
+    if isinstance(target, TiledCanvas):
+        target.paste(point, patch)
+        return
+    painter = QPainter(target)
+    painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+    if isinstance(patch, QPixmap):
+        painter.drawPixmap(point, patch)
+    else:
+        painter.drawImage(point, patch)
+    painter.end()
+
+
+## Pixels of rect as a new image; a rect covering the whole canvas takes a full copy() instead, which a tiled canvas
+## answers with a snapshot of shared tiles rather than one flattened bitmap
+def copy_region(canvas, rect):
+    return canvas.copy() if rect == canvas.rect() else canvas.copy(rect)
+
+
+## Undo history for a raster canvas. Every operation stores only the pixels of its dirty rectangle as they look
+## afterwards; every checkpoint_interval operations a full copy of the canvas is kept as well. Redo pastes one patch.
+## Undo rebuilds the rectangle from the nearest earlier checkpoint plus at most checkpoint_interval patches clipped to
+## it, so both directions are O(region) and never replay the whole history. Over max_bytes, the oldest stretch up to
+## the next checkpoint is dropped.
+## Tiled snapshots share their tiles with the canvas and with each other until one side paints on a tile and detaches
+## it. The history therefore counts references to every tile buffer (by QImage.cacheKey()) it holds, and which buffers
+## the canvas holds per tile position; a buffer costs its full size once nothing but the history has it. Only the tiles
+## under a changed rectangle can detach, so keeping this up to date is O(region) as well.
+class RasterHistory:
+    def __init__(self, checkpoint_interval=16, max_bytes=256 * 1024 * 1024):
+        self.checkpoint_interval = checkpoint_interval
+        self.max_bytes = max_bytes
+        self.reset(None)
+
+    ## Start over from canvas as the oldest reachable state
+    def reset(self, canvas):
+        self.first = 0
+        self.position = 0
+        self.operations = []
+        self.checkpoints = {}
+        ## References from the history per tile buffer, and the buffer the canvas has at each tile position with the
+        ## number of positions per buffer
+        self.tile_references = {}
+        self.canvas_tiles = {}
+        self.canvas_references = {}
+        ## Bytes of flat patches, and tile buffers only the history holds, at tile_bytes each
+        self.flat_bytes = 0
+        self.held_tiles = 0
+        self.tile_bytes = 0
+        self.bytes = 0
+        if canvas is not None:
+            if isinstance(canvas, TiledCanvas):
+                self.tile_bytes = canvas.tile_size * canvas.tile_size * 4
+                self.track_canvas(canvas)
+            self.checkpoints[0] = canvas.copy()
+            self.hold(self.checkpoints[0], 1)
+
+    ## Count image in (references 1) or out (-1) of the history
+    def hold(self, image, references):
+        if isinstance(image, TiledCanvas):
+            for tile in image.tiles.values():
+                key = tile.cacheKey()
+                count = self.tile_references.get(key, 0)
+                if not self.canvas_references.get(key):
+                    self.held_tiles += (count + references > 0) - (count > 0)
+                if count + references:
+                    self.tile_references[key] = count + references
+                else:
+                    del self.tile_references[key]
+        else:
+            self.flat_bytes += references * image_bytes(image)
+        self.bytes = self.flat_bytes + self.held_tiles * self.tile_bytes
+
+    ## Note which buffers the canvas has under rect (all of it by default) after it changed there
+    def track_canvas(self, canvas, rect=None):
+        if not isinstance(canvas, TiledCanvas):
+            return
+        positions = set(self.canvas_tiles) | set(canvas.tiles) if rect is None else canvas.tile_keys(rect)
+        for position in positions:
+            old = self.canvas_tiles.pop(position, None)
+            tile = canvas.tiles.get(position)
+            new = tile.cacheKey() if tile is not None else None
+            if old == new:
+                if new is not None:
+                    self.canvas_tiles[position] = new
+                continue
+            if old is not None:
+                self.canvas_references[old] -= 1
+                if not self.canvas_references[old]:
+                    del self.canvas_references[old]
+                    self.held_tiles += old in self.tile_references
+            if new is not None:
+                self.canvas_tiles[position] = new
+                count = self.canvas_references.get(new, 0)
+                self.canvas_references[new] = count + 1
+                if not count:
+                    self.held_tiles -= new in self.tile_references
+        self.bytes = self.flat_bytes + self.held_tiles * self.tile_bytes
+
+    ## Remember the state of rect after an operation that has just been painted onto canvas
+    def record(self, canvas, rect):
+        rect = rect.intersected(canvas.rect())
+        if rect.isEmpty():
+            return
+        self.track_canvas(canvas, rect)
+        for _, stale in self.operations[self.position - self.first:]:
+            self.hold(stale, -1)
+        del self.operations[self.position - self.first:]
+        for state in [state for state in self.checkpoints if state > self.position]:
+            self.hold(self.checkpoints.pop(state), -1)
+        patch = copy_region(canvas, rect)
+        self.operations.append((rect, patch))
+        self.hold(patch, 1)
+        self.position += 1
+        if self.position % self.checkpoint_interval == 0:
+            self.checkpoints[self.position] = canvas.copy()
+            self.hold(self.checkpoints[self.position], 1)
+        self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes:
+            later = [state for state in self.checkpoints if self.first < state <= self.position]
+            if not later:
+                return
+            new_first = min(later)
+            for _, patch in self.operations[:new_first - self.first]:
+                self.hold(patch, -1)
+            del self.operations[:new_first - self.first]
+            for state in [state for state in self.checkpoints if state < new_first]:
+                self.hold(self.checkpoints.pop(state), -1)
+            self.first = new_first
+
+    def can_undo(self):
+        return self.position > self.first
+
+    def can_redo(self):
+        return self.position - self.first < len(self.operations)
+
+    ## Step back one operation; returns the rectangle that changed, or an empty QRect if there is nothing to undo
+    def undo(self, canvas):
+        if not self.can_undo():
+            return QRect()
+        rect = self.operations[self.position - self.first - 1][0]
+        target = self.position - 1
+        checkpoint = max(state for state in self.checkpoints if state <= target)
+        restored = copy_region(self.checkpoints[checkpoint], rect)
+        for state in range(checkpoint, target):
+            patch_rect, patch = self.operations[state - self.first]
+            overlap = patch_rect.intersected(rect)
+            if not overlap.isEmpty():
+                paste(restored, overlap.topLeft() - rect.topLeft(), copy_region(patch, overlap.translated(-patch_rect.topLeft())))
+        paste(canvas, rect.topLeft(), restored)
+        self.track_canvas(canvas, None if isinstance(restored, TiledCanvas) else rect)
+        self.position = target
+        return rect
+
+    def redo(self, canvas):
+        if not self.can_redo():
+            return QRect()
+        rect, patch = self.operations[self.position - self.first]
+        paste(canvas, rect.topLeft(), patch)
+        self.track_canvas(canvas, None if isinstance(patch, TiledCanvas) else rect)
+        self.position += 1
+        return rect